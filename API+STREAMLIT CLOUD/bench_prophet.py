@@ -0,0 +1,108 @@
+"""Benchmark and accuracy report: fast (deterministic) vs full (sampling) Prophet prediction.
+
+Usage:
+    python bench_prophet.py --model ../ML/prophet_model.pkl [--intervals prophet_intervals.json]
+
+Without --intervals the residual quantiles are calibrated from the model's own history,
+the same way the training job does it.
+
+The held-out check refits the model without its last --holdout-days days, calibrates on
+the shortened history and reports how often the actual values fall inside the fast and
+the full intervals, next to the nominal interval_width.
+"""
+import argparse
+import json
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from prophet.diagnostics import prophet_copy
+
+from fast_prophet import calibrate_residual_quantiles, load_interval_calibration, predict_fast
+
+
+def time_call(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, float(np.median(timings))
+
+
+def holdout_coverage(model, days):
+    """Empirical interval coverage on the last days of the history, with the model refitted without them."""
+    history = model.history
+    cutoff = history['ds'].max() - pd.Timedelta(days=days)
+    train, test = history[history['ds'] <= cutoff], history[history['ds'] > cutoff]
+    refit = prophet_copy(model, cutoff)
+    refit.fit(train[['ds', 'y']])
+    calibration = calibrate_residual_quantiles(refit)
+
+    actual = test['y'].to_numpy()
+    fast = predict_fast(refit, test['ds'], calibration)
+    full = refit.predict(test[['ds']])[['yhat', 'yhat_lower', 'yhat_upper']].to_numpy().T
+
+    def coverage(values):
+        return float(np.mean((actual >= values[1]) & (actual <= values[2])))
+
+    return {
+        "days": days,
+        "cutoff": str(cutoff.date()),
+        "n_points": int(len(test)),
+        "nominal_coverage": refit.interval_width,
+        "fast_coverage": coverage(fast),
+        "full_coverage": coverage(full),
+        "fast_mean_width": float(np.mean(fast[2] - fast[1])),
+        "full_mean_width": float(np.mean(full[2] - full[1])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="../ML/prophet_model.pkl")
+    parser.add_argument("--intervals", default=None)
+    parser.add_argument("--horizons", default="7,30,90,365")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--holdout-days", type=int, default=90)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    model = joblib.load(args.model)
+    calibration = load_interval_calibration(args.intervals) or calibrate_residual_quantiles(model)
+    start = model.history['ds'].max() + pd.Timedelta(days=1)
+
+    report = {"calibration": calibration, "horizons": []}
+    for horizon in [int(h) for h in args.horizons.split(",")]:
+        ds = pd.date_range(start=start, periods=horizon, freq='D')
+
+        full, full_time = time_call(lambda: model.predict(pd.DataFrame({'ds': ds})), args.repeats)
+        fast, fast_time = time_call(lambda: predict_fast(model, ds, calibration), args.repeats)
+
+        full_values = full[['yhat', 'yhat_lower', 'yhat_upper']].to_numpy().T
+        full_width = full_values[2] - full_values[1]
+        fast_width = fast[2] - fast[1]
+        report["horizons"].append({
+            "days": horizon,
+            "full_ms": full_time * 1000,
+            "fast_ms": fast_time * 1000,
+            "speedup": full_time / fast_time,
+            "yhat_max_abs_diff": float(np.max(np.abs(fast[0] - full_values[0]))),
+            "lower_mean_abs_diff": float(np.mean(np.abs(fast[1] - full_values[1]))),
+            "upper_mean_abs_diff": float(np.mean(np.abs(fast[2] - full_values[2]))),
+            "width_ratio_first_day": float(fast_width[0] / full_width[0]),
+            "width_ratio_last_day": float(fast_width[-1] / full_width[-1]),
+        })
+
+    if args.holdout_days:
+        report["holdout"] = holdout_coverage(model, args.holdout_days)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Offline load test for the prediction API.
+
+Boots main:app under uvicorn in a subprocess with the local stand-ins
+(LOCAL_GCS_ROOT pointing at a temporary bucket seeded with ML/*.pkl and
+LOCAL_BIGQUERY=1), drives /predict and /demand_predict at the requested
+concurrency levels and writes throughput, latency percentiles and server
+memory (summed over the server and its worker processes) as JSON.
+
+Usage:
+    python benchmark.py --concurrency 1,8,32 --requests 2000 --output bench.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+bucket_name = "bucket_for_model_tfm"
+
+
+def seed_bucket(root, models_dir, with_forecast_artifact, with_cluster_bundle=False):
+    bucket_dir = os.path.join(root, bucket_name)
+    os.makedirs(bucket_dir, exist_ok=True)
+    for filename in ("clusterizacion_clientes_model.pkl", "clusterizacion_clientes_modelscaler.pkl", "prophet_model.pkl"):
+        shutil.copyfile(os.path.join(models_dir, filename), os.path.join(bucket_dir, filename))
+
+    if with_cluster_bundle:
+        # Same bundle the clustering job publishes, built from the checked-in pickles.
+        import joblib
+        from fast_kmeans import FastKMeans, save_bundle
+
+        scaler = joblib.load(os.path.join(models_dir, "clusterizacion_clientes_modelscaler.pkl"))
+        kmeans = joblib.load(os.path.join(models_dir, "clusterizacion_clientes_model.pkl"))
+        save_bundle(os.path.join(bucket_dir, "clusterizacion_clientes_bundle.npz"), FastKMeans.from_sklearn(scaler, kmeans),
+                    list(scaler.feature_names_in_), {"source": "ML/*.pkl"})
+
+    if with_forecast_artifact:
+        # Same artifacts the demand training job publishes, built from the checked-in model
+        # with the same fast_prophet helpers the job uses.
+        import joblib
+        from fast_prophet import build_forecast_artifact, calibrate_residual_quantiles
+
+        model = joblib.load(os.path.join(models_dir, "prophet_model.pkl"))
+        np.save(os.path.join(bucket_dir, "prophet_forecast.npy"), build_forecast_artifact(model))
+        with open(os.path.join(bucket_dir, "prophet_intervals.json"), "w") as file:
+            json.dump(calibrate_residual_quantiles(model), file)
+
+
+def process_tree(pid):
+    """pid plus all of its descendants (the Prophet pool workers), read from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                # The ppid is the second field after the parenthesised command name.
+                ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def read_rss_mb(pid):
+    """Current and peak RSS summed over the server process and its children."""
+    rss = peak = None
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        rss = (rss or 0) + int(line.split()[1]) / 1024
+                    elif line.startswith("VmHWM:"):
+                        peak = (peak or 0) + int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return rss, peak
+
+
+def wait_until_ready(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/ready")
+            status = conn.getresponse().status
+            conn.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Service did not become ready")
+
+
+def cluster_payload(rng):
+    return {
+        "total_spent": rng.uniform(10, 2000),
+        "purchase_frequency": rng.randint(1, 5),
+        "average_order_value": rng.uniform(10, 1000),
+        "num_reviews": rng.randint(0, 5),
+        "avg_review_score": rng.uniform(1, 5),
+        "days_since_last_purchase": rng.uniform(0, 1200),
+    }
+
+
+def demand_payload(rng, days, mode):
+    start = datetime(2023, 9, 4) + timedelta(days=rng.randint(0, 300))
+    payload = {"days": days, "start_date": start.strftime("%Y-%m-%d")}
+    if mode:
+        payload["mode"] = mode
+    return payload
+
+
+def run_level(port, path, make_payload, concurrency, total_requests):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+
+    def worker(seed):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        local = []
+        local_errors = 0
+        headers = {"Content-Type": "application/json"}
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            body = json.dumps(make_payload(rng))
+            start = time.perf_counter()
+            try:
+                conn.request("POST", path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "endpoint": path,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": float(latencies_ms.mean()),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p95": float(np.percentile(latencies_ms, 95)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "max": float(latencies_ms.max()),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint and concurrency level")
+    parser.add_argument("--endpoints", default="predict,demand_predict")
+    parser.add_argument("--demand-days", type=int, default=30)
+    parser.add_argument("--demand-mode", default=None, choices=[None, "full", "fast"])
+    parser.add_argument("--with-forecast-artifact", action="store_true")
+    parser.add_argument("--with-cluster-bundle", action="store_true")
+    parser.add_argument("--models-dir", default=os.path.join(here, "..", "ML"))
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="api-bench-")
+    gcs_root = os.path.join(workdir, "gcs")
+    seed_bucket(gcs_root, args.models_dir, args.with_forecast_artifact, args.with_cluster_bundle)
+
+    env = dict(
+        os.environ,
+        LOCAL_GCS_ROOT=gcs_root,
+        LOCAL_BIGQUERY="1",
+        MODEL_CACHE_DIR=os.path.join(workdir, "cache"),
+        MODEL_POLL_SECONDS="0",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+
+    endpoints = {
+        "predict": ("/predict", cluster_payload),
+        "demand_predict": ("/demand_predict", lambda rng: demand_payload(rng, args.demand_days, args.demand_mode)),
+    }
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "config": vars(args),
+        "results": [],
+    }
+    try:
+        start = time.perf_counter()
+        wait_until_ready(args.port, timeout=300)
+        report["startup_s"] = time.perf_counter() - start
+        report["idle_rss_mb"] = read_rss_mb(server.pid)[0]
+
+        for name in args.endpoints.split(","):
+            path, make_payload = endpoints[name]
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                result = run_level(args.port, path, make_payload, concurrency, args.requests)
+                result["server_rss_mb"], result["server_peak_rss_mb"] = read_rss_mb(server.pid)
+                report["results"].append(result)
+                print(f"{path} c={concurrency}: {result['throughput_rps']:.1f} req/s, "
+                      f"p50 {result['latency_ms']['p50']:.2f} ms, p99 {result['latency_ms']['p99']:.2f} ms, "
+                      f"errors {result['errors']}", file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+
+import yaml
+
+
+def _to_date(value):
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m-%d')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    print(f"Error formatting date: {value}")
+    return None
+
+
+def _to_bool(value):
+    # bool("false") is True, so strings are parsed explicitly.
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true')
+    return bool(value)
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+converters = {
+    'STRING': str,
+    'FLOAT': float,
+    'FLOAT64': float,
+    'INTEGER': int,
+    'INT64': int,
+    'BOOLEAN': _to_bool,
+    'BOOL': _to_bool,
+    'DATE': _to_date,
+    'TIMESTAMP': _to_timestamp,
+}
+
+
+class RowFormatter:
+    """Turns prediction dicts into BigQuery rows; built once per schema YAML."""
+
+    def __init__(self, schema_file):
+        with open(schema_file, 'r') as file:
+            schema_dict = yaml.safe_load(file)
+        self.fields = [(col['name'], col['type'].upper()) for col in schema_dict]
+        self._converters = [(name, converters.get(field_type, str)) for name, field_type in self.fields]
+        self.has_timestamp = any(name == 'timestamp' for name, _ in self.fields)
+
+    def __call__(self, data, **overrides):
+        values = {**data, **overrides}
+        if self.has_timestamp:
+            values['timestamp'] = datetime.utcnow().isoformat()
+        row = {}
+        for name, convert in self._converters:
+            value = values.get(name)
+            row[name] = None if value is None else convert(value)
+        return row
+
+    def format_frame(self, df, **constants):
+        """Vectorized variant for whole DataFrames; returns a list of JSON-ready rows."""
+        import pandas as pd
+
+        formatted = pd.DataFrame(index=df.index)
+        for name, field_type in self.fields:
+            if name in constants:
+                formatted[name] = constants[name]
+            elif name == 'timestamp' and field_type == 'TIMESTAMP':
+                formatted[name] = datetime.utcnow().isoformat()
+            elif name in df.columns:
+                column = df[name]
+                if field_type in ('INTEGER', 'INT64'):
+                    column = column.round().astype('Int64')
+                elif field_type in ('BOOLEAN', 'BOOL'):
+                    column = column.map(_to_bool, na_action='ignore')
+                elif field_type == 'DATE':
+                    column = pd.to_datetime(column, errors='coerce').dt.strftime('%Y-%m-%d')
+                formatted[name] = column
+            else:
+                formatted[name] = None
+        return json.loads(formatted.to_json(orient='records'))
+
+
+class BigQuerySink:
+    def __init__(self, client, project_id, dataset_id):
+        self.client = client
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+
+    def write(self, table_id, rows):
+        errors = self.client.insert_rows_json(f"{self.project_id}.{self.dataset_id}.{table_id}", rows)
+        if errors:
+            print(f"Failed to insert rows into BigQuery: {errors[:10]}")
+        return len(errors)
+
+
+class SQLiteSink:
+    """Offline stand-in: one SQLite table per BigQuery table, columns taken from the rows."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._tables = set()
+
+    def write(self, table_id, rows):
+        columns = list(rows[0])
+        quoted = ", ".join(f'"{col}"' for col in columns)
+        with self._lock:
+            if table_id not in self._tables:
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_id}" ({quoted})')
+                self._tables.add(table_id)
+            self.conn.executemany(
+                f'INSERT INTO "{table_id}" ({quoted}) VALUES ({", ".join("?" for _ in columns)})',
+                [tuple(row.get(col) for col in columns) for row in rows],
+            )
+            self.conn.commit()
+        return 0
+
+
+class JsonlFileSink:
+    """Offline stand-in: appends rows to <directory>/<table_id>.jsonl."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, table_id, rows):
+        with open(os.path.join(self.directory, f"{table_id}.jsonl"), 'a') as file:
+            for row in rows:
+                file.write(json.dumps(row) + "\n")
+        return 0
+
+
+def make_sink(kind, path, bq_client, project_id, dataset_id):
+    if kind == 'sqlite':
+        return SQLiteSink(path or 'predictions.sqlite')
+    if kind == 'file':
+        return JsonlFileSink(path or 'predictions')
+    return BigQuerySink(bq_client, project_id, dataset_id)
+
+
+class MicroBatchWriter:
+    """Background writer with a bounded queue, flushing by batch size or age.
+
+    Producers never wait on the sink: ``submit`` drops rows (and counts them)
+    when the queue is full, unless a ``timeout`` is given, in which case the
+    caller waits up to that long for room (counted as backpressure).
+    """
+
+    def __init__(self, sink, max_queue=10000, batch_size=500, flush_interval=1.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = object()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.counters = {
+            'rows_enqueued': 0,
+            'rows_written': 0,
+            'rows_dropped': 0,
+            'rows_failed': 0,
+            'backpressure_waits': 0,
+            'flushes': 0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="prediction-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """Flush what is queued and stop the worker, waiting at most ``timeout`` seconds."""
+        if self._thread is not None:
+            self._stopping.set()
+            try:
+                # Only wakes a worker blocked on an empty queue; a full queue means it is not blocked.
+                self._queue.put_nowait(self._stop)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                print(f"Prediction writer still flushing after {timeout}s, "
+                      f"{self._queue.qsize()} batches left in the queue")
+            self._thread = None
+
+    def _count(self, name, amount):
+        with self._lock:
+            self.counters[name] += amount
+
+    def submit(self, table_id, rows, timeout=0):
+        """Queue rows for table_id in chunks of batch_size. Returns how many were accepted."""
+        accepted = 0
+        for start in range(0, len(rows), self.batch_size):
+            chunk = rows[start:start + self.batch_size]
+            try:
+                self._queue.put_nowait((table_id, chunk))
+            except queue.Full:
+                if not timeout:
+                    self._count('rows_dropped', len(rows) - accepted)
+                    break
+                self._count('backpressure_waits', 1)
+                try:
+                    self._queue.put((table_id, chunk), timeout=timeout)
+                except queue.Full:
+                    self._count('rows_dropped', len(rows) - accepted)
+                    break
+            accepted += len(chunk)
+        self._count('rows_enqueued', accepted)
+        return accepted
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['queue_capacity'] = self._queue.maxsize
+        return stats
+
+    def _flush(self, pending):
+        for table_id, rows in pending.items():
+            for start in range(0, len(rows), self.batch_size):
+                chunk = rows[start:start + self.batch_size]
+                try:
+                    failed = self.sink.write(table_id, chunk)
+                except Exception as e:
+                    print(f"Prediction sink write failed for {table_id}: {e}")
+                    failed = len(chunk)
+                self._count('rows_failed', failed)
+                self._count('rows_written', len(chunk) - failed)
+        self._count('flushes', 1)
+        pending.clear()
+
+    def _drain(self, pending, item):
+        while True:
+            if item is not None and item is not self._stop:
+                table_id, rows = item
+                pending.setdefault(table_id, []).extend(rows)
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if pending:
+            self._flush(pending)
+
+    def _run(self):
+        pending = {}
+        pending_rows = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._stop or self._stopping.is_set():
+                self._drain(pending, item)
+                return
+
+            if item is not None:
+                table_id, rows = item
+                pending.setdefault(table_id, []).extend(rows)
+                pending_rows += len(rows)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if pending and (pending_rows >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(pending)
+                pending_rows = 0
+                deadline = None
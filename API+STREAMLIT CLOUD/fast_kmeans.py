@@ -0,0 +1,147 @@
+import json
+import threading
+import numpy as np
+
+# Cluster bundle written by the clustering job (CLOUD RUN/app.py): a plain .npz with
+# the scaler parameters, the centroids in scaled space, the feature order and metadata.
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_KEYS = ('format_version', 'feature_names', 'mean', 'scale', 'centroids', 'metadata')
+
+
+class FastKMeans:
+    """StandardScaler + KMeans.predict on plain contiguous NumPy arrays.
+
+    The arithmetic mirrors scikit-learn: the scaler does ``(x - mean_) / scale_``
+    and KMeans assigns the centroid minimising ``||c||^2 - 2 x.c`` (the constant
+    ``||x||^2`` term is skipped, as in sklearn's Lloyd kernel).
+    """
+
+    def __init__(self, mean, scale, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float64)
+        self.n_clusters, self.n_features = self.centroids.shape
+        self.mean = np.ascontiguousarray(mean, dtype=np.float64).reshape(self.n_features)
+        self.scale = np.ascontiguousarray(scale, dtype=np.float64).reshape(self.n_features)
+        self.centroids_t = np.ascontiguousarray(self.centroids.T)
+        self.centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self._local = threading.local()
+
+    @classmethod
+    def from_sklearn(cls, scaler, kmeans):
+        n_features = kmeans.cluster_centers_.shape[1]
+        mean = scaler.mean_ if scaler.with_mean else np.zeros(n_features)
+        scale = scaler.scale_ if scaler.with_std else np.ones(n_features)
+        return cls(mean, scale, kmeans.cluster_centers_)
+
+    def _buffers(self):
+        # Handlers run on a threadpool, so every thread gets its own scratch space.
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = (np.empty(self.n_features), np.empty(self.n_clusters))
+            self._local.buffers = buffers
+        return buffers
+
+    def transform_one(self, values):
+        """Scales one row into this thread's buffer and returns the buffer."""
+        x, _ = self._buffers()
+        x[:] = values
+        np.subtract(x, self.mean, out=x)
+        np.divide(x, self.scale, out=x)
+        return x
+
+    def assign_one(self, x):
+        _, distances = self._buffers()
+        np.dot(self.centroids, x, out=distances)
+        distances *= -2.0
+        distances += self.centroid_sq_norms
+        return int(distances.argmin())
+
+    def predict_one(self, values):
+        return self.assign_one(self.transform_one(values))
+
+    def transform(self, X):
+        X = np.array(X, dtype=np.float64, order='C')
+        X -= self.mean
+        X /= self.scale
+        return X
+
+    def assign(self, X):
+        distances = X @ self.centroids_t
+        distances *= -2.0
+        distances += self.centroid_sq_norms
+        return distances.argmin(axis=1)
+
+    def predict(self, X):
+        return self.assign(self.transform(X))
+
+
+def save_bundle(path, fast, feature_names, metadata=None):
+    """Writes a FastKMeans as a cluster bundle (no pickled objects)."""
+    with open(path, 'wb') as file:
+        np.savez(
+            file,
+            format_version=np.int64(BUNDLE_FORMAT_VERSION),
+            feature_names=np.array(feature_names, dtype=str),
+            mean=fast.mean,
+            scale=fast.scale,
+            centroids=fast.centroids,
+            metadata=np.array(json.dumps(metadata or {})),
+        )
+
+
+def load_bundle(path, feature_names):
+    """Loads a cluster bundle and checks it against the serving feature order.
+
+    Returns ``(FastKMeans, metadata)``. Raises ValueError for an unknown format
+    version, a different feature order, inconsistent shapes or invalid values,
+    so a bundle that does not match the API is never served.
+    """
+    with np.load(path, allow_pickle=False) as bundle:
+        missing = [key for key in BUNDLE_KEYS if key not in bundle.files]
+        if missing:
+            raise ValueError(f"Cluster bundle is missing {missing}")
+        arrays = {key: bundle[key] for key in BUNDLE_KEYS}
+
+    version = int(arrays['format_version'])
+    if version != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported cluster bundle format {version}, expected {BUNDLE_FORMAT_VERSION}")
+    names = [str(name) for name in arrays['feature_names']]
+    if names != list(feature_names):
+        raise ValueError(f"Cluster bundle features {names} do not match {list(feature_names)}")
+
+    mean, scale, centroids = arrays['mean'], arrays['scale'], arrays['centroids']
+    n_features = len(names)
+    if mean.shape != (n_features,) or scale.shape != (n_features,):
+        raise ValueError(f"Cluster bundle scaler shapes {mean.shape}/{scale.shape} do not match {n_features} features")
+    if centroids.ndim != 2 or centroids.shape[0] == 0 or centroids.shape[1] != n_features:
+        raise ValueError(f"Cluster bundle centroids have shape {centroids.shape}")
+    if not (np.isfinite(mean).all() and np.isfinite(centroids).all() and np.isfinite(scale).all() and (scale > 0).all()):
+        raise ValueError("Cluster bundle contains non-finite values or a non-positive scale")
+
+    return FastKMeans(mean, scale, centroids), json.loads(str(arrays['metadata']))
+
+
+def sample_probe_points(fast, n_samples=5000, seed=0):
+    """Raw-space points scattered around every centroid, including near-ties between them."""
+    rng = np.random.default_rng(seed)
+    centers_raw = fast.centroids * fast.scale + fast.mean
+    picks = rng.integers(fast.n_clusters, size=(n_samples, 2))
+    weights = rng.random((n_samples, 1))
+    points = weights * centers_raw[picks[:, 0]] + (1 - weights) * centers_raw[picks[:, 1]]
+    return points + rng.normal(size=points.shape) * fast.scale * 0.25
+
+
+def verify_fast_kmeans(fast, scaler, kmeans, feature_names, n_samples=5000):
+    """Returns True when the fast path gives exactly the sklearn labels and scaled values."""
+    import pandas as pd
+
+    X = sample_probe_points(fast, n_samples)
+    X_df = pd.DataFrame(X, columns=feature_names)
+    scaled = scaler.transform(X_df)
+    expected = kmeans.predict(scaled)
+
+    if not np.array_equal(fast.transform(X), scaled):
+        return False
+    if not np.array_equal(fast.predict(X), expected):
+        return False
+    single = np.fromiter((fast.predict_one(row) for row in X), dtype=np.int64, count=len(X))
+    return bool(np.array_equal(single, expected))
@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class ForecastStore:
+    """Memory-mapped daily forecast published by the demand training job.
+
+    The artifact is a float64 .npy of shape (4, n_days) holding ds (days since
+    1970-01-01), yhat, yhat_lower and yhat_upper for consecutive days, so any
+    (start, days) window is a single slice.
+    """
+
+    def __init__(self, path):
+        self.data = np.load(path, mmap_mode='r')
+        if self.data.ndim != 2 or self.data.shape[0] != 4:
+            raise ValueError(f"Unexpected forecast artifact shape: {self.data.shape}")
+        self.n_days = self.data.shape[1]
+        self.first_day = int(self.data[0, 0])
+        self.last_day = self.first_day + self.n_days - 1
+        if int(self.data[0, -1]) != self.last_day:
+            raise ValueError("Forecast artifact is not a contiguous daily range")
+
+    def window(self, start_day, days):
+        """Returns (offset, values) for the part of [start_day, start_day + days) that is materialized.
+
+        ``values`` has shape (3, covered_days) with yhat, yhat_lower, yhat_upper and
+        ``offset`` is the position of its first column inside the requested window.
+        """
+        lo = max(start_day, self.first_day)
+        hi = min(start_day + days, self.last_day + 1)
+        if lo >= hi:
+            return 0, np.empty((3, 0))
+        return lo - start_day, self.data[1:, lo - self.first_day:hi - self.first_day]
+
+
+def load_forecast_store(path):
+    try:
+        store = ForecastStore(path)
+    except Exception as e:
+        print(f"Forecast artifact not available, using live Prophet only: {e}")
+        return None
+    print(f"Loaded forecast artifact: {store.n_days} days")
+    return store
@@ -0,0 +1,128 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import pandas as pd
+
+from fast_prophet import predict_fast
+
+
+class MicroBatcher:
+    """Groups concurrent single-row requests and scores them in one vectorized call.
+
+    A batch is flushed when it reaches max_batch_size rows or max_wait seconds
+    after its first row arrived, whichever comes first. When the previous batch
+    held a single row (low load) the batch is flushed on the next event-loop
+    iteration instead, so idle traffic does not pay the wait. Rows are grouped by
+    ``key`` (the ModelSet a request started with), so a hot reload never mixes
+    models inside one batch. Batching runs on the event loop; ``score_fn(key, rows)``
+    runs in the loop's default executor so a slow batch never blocks other requests.
+    A batch of one is scored inline with ``score_one(key, row)`` when given, which
+    must be cheap enough for the event loop (a few microseconds, no I/O).
+    """
+
+    def __init__(self, score_fn, max_batch_size=64, max_wait=0.002, score_one=None):
+        self.score_fn = score_fn
+        self.score_one = score_one
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._last_batch_size = 0
+        self._scoring = set()
+        self.batches = 0
+        self.rows = 0
+
+    async def submit(self, key, row):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, row, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            delay = self.max_wait if self._last_batch_size > 1 else 0
+            self._timer = loop.call_later(delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        self._last_batch_size = len(pending)
+
+        groups = {}
+        for key, row, future in pending:
+            groups.setdefault(id(key), (key, []))[1].append((row, future))
+
+        loop = asyncio.get_running_loop()
+        for key, items in groups.values():
+            self.batches += 1
+            self.rows += len(items)
+            if len(items) == 1 and self.score_one is not None:
+                self._score_inline(key, *items[0])
+                continue
+            task = loop.create_task(self._score(key, items))
+            self._scoring.add(task)
+            task.add_done_callback(self._scoring.discard)
+
+    def _score_inline(self, key, row, future):
+        try:
+            result = self.score_one(key, row)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def _score(self, key, items):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(None, self.score_fn, key, [row for row, _ in items])
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+
+_worker_model = {}
+
+
+def _load_prophet(path, version):
+    # The cached path is generation-specific (model_cache.fetch_blob), so a worker that
+    # sees a new (path, version) always reads the file of that generation.
+    if _worker_model.get("key") != (path, version):
+        _worker_model["model"] = joblib.load(path)
+        _worker_model["key"] = (path, version)
+    return _worker_model["model"]
+
+
+def init_prophet_worker(path, version):
+    if path is not None:
+        _load_prophet(path, version)
+
+
+def prophet_forecast(path, version, ds, mode, calibration):
+    """Runs in a pool worker; the model is loaded once per worker and version."""
+    model = _load_prophet(path, version)
+    if mode == "fast" and calibration is not None:
+        return predict_fast(model, ds, calibration)
+    forecast = model.predict(pd.DataFrame({'ds': ds}))
+    return forecast[['yhat', 'yhat_lower', 'yhat_upper']].to_numpy().T
+
+
+def make_prophet_pool(workers, path=None, version=None):
+    if workers <= 0:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_prophet_worker,
+        initargs=(path, version),
+    )
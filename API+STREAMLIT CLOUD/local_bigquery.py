@@ -0,0 +1,49 @@
+"""In-memory stand-in for google.cloud.bigquery.Client.
+
+Implements the calls the API makes (dataset/get_table/create_table/
+insert_rows_json) and keeps inserted rows in memory, so the service can run
+offline for benchmarks and local testing.
+"""
+import threading
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+
+class InMemoryBigQueryClient:
+    def __init__(self, project="local"):
+        self.project = project
+        self.tables = {}
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def _key(self, table):
+        if isinstance(table, str):
+            return table.split(".", 1)[-1] if table.count(".") == 2 else table
+        reference = getattr(table, "reference", table)
+        return f"{reference.dataset_id}.{reference.table_id}"
+
+    def get_table(self, table):
+        key = self._key(table)
+        if key not in self.tables:
+            raise NotFound(f"Table {key} not found")
+        return self.tables[key]
+
+    def create_table(self, table, exists_ok=False):
+        key = self._key(table)
+        with self._lock:
+            self.tables.setdefault(key, table)
+            self.rows.setdefault(key, [])
+        return table
+
+    def insert_rows_json(self, table, rows, **kwargs):
+        key = self._key(table)
+        with self._lock:
+            self.rows.setdefault(key, []).extend(rows)
+        return []
+
+    def row_count(self, table):
+        return len(self.rows.get(self._key(table), []))
@@ -0,0 +1,66 @@
+"""Local stand-in for google.cloud.storage.Client backed by a directory tree.
+
+Buckets are sub-directories of the root and blobs are files inside them.
+Generation is the file's mtime in nanoseconds, so replacing a file behaves
+like uploading a new object version. Only the calls the API makes are
+implemented.
+"""
+import os
+import shutil
+
+from model_cache import file_md5_base64
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+        self.generation = None
+        self.md5_hash = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        if not self.exists():
+            raise FileNotFoundError(f"gs://{self.bucket.name}/{self.name}")
+        self.generation = os.stat(self.path).st_mtime_ns
+        self.md5_hash = file_md5_base64(self.path)
+
+    def download_as_bytes(self, **kwargs):
+        with open(self.path, "rb") as file:
+            return file.read()
+
+    def download_to_filename(self, filename, if_generation_match=None, **kwargs):
+        if if_generation_match is not None and os.stat(self.path).st_mtime_ns != int(if_generation_match):
+            raise RuntimeError(f"Precondition failed for gs://{self.bucket.name}/{self.name}")
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_filename(self, filename, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+
+class LocalBucket:
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+
+class LocalStorageClient:
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, name):
+        return LocalBucket(self.root, name)
@@ -1,22 +1,59 @@
+import asyncio
+import logging
 import pickle
 import pandas as pd
 import numpy as np
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 from google.cloud import bigquery, storage
 import joblib
 import yaml
 import io
-
-app = FastAPI()
-
+import json
+import time
+from bq_sink import MicroBatchWriter, RowFormatter, make_sink
+from fast_kmeans import FastKMeans, load_bundle, verify_fast_kmeans
+from fast_prophet import load_interval_calibration, predict_fast
+from forecast_store import load_forecast_store
+from inference import MicroBatcher, make_prophet_pool, prophet_forecast
+from local_bigquery import InMemoryBigQueryClient
+from local_gcs import LocalStorageClient
+from satisfaction_model import load_satisfaction_model
+from metrics import RequestTimingMiddleware, SampledLogger, StageHistogram, render_gauge
+from model_cache import BlobWatcher, fetch_blobs
 
 bucket_name = "bucket_for_model_tfm"
+cluster_bundle_filename = "clusterizacion_clientes_bundle.npz"
 kmeans_model_filename = "clusterizacion_clientes_model.pkl"
 scaler_filename = "clusterizacion_clientes_modelscaler.pkl"
 prophet_model_filename = "prophet_model.pkl"
+forecast_artifact_filename = "prophet_forecast.npy"
+interval_calibration_filename = "prophet_intervals.json"
+satisfaction_model_filename = "satisfaccion_model.json"
+satisfaction_metadata_filename = "satisfaccion_model_metadata.json"
+model_filenames = [
+    cluster_bundle_filename,
+    kmeans_model_filename,
+    scaler_filename,
+    prophet_model_filename,
+    forecast_artifact_filename,
+    interval_calibration_filename,
+    satisfaction_model_filename,
+    satisfaction_metadata_filename,
+]
+model_cache_dir = os.getenv("MODEL_CACHE_DIR", "/tmp/model_cache")
+model_poll_seconds = float(os.getenv("MODEL_POLL_SECONDS", "60"))
+inference_max_batch = int(os.getenv("INFERENCE_MAX_BATCH", "64"))
+inference_max_wait_ms = float(os.getenv("INFERENCE_MAX_WAIT_MS", "2"))
+prophet_workers = int(os.getenv("PROPHET_WORKERS", str(os.cpu_count() or 1)))
+startup_retry_max_seconds = float(os.getenv("STARTUP_RETRY_MAX_SECONDS", "60"))
 
 project_id = "tfm-edem"
 dataset_id = "tabla_pred_clust"
@@ -24,27 +61,176 @@ cluster_table_id = "pred_clust"
 demand_table_id = "demand_predictions"
 
 
-bq_client = bigquery.Client()
-storage_client = storage.Client()
+logger = SampledLogger(logging.getLogger("prediction_api"), float(os.getenv("DEBUG_LOG_SAMPLE_RATE", "0.01")))
+stage_latency = StageHistogram(
+    "prediction_stage_latency_seconds",
+    "Latency of each stage of the prediction endpoints.",
+)
 
+bq_client = InMemoryBigQueryClient(project_id) if os.getenv("LOCAL_BIGQUERY") else bigquery.Client()
+local_gcs_root = os.getenv("LOCAL_GCS_ROOT")
+storage_client = LocalStorageClient(local_gcs_root) if local_gcs_root else storage.Client()
 
-def load_model_from_gcp(model_filename, is_joblib=False):
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(model_filename)
-    model_bytes = blob.download_as_bytes()
 
+def load_model_file(path, is_joblib=False):
     if is_joblib:
-        model = joblib.load(io.BytesIO(model_bytes))
+        model = joblib.load(path)
     else:
-        model = pickle.loads(model_bytes)
+        with open(path, 'rb') as file:
+            model = pickle.load(file)
     
     print(f"Loaded model type: {type(model)}")
     return model
 
 
-kmeans_model = load_model_from_gcp(kmeans_model_filename, is_joblib=False)
-scaler = load_model_from_gcp(scaler_filename, is_joblib=False)
-prophet_model = load_model_from_gcp(prophet_model_filename, is_joblib=True)
+class ModelSet:
+    def __init__(self, blobs, previous=None):
+        # The pickles are only needed while the bucket has no cluster bundle yet.
+        bundle = blobs.get(cluster_bundle_filename)
+        required = [prophet_model_filename] if bundle else [kmeans_model_filename, scaler_filename, prophet_model_filename]
+        for name in required:
+            if blobs.get(name) is None:
+                raise RuntimeError(f"Required model {name} is missing from gs://{bucket_name}")
+
+        self.versions = {name: blob.generation for name, blob in blobs.items() if blob is not None}
+        if bundle is not None:
+            # A bundle that does not match cluster_features raises here and is never served.
+            start = time.perf_counter()
+            self.fast_kmeans, self.cluster_metadata = load_bundle(bundle.path, cluster_features)
+            print(f"Loaded cluster bundle in {(time.perf_counter() - start) * 1000:.1f} ms: {self.cluster_metadata}")
+            self.kmeans_model = self.scaler = None
+            self.fast_kmeans_enabled = True
+            self.cluster_version = self.versions[cluster_bundle_filename]
+        else:
+            self.kmeans_model = load_model_file(blobs[kmeans_model_filename].path, is_joblib=False)
+            self.scaler = load_model_file(blobs[scaler_filename].path, is_joblib=False)
+            self.cluster_metadata = None
+            self.cluster_version = f"{self.versions[kmeans_model_filename]}-{self.versions[scaler_filename]}"
+            self.fast_kmeans = FastKMeans.from_sklearn(self.scaler, self.kmeans_model)
+            self.fast_kmeans_enabled = verify_fast_kmeans(self.fast_kmeans, self.scaler, self.kmeans_model, cluster_features)
+            print(f"Fast KMeans path {'enabled' if self.fast_kmeans_enabled else 'disabled: results differ from sklearn'}")
+
+        self.prophet_path = blobs[prophet_model_filename].path
+        self.prophet_model = load_model_file(self.prophet_path, is_joblib=True)
+
+        artifact = blobs.get(forecast_artifact_filename)
+        self.forecast_store = load_forecast_store(artifact.path) if artifact else None
+        calibration = blobs.get(interval_calibration_filename)
+        self.interval_calibration = load_interval_calibration(calibration.path if calibration else None)
+
+        self.demand_version = "-".join(
+            self.versions.get(name, "none")
+            for name in (prophet_model_filename, forecast_artifact_filename, interval_calibration_filename)
+        )
+
+        # Optional: /satisfaction_predict answers 503 until the training job has published a model.
+        # A pair that fails to load (e.g. mid-publish) never takes the other models down with it;
+        # a reload keeps serving the previous satisfaction model instead.
+        self.satisfaction_model = self.satisfaction_version = None
+        satisfaction_model = blobs.get(satisfaction_model_filename)
+        satisfaction_metadata = blobs.get(satisfaction_metadata_filename)
+        if satisfaction_model is not None and satisfaction_metadata is not None:
+            try:
+                self.satisfaction_model = load_satisfaction_model(satisfaction_model.path, satisfaction_metadata.path)
+                self.satisfaction_version = f"{self.versions[satisfaction_model_filename]}-{self.versions[satisfaction_metadata_filename]}"
+            except Exception as e:
+                if previous is not None:
+                    self.satisfaction_model, self.satisfaction_version = previous.satisfaction_model, previous.satisfaction_version
+                print(f"Satisfaction model not loaded, serving version {self.satisfaction_version}: {e}")
+        self.loaded_at = datetime.utcnow().isoformat()
+
+
+def load_models(previous=None):
+    blobs = fetch_blobs(storage_client.bucket(bucket_name), model_filenames, model_cache_dir)
+    return ModelSet(blobs, previous)
+
+
+models = None
+startup_error = None
+model_reloads = 0
+prophet_pool = None
+startup_stop = threading.Event()
+
+
+def reload_models(changed):
+    # In-flight requests keep the ModelSet they started with; new ones see the swap.
+    global models, model_reloads
+    new_models = load_models(models)
+    models = new_models
+    model_reloads += 1
+    print(f"Models reloaded: cluster {new_models.cluster_version}, demand {new_models.demand_version}")
+
+
+model_watcher = BlobWatcher(
+    storage_client.bucket(bucket_name),
+    model_filenames,
+    lambda: models.versions,
+    reload_models,
+    model_poll_seconds,
+)
+
+
+def startup():
+    # A transient GCS/BigQuery error must not leave the service at 503 for good: keep
+    # retrying with exponential backoff (capped) until it loads or the app shuts down.
+    global models, startup_error, prophet_pool
+    delay = 1.0
+    attempt = 1
+    while True:
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                tables = [
+                    pool.submit(create_bq_table_if_not_exists, cluster_table_id, cluster_schema),
+                    pool.submit(create_bq_table_if_not_exists, demand_table_id, demand_schema),
+                ]
+                loaded = load_models()
+                for table in tables:
+                    table.result()
+            prophet_pool = make_prophet_pool(prophet_workers, loaded.prophet_path, loaded.versions[prophet_model_filename])
+            models = loaded
+            startup_error = None
+            model_watcher.start()
+            print("Service ready.")
+            return
+        except Exception as e:
+            startup_error = f"Startup failed (attempt {attempt}), retrying in {delay:.0f} s: {e}"
+            print(startup_error)
+        if startup_stop.wait(delay):
+            return
+        delay = min(delay * 2, startup_retry_max_seconds)
+        attempt += 1
+
+
+def get_models():
+    if models is None:
+        raise HTTPException(status_code=503, detail=startup_error or "Models are still loading")
+    return models
+
+
+@asynccontextmanager
+async def lifespan(app):
+    prediction_writer.start()
+    app.state.startup = asyncio.get_running_loop().run_in_executor(None, startup)
+    yield
+    startup_stop.set()
+    model_watcher.stop()
+    if prophet_pool is not None:
+        prophet_pool.shutdown(cancel_futures=True)
+    prediction_writer.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    RequestTimingMiddleware,
+    histogram=stage_latency,
+    endpoints=["/predict", "/predict_batch", "/demand_predict", "/satisfaction_predict"],
+)
+
+
+def observe_parse(endpoint, request):
+    request_start = getattr(request.state, "request_start", None)
+    if request_start is not None:
+        stage_latency.observe(endpoint, "parse", time.perf_counter() - request_start)
 
 
 def load_schema_from_yaml(yaml_file):
@@ -71,8 +257,6 @@ cluster_schema_file = "cluster_schema.yaml"
 demand_schema_file = "demand_schema.yaml"
 cluster_schema = load_schema_from_yaml(cluster_schema_file)
 demand_schema = load_schema_from_yaml(demand_schema_file)
-create_bq_table_if_not_exists(cluster_table_id, cluster_schema)
-create_bq_table_if_not_exists(demand_table_id, demand_schema)
 
 
 class ClusterInputData(BaseModel):
@@ -83,98 +267,288 @@ class ClusterInputData(BaseModel):
     avg_review_score: float
     days_since_last_purchase: float
 
+cluster_features = list(ClusterInputData.__fields__)
+
 class DemandInputData(BaseModel):
     days: int
     start_date: str = Field(default=None, description="Дата начала предсказания в формате 'YYYY-MM-DD'")
+    mode: str = Field(default=None, description="'full' (Prophet con muestreo) o 'fast' (sin muestreo, intervalos calibrados)")
 
 
-def save_to_bigquery(data, prediction_result, table_id, schema_file):
-    schema = load_schema_from_yaml(schema_file)
+prediction_sink = os.getenv("PREDICTION_SINK", "bigquery")
+prediction_sink_path = os.getenv("PREDICTION_SINK_PATH")
+cluster_row_formatter = RowFormatter(cluster_schema_file)
+demand_row_formatter = RowFormatter(demand_schema_file)
 
-    formatted_data = {field.name: data.get(field.name, None) for field in schema}
+prediction_writer = MicroBatchWriter(
+    make_sink(prediction_sink, prediction_sink_path, bq_client, project_id, dataset_id),
+    max_queue=int(os.getenv("PREDICTION_QUEUE_SIZE", "10000")),
+    batch_size=int(os.getenv("PREDICTION_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("PREDICTION_FLUSH_SECONDS", "1.0")),
+)
+batch_submit_timeout = float(os.getenv("PREDICTION_BATCH_SUBMIT_TIMEOUT", "5.0"))
+demand_predict_mode = os.getenv("DEMAND_PREDICT_MODE", "full")
 
-    if 'prediction_result' in formatted_data:
-        formatted_data['prediction_result'] = prediction_result
 
-    formatted_data["timestamp"] = datetime.utcnow().isoformat()
+def save_to_bigquery(data, prediction_result, table_id, row_formatter):
+    row = row_formatter(data, prediction_result=prediction_result)
+    prediction_writer.submit(table_id, [row])
 
-    if 'ds' in formatted_data:
-        try:
-            formatted_data['ds'] = datetime.strptime(formatted_data['ds'], '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d')
-        except ValueError:
-            print(f"Error formatting date: {formatted_data['ds']}")
-            formatted_data['ds'] = None
 
-    rows_to_insert = [formatted_data]
-    errors = bq_client.insert_rows_json(f"{project_id}.{dataset_id}.{table_id}", rows_to_insert)
-    if errors:
-        print(f"Failed to insert rows into BigQuery: {errors}")
+def save_batch_to_bigquery(rows_df, predictions, table_id, row_formatter):
+    rows_to_insert = row_formatter.format_frame(rows_df, prediction_result=predictions.astype(str))
+    prediction_writer.submit(table_id, rows_to_insert, timeout=batch_submit_timeout)
 
 
-@app.post("/predict")
-def predict(data: ClusterInputData):
+def read_batch_frame(body, content_type):
+    if content_type.startswith("text/csv"):
+        df = pd.read_csv(io.BytesIO(body))
+    elif content_type in ("application/parquet", "application/x-parquet", "application/octet-stream"):
+        df = pd.read_parquet(io.BytesIO(body))
+    else:
+        payload = json.loads(body)
+        if isinstance(payload, dict) and "rows" in payload:
+            payload = payload["rows"]
+        df = pd.DataFrame(payload)
+    if len(df) == 0:
+        raise ValueError("Empty batch: no rows to score")
+    return df
+
+
+def score_cluster_matrix(current, X, endpoint):
+    if current.fast_kmeans_enabled:
+        with stage_latency.time(endpoint, "scale"):
+            scaled = current.fast_kmeans.transform(X)
+        with stage_latency.time(endpoint, "predict"):
+            return current.fast_kmeans.assign(scaled)
+    with stage_latency.time(endpoint, "scale"):
+        scaled = current.scaler.transform(pd.DataFrame(X, columns=cluster_features))
+    with stage_latency.time(endpoint, "predict"):
+        return current.kmeans_model.predict(scaled)
+
+
+def score_clusters(current, input_df, endpoint):
+    missing = [col for col in cluster_features if col not in input_df.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {missing}")
+
+    features = input_df[cluster_features].astype('float64')
+    if features.isna().any().any():
+        raise ValueError("Input contains null or non-numeric values")
+
+    return score_cluster_matrix(current, features.to_numpy(), endpoint)
+
+
+def score_cluster_row(current, row):
+    # A lone /predict row is scored on the event loop with the preallocated single-row path.
+    if current.fast_kmeans_enabled:
+        with stage_latency.time("/predict", "predict"):
+            return current.fast_kmeans.predict_one(row)
+    return score_cluster_matrix(current, np.array([row], dtype=np.float64), "/predict").tolist()[0]
+
+
+cluster_batcher = MicroBatcher(
+    lambda current, rows: score_cluster_matrix(current, np.array(rows, dtype=np.float64), "/predict").tolist(),
+    max_batch_size=inference_max_batch,
+    max_wait=inference_max_wait_ms / 1000,
+    score_one=score_cluster_row,
+)
+
+
+@app.post("/predict_batch")
+async def predict_batch(request: Request):
+    endpoint = "/predict_batch"
+    current = get_models()
     try:
-        
-        input_df = pd.DataFrame([data.dict()])
-        scaled_input_df = scaler.transform(input_df)
-        prediction = kmeans_model.predict(scaled_input_df)[0]
+        with stage_latency.time(endpoint, "parse"):
+            body = await request.body()
+            content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+            input_df = await run_in_threadpool(read_batch_frame, body, content_type)
+        predictions = await run_in_threadpool(score_clusters, current, input_df, endpoint)
+
+        with stage_latency.time(endpoint, "bq_write"):
+            await run_in_threadpool(save_batch_to_bigquery, input_df, predictions, cluster_table_id, cluster_row_formatter)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        if isinstance(prediction, (np.integer, np.int32, np.int64)):
-            prediction = int(prediction)
-        elif isinstance(prediction, (np.floating, np.float32, np.float64)):
-            prediction = float(prediction)
+    with stage_latency.time(endpoint, "serialize"):
+        return JSONResponse({
+            "count": int(len(predictions)),
+            "predictions": predictions.tolist(),
+            "model_version": current.cluster_version,
+        })
 
-        
-        save_to_bigquery(data.dict(), str(prediction), cluster_table_id, cluster_schema_file)
 
-        return {"prediction": prediction}
+@app.post("/predict")
+async def predict(data: ClusterInputData, request: Request):
+    endpoint = "/predict"
+    current = get_models()
+    observe_parse(endpoint, request)
+    try:
+        with stage_latency.time(endpoint, "batch_wait"):
+            prediction = await cluster_batcher.submit(current, [getattr(data, col) for col in cluster_features])
+
+        with stage_latency.time(endpoint, "bq_write"):
+            save_to_bigquery(data.dict(), str(prediction), cluster_table_id, cluster_row_formatter)
+
+        with stage_latency.time(endpoint, "serialize"):
+            return JSONResponse({"prediction": prediction, "model_version": current.cluster_version})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+def predict_demand_live(current, ds, mode):
+    if mode == "fast" and current.interval_calibration is not None:
+        return predict_fast(current.prophet_model, ds, current.interval_calibration)
+    forecast = current.prophet_model.predict(pd.DataFrame({'ds': ds}))
+    return forecast[['yhat', 'yhat_lower', 'yhat_upper']].to_numpy().T
+
+
+async def forecast_demand(current, start, n_days, mode):
+    ds = pd.date_range(start=start, periods=n_days, freq='D')
+    values = np.empty((3, n_days))
+
+    covered_from = covered_to = 0
+    if current.forecast_store is not None:
+        start_day = (start - pd.Timestamp('1970-01-01')).days
+        covered_from, window = current.forecast_store.window(start_day, n_days)
+        covered_to = covered_from + window.shape[1]
+        values[:, covered_from:covered_to] = window
+
+    live = np.r_[0:covered_from, covered_to:n_days]
+    if len(live):
+        logger.debug("Live Prophet prediction for %s of %s days: %s - %s", len(live), n_days, ds[live].min(), ds[live].max())
+        if prophet_pool is not None:
+            values[:, live] = await asyncio.get_running_loop().run_in_executor(
+                prophet_pool,
+                prophet_forecast,
+                current.prophet_path,
+                current.versions[prophet_model_filename],
+                ds[live],
+                mode,
+                current.interval_calibration,
+            )
+        else:
+            values[:, live] = await run_in_threadpool(predict_demand_live, current, ds[live], mode)
+
+    return ds, values
+
+
 @app.post("/demand_predict")
-def demand_predict(data: DemandInputData):
+async def demand_predict(data: DemandInputData, request: Request):
+    endpoint = "/demand_predict"
+    current = get_models()
+    observe_parse(endpoint, request)
     try:
         n_days = data.days
 
         
         if data.start_date:
-            current_date = datetime.strptime(data.start_date, "%Y-%m-%d")
+            current_date = pd.Timestamp(datetime.strptime(data.start_date, "%Y-%m-%d"))
         else:
-            current_date = datetime.utcnow()
+            current_date = pd.Timestamp(datetime.utcnow()).normalize()
 
-        
-        future = prophet_model.make_future_dataframe(periods=n_days, freq='D', include_history=False)
-        future['ds'] = pd.date_range(start=current_date, periods=n_days, freq='D')
+        mode = data.mode or demand_predict_mode
+        if mode not in ("full", "fast"):
+            raise ValueError(f"Unknown mode: {mode}")
 
-        print(f"Future DataFrame before prediction: {future.head()}")
-        print(f"Future DataFrame date range: {future['ds'].min()} - {future['ds'].max()}")
+        with stage_latency.time(endpoint, "predict"):
+            ds, values = await forecast_demand(current, current_date, n_days, mode)
 
-        
-        forecast = prophet_model.predict(future)
+        with stage_latency.time(endpoint, "serialize"):
+            results = [
+                {"ds": day, "yhat": yhat, "yhat_lower": yhat_lower, "yhat_upper": yhat_upper}
+                for day, yhat, yhat_lower, yhat_upper in zip(ds.strftime('%Y-%m-%d %H:%M:%S'), *values.tolist())
+            ]
+            response = JSONResponse({"forecast": results, "model_version": current.demand_version})
 
-        
-        results = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(n_days).to_dict(orient='records')
+        with stage_latency.time(endpoint, "bq_write"):
+            prediction_writer.submit(demand_table_id, [demand_row_formatter(result) for result in results])
 
-        
-        for result in results:
-            result['ds'] = result['ds'].strftime('%Y-%m-%d %H:%M:%S')
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        
-        for result in results:
-            result_data = {
-                "ds": result['ds'],
-                "yhat": result['yhat'],
-                "yhat_lower": result['yhat_lower'],
-                "yhat_upper": result['yhat_upper'],
-                "timestamp": datetime.utcnow().isoformat()
-            }
-            save_to_bigquery(result_data, None, demand_table_id, demand_schema_file)
-
-        return {"forecast": results}
+
+def score_satisfaction(current, input_df, endpoint):
+    with stage_latency.time(endpoint, "predict"):
+        return current.satisfaction_model.predict(input_df)
+
+
+@app.post("/satisfaction_predict")
+async def satisfaction_predict(request: Request):
+    endpoint = "/satisfaction_predict"
+    current = get_models()
+    if current.satisfaction_model is None:
+        raise HTTPException(status_code=503, detail="Satisfaction model is not published yet")
+    try:
+        with stage_latency.time(endpoint, "parse"):
+            body = await request.body()
+            content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+            input_df = await run_in_threadpool(read_batch_frame, body, content_type)
+        predictions = await run_in_threadpool(score_satisfaction, current, input_df, endpoint)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+    with stage_latency.time(endpoint, "serialize"):
+        return JSONResponse({
+            "count": int(len(predictions)),
+            "predictions": predictions.tolist(),
+            "model_version": current.satisfaction_version,
+        })
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+def ready():
+    current = get_models()
+    return {
+        "status": "ready",
+        "cluster_model_version": current.cluster_version,
+        "cluster_model_metadata": current.cluster_metadata,
+        "demand_model_version": current.demand_version,
+        "satisfaction_model_version": current.satisfaction_version,
+        "model_versions": current.versions,
+        "loaded_at": current.loaded_at,
+        "model_reloads": model_reloads,
+    }
+
+
+@app.get("/sink_stats")
+def sink_stats():
+    return prediction_writer.stats()
+
+
+@app.get("/metrics")
+def metrics():
+    lines = stage_latency.render()
+
+    sink = prediction_writer.stats()
+    lines += render_gauge("prediction_sink_queue_depth", "Row batches waiting in the prediction sink queue.", [({}, sink["queue_depth"])])
+    lines += render_gauge("prediction_sink_queue_capacity", "Capacity of the prediction sink queue.", [({}, sink["queue_capacity"])])
+    for counter in ("rows_enqueued", "rows_written", "rows_dropped", "rows_failed", "backpressure_waits", "flushes"):
+        lines += render_gauge(f"prediction_sink_{counter}_total", f"Prediction sink {counter.replace('_', ' ')}.", [({}, sink[counter])], "counter")
+
+    current = models
+    lines += render_gauge("inference_batches_total", "Micro-batches scored for /predict.", [({}, cluster_batcher.batches)], "counter")
+    lines += render_gauge("inference_batched_rows_total", "Rows scored through micro-batches.", [({}, cluster_batcher.rows)], "counter")
+    lines += render_gauge("model_ready", "1 once models are loaded.", [({}, int(current is not None))])
+    lines += render_gauge("model_reloads_total", "Hot reloads since startup.", [({}, model_reloads)], "counter")
+    if current is not None:
+        lines += render_gauge("model_info", "Active model versions.", [
+            ({"model": "cluster", "version": current.cluster_version}, 1),
+            ({"model": "demand", "version": current.demand_version}, 1),
+            ({"model": "satisfaction", "version": current.satisfaction_version or "none"}, 1),
+        ])
+        lines += render_gauge("fast_kmeans_enabled", "1 when the NumPy KMeans path is active.", [({}, int(current.fast_kmeans_enabled))])
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
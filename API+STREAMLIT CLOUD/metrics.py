@@ -0,0 +1,98 @@
+import bisect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+latency_buckets = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class StageHistogram:
+    """Prometheus-style latency histogram labelled by endpoint and stage."""
+
+    def __init__(self, name, help_text, buckets=latency_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, stage, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        key = (endpoint, stage)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    @contextmanager
+    def time(self, endpoint, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(endpoint, stage, time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for (endpoint, stage), (counts, total, count) in sorted(snapshot.items()):
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+def render_gauge(name, help_text, samples, metric_type="gauge"):
+    """samples: list of (labels dict, value)."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+
+class RequestTimingMiddleware:
+    """Pure ASGI middleware: stamps the request start and records total latency per endpoint."""
+
+    def __init__(self, app, histogram, endpoints):
+        self.app = app
+        self.histogram = histogram
+        self.endpoints = set(endpoints)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.endpoints:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        scope.setdefault("state", {})["request_start"] = start
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.histogram.observe(scope["path"], "total", time.perf_counter() - start)
+
+
+class SampledLogger:
+    """Debug logging for hot paths: only a fraction of calls are formatted and emitted."""
+
+    def __init__(self, logger, sample_rate):
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    def debug(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG) and random.random() < self.sample_rate:
+            self.logger.debug(msg, *args)
@@ -0,0 +1,135 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+CachedBlob = namedtuple("CachedBlob", ["name", "path", "generation", "md5_hash", "downloaded"])
+
+
+def file_md5_base64(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _prune_generations(cache_dir, blob_name, keep):
+    """Removes cached copies of blob_name whose generation is not in keep."""
+    directory = os.path.join(cache_dir, os.path.dirname(blob_name))
+    prefix = os.path.basename(blob_name) + "."
+    for entry in os.listdir(directory):
+        generation = entry[len(prefix):]
+        if entry.startswith(prefix) and generation.isdigit() and generation not in keep:
+            try:
+                os.remove(os.path.join(directory, entry))
+            except OSError:
+                pass
+
+
+def fetch_blob(bucket, blob_name, cache_dir):
+    """Makes gs://bucket/blob_name available under cache_dir, downloading only when it changed.
+
+    Each generation is stored as <blob_name>.<generation>, so a new generation never
+    overwrites a file that a worker process may still be loading. A cached copy is
+    reused when its recorded generation and MD5 match the blob metadata and the file
+    on disk still hashes to that MD5; after a download only the new and the previous
+    generation are kept. Returns None when the blob does not exist.
+    """
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        print(f"Blob gs://{bucket.name}/{blob_name} not found.")
+        return None
+
+    generation = str(blob.generation)
+    local_path = os.path.join(cache_dir, f"{blob_name}.{generation}")
+    meta_path = os.path.join(cache_dir, blob_name + ".meta.json")
+
+    meta = _read_meta(meta_path)
+    if (
+        meta is not None
+        and meta.get("generation") == generation
+        and meta.get("md5_hash") == blob.md5_hash
+        and os.path.exists(local_path)
+        and (blob.md5_hash is None or file_md5_base64(local_path) == blob.md5_hash)
+    ):
+        print(f"Using cached {blob_name} (generation {generation}).")
+        return CachedBlob(blob_name, local_path, generation, blob.md5_hash, False)
+
+    os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+    partial_path = local_path + ".part"
+    blob.download_to_filename(partial_path, if_generation_match=blob.generation)
+    if blob.md5_hash and file_md5_base64(partial_path) != blob.md5_hash:
+        os.remove(partial_path)
+        raise IOError(f"Checksum mismatch downloading {blob_name}")
+    os.replace(partial_path, local_path)
+    with open(meta_path, "w") as file:
+        json.dump({"generation": generation, "md5_hash": blob.md5_hash}, file)
+    _prune_generations(cache_dir, blob_name, {generation, meta.get("generation") if meta else None})
+
+    print(f"Downloaded {blob_name} (generation {generation}).")
+    return CachedBlob(blob_name, local_path, generation, blob.md5_hash, True)
+
+
+def fetch_blobs(bucket, blob_names, cache_dir, max_workers=8):
+    """Fetches several blobs concurrently; returns {name: CachedBlob or None}."""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(lambda name: fetch_blob(bucket, name, cache_dir), blob_names)
+        return dict(zip(blob_names, results))
+
+
+class BlobWatcher:
+    """Background thread that polls blob generations and calls on_change when any differ.
+
+    ``get_versions`` returns the {name: generation} currently in use; a blob that
+    appears, disappears or gets a new generation triggers ``on_change(changed)``.
+    Errors are logged and retried on the next poll.
+    """
+
+    def __init__(self, bucket, blob_names, get_versions, on_change, interval):
+        self.bucket = bucket
+        self.blob_names = blob_names
+        self.get_versions = get_versions
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="model-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def changed_blobs(self):
+        current = self.get_versions()
+        changed = []
+        for name in self.blob_names:
+            blob = self.bucket.get_blob(name)
+            generation = None if blob is None else str(blob.generation)
+            if generation != current.get(name):
+                changed.append(name)
+        return changed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                changed = self.changed_blobs()
+                if changed:
+                    print(f"New model generations detected: {changed}")
+                    self.on_change(changed)
+            except Exception as e:
+                print(f"Model reload failed, keeping current models: {e}")
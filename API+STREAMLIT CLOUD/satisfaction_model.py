@@ -0,0 +1,73 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+# Satisfaction model written by ML/satisfaction_job.py: an XGBoost booster saved as JSON plus
+# a metadata JSON with the feature order, the category vocabularies and the model checksum.
+SATISFACTION_FORMAT_VERSION = 1
+METADATA_KEYS = ('format_version', 'model_sha256', 'numeric_features', 'categorical_features', 'best_iteration')
+
+
+class SatisfactionModel:
+    """Encodes order rows exactly like the training job and predicts the review score.
+
+    Numeric columns are cast to float32; categorical columns become their position in
+    the training vocabulary, with unknown values sent to XGBoost as missing (NaN).
+    """
+
+    def __init__(self, booster, metadata):
+        self.booster = booster
+        self.metadata = metadata
+        self.numeric_features = list(metadata['numeric_features'])
+        self.categories = {col: pd.Index(vocab) for col, vocab in metadata['categorical_features'].items()}
+        self.feature_names = self.numeric_features + list(self.categories)
+        self.iteration_range = (0, int(metadata['best_iteration']) + 1)
+
+    def encode(self, df):
+        missing = [col for col in self.feature_names if col not in df.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {missing}")
+
+        X = np.empty((len(df), len(self.feature_names)), dtype=np.float32)
+        numeric = df[self.numeric_features].apply(pd.to_numeric, errors='coerce')
+        X[:, :len(self.numeric_features)] = numeric.to_numpy(dtype=np.float32, na_value=np.nan)
+        for j, (col, vocab) in enumerate(self.categories.items(), start=len(self.numeric_features)):
+            codes = vocab.get_indexer(df[col].astype(str))
+            X[:, j] = np.where(codes >= 0, codes, np.nan)
+        return X
+
+    def predict(self, df):
+        # Scores are 1-5; a regressor can step slightly outside that range.
+        predictions = self.booster.inplace_predict(self.encode(df), iteration_range=self.iteration_range)
+        return np.clip(predictions, 1.0, 5.0)
+
+
+def load_satisfaction_model(model_path, metadata_path):
+    """Loads the booster and its metadata and checks that they belong together.
+
+    Raises ValueError for an unknown format version, a checksum that does not match
+    the booster file (e.g. halfway through a publish) or a booster whose features
+    differ from the metadata, so a mismatched pair is never served.
+    """
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    missing = [key for key in METADATA_KEYS if key not in metadata]
+    if missing:
+        raise ValueError(f"Satisfaction metadata is missing {missing}")
+    if metadata['format_version'] != SATISFACTION_FORMAT_VERSION:
+        raise ValueError(f"Unsupported satisfaction model format {metadata['format_version']}, "
+                         f"expected {SATISFACTION_FORMAT_VERSION}")
+
+    with open(model_path, 'rb') as f:
+        raw = f.read()
+    if hashlib.sha256(raw).hexdigest() != metadata['model_sha256']:
+        raise ValueError("Satisfaction model does not match its metadata checksum")
+
+    booster = xgb.Booster()
+    booster.load_model(bytearray(raw))
+    model = SatisfactionModel(booster, metadata)
+    if booster.feature_names != model.feature_names:
+        raise ValueError(f"Satisfaction model features {booster.feature_names} do not match {model.feature_names}")
+    return model
@@ -0,0 +1,362 @@
+"""Agregaciones de customer_features y de la demanda diaria, escritas una sola vez en SQL.
+
+Las fórmulas (cada pedido pesa P·I·max(R, 1) en customer_features y P·I en la demanda) están
+solo en CUSTOMER_FEATURES_SELECT y DAILY_DEMAND_SELECT, que leen una tabla por pedido. Sobre los
+archivos limpios se ejecutan en DuckDB (CSV/Parquet locales, multihilo y con volcado a disco) o
+directamente en BigQuery; sobre tablas por pedido ya agregadas, en SQLite: el estado incremental
+de feature_store.py y la tabla de hechos de ML/order_facts.py. La demanda por categoría y por país
+también se calcula aquí: CLOUD RUN 2 la recalcula en BigQuery antes de entrenar segments.py.
+ML/ y CLOUD RUN 2/ llevan una copia idéntica de este archivo.
+
+Uso (sin conexión, sobre una carpeta con orders.csv, customers.csv, ... o .parquet):
+    python aggregation.py --backend duckdb --data-dir ../../DATA/raw --query customer_features --output features.csv
+En producción, calculando en BigQuery y escribiendo el resultado sin descargarlo:
+    python aggregation.py --backend bigquery --query daily_demand --destination tfm-edem.tablas_ml.ml_demanda
+    python aggregation.py --backend bigquery --query demand_by_category --destination tfm-edem.tablas_ml.ml_demanda_category
+    python aggregation.py --backend bigquery --query demand_by_country --destination tfm-edem.tablas_ml.ml_demanda_country
+"""
+import argparse
+import glob
+import os
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Solo BigQueryBackend lo necesita; feature_store y ML/order_facts usan este módulo sin él
+try:
+    from google.cloud import bigquery
+except ImportError:
+    bigquery = None
+
+SOURCES = ('orders', 'customers', 'order_payments', 'order_items', 'reviews', 'products', 'geolocalizaciones')
+MIN_PURCHASE = pd.Timestamp('2010-01-01')
+
+# Lo único que cambia entre motores: conversiones, literales y aritmética de fechas.
+# En SQLite las fechas son segundos epoch (REAL), como las guardan feature_store y order_facts.
+DIALECTS = {
+    'duckdb': {
+        'float': "DOUBLE",
+        'number': "TRY_CAST({} AS DOUBLE)",
+        'text': "CAST({} AS VARCHAR)",
+        'datetime': "TRY_CAST({} AS TIMESTAMP)",
+        'literal': "TIMESTAMP '{}'",
+        'minus_years': "{} - INTERVAL {} YEAR",
+        'days_between': "FLOOR(date_diff('second', {}, {}) / 86400)",
+        'date': "CAST({} AS DATE)",
+    },
+    'bigquery': {
+        'float': "FLOAT64",
+        'number': "SAFE_CAST({} AS FLOAT64)",
+        'text': "CAST({} AS STRING)",
+        'datetime': "SAFE_CAST({} AS DATETIME)",
+        'literal': "DATETIME '{}'",
+        'minus_years': "DATETIME_SUB({}, INTERVAL {} YEAR)",
+        'days_between': "FLOOR(DATETIME_DIFF({1}, {0}, SECOND) / 86400)",
+        'date': "DATE({})",
+    },
+    'sqlite': {
+        'float': "REAL",
+        'number': "CAST({} AS REAL)",
+        'text': "CAST({} AS TEXT)",
+        'datetime': "CAST(strftime('%s', {}) AS REAL)",
+        'literal': "CAST(strftime('%s', '{}') AS REAL)",
+        'minus_years': "CAST(strftime('%s', {}, 'unixepoch', '-{} years') AS REAL)",
+        # La fecha de compra nunca es posterior a la de referencia: truncar es redondear hacia abajo
+        'days_between': "CAST(({1} - {0}) / 86400 AS INTEGER)",
+        'date': "date({}, 'unixepoch')",
+    },
+}
+
+# Fecha de compra con el año 2222 corregido a 2022, como en los notebooks
+PURCHASES_CTE = """purchases AS (
+    SELECT order_id, customer_id,
+           CASE WHEN EXTRACT(YEAR FROM ts) = 2222 THEN {ts_minus_200} ELSE ts END AS purchase_ts
+    FROM (SELECT order_id, customer_id, {purchase_ts} AS ts FROM {orders}) AS o
+)"""
+
+PAYMENTS_CTE = """payments AS (
+    SELECT order_id, COUNT(*) AS p, COALESCE(SUM({amount}), 0) AS amount
+    FROM {order_payments}
+    GROUP BY order_id
+)"""
+
+ITEMS_CTE = """items AS (
+    SELECT order_id, COUNT(*) AS i, COUNT({price}) AS ip, COALESCE(SUM({price}), 0) AS price_sum
+    FROM {order_items}
+    GROUP BY order_id
+)"""
+
+# La puntuación 's' es un 5 y las reseñas sin puntuación cuentan 0
+REVIEWS_CTE = """reviews AS (
+    SELECT order_id, COUNT(*) AS r, COALESCE(SUM({score}), 0) AS score_sum
+    FROM {reviews}
+    GROUP BY order_id
+)"""
+
+# Mismas filas que el merge del notebook de clusterización: cada pedido pesa P·I·max(R, 1).
+# per_order: una fila por pedido con customer_id, purchase_ts, p (pagos), amount, i (artículos),
+# ip (artículos con precio), price_sum, r (reseñas, al menos 1) y score_sum.
+CUSTOMER_FEATURES_SELECT = """
+SELECT customer_id,
+       CAST(SUM(amount * i * r) AS {float}) AS total_spent,
+       CAST(SUM(p * i * r) AS {float}) AS purchase_frequency,
+       CAST(SUM(price_sum * p * r) AS {float}) / NULLIF(SUM(ip * p * r), 0) AS average_order_value,
+       CAST(SUM(p * i * r) AS {float}) AS num_reviews,
+       CAST(SUM(score_sum * p * i) AS {float}) / SUM(p * i * r) AS avg_review_score,
+       CAST({days_since_purchase} AS {float}) AS days_since_purchase
+FROM per_order
+WHERE p > 0 AND i > 0 AND purchase_ts BETWEEN {min_ts} AND {reference_ts}
+GROUP BY customer_id
+"""
+
+CUSTOMER_FEATURES_SQL = "WITH " + ",\n".join([PURCHASES_CTE, PAYMENTS_CTE, ITEMS_CTE, REVIEWS_CTE]) + """,
+per_order AS (
+    SELECT o.customer_id, o.purchase_ts, pay.p, pay.amount, it.i, it.ip, it.price_sum,
+           GREATEST(COALESCE(rv.r, 0), 1) AS r, COALESCE(rv.score_sum, 0) AS score_sum
+    FROM (SELECT order_id, ANY_VALUE(customer_id) AS customer_id, MIN(purchase_ts) AS purchase_ts
+          FROM purchases GROUP BY order_id) AS o
+    JOIN (SELECT DISTINCT customer_id FROM {customers}) AS c ON c.customer_id = o.customer_id
+    JOIN payments AS pay ON pay.order_id = o.order_id
+    JOIN items AS it ON it.order_id = o.order_id
+    LEFT JOIN reviews AS rv ON rv.order_id = o.order_id
+)""" + CUSTOMER_FEATURES_SELECT
+
+# Serie del notebook de demanda: filas de orders ⋈ order_items ⋈ order_payments por día de compra.
+# demand_orders: una fila por fila de orders con purchase_ts, p (pagos) e i (artículos).
+DAILY_DEMAND_SELECT = """
+SELECT {date} AS ds, SUM(i * p) AS y
+FROM demand_orders
+WHERE p > 0 AND i > 0 AND purchase_ts BETWEEN {min_ts} AND {reference_ts}
+GROUP BY ds
+ORDER BY ds
+"""
+
+DAILY_DEMAND_SQL = "WITH " + ",\n".join([PURCHASES_CTE, PAYMENTS_CTE, ITEMS_CTE]) + """,
+demand_orders AS (
+    SELECT o.purchase_ts, pay.p, it.i
+    FROM purchases AS o
+    JOIN payments AS pay ON pay.order_id = o.order_id
+    JOIN items AS it ON it.order_id = o.order_id
+)""" + DAILY_DEMAND_SELECT
+
+# Demanda por segmento para los modelos de segments.py: la misma serie repartida por artículo
+# (cada artículo de un pedido aporta P filas, así que la suma de los segmentos es daily_demand)
+DEMAND_ITEMS_SQL = "WITH " + ",\n".join([PURCHASES_CTE, PAYMENTS_CTE]) + """,
+demand_items AS (
+    SELECT o.customer_id, it.product_id, o.purchase_ts, pay.p
+    FROM purchases AS o
+    JOIN {order_items} AS it ON it.order_id = o.order_id
+    JOIN payments AS pay ON pay.order_id = o.order_id
+    WHERE o.purchase_ts BETWEEN {min_ts} AND {reference_ts}
+)"""
+
+DEMAND_BY_CATEGORY_SQL = DEMAND_ITEMS_SQL + """
+SELECT COALESCE(pr.category_name, 'unknown') AS segment, {date} AS ds, SUM(r.p) AS y
+FROM demand_items AS r
+LEFT JOIN {products} AS pr ON pr.product_id = r.product_id
+GROUP BY segment, ds
+ORDER BY segment, ds
+"""
+
+DEMAND_BY_COUNTRY_SQL = DEMAND_ITEMS_SQL + """
+SELECT COALESCE(g.country, 'unknown') AS segment, {date} AS ds, SUM(r.p) AS y
+FROM demand_items AS r
+LEFT JOIN {customers} AS c ON c.customer_id = r.customer_id
+LEFT JOIN (
+    SELECT ZIPCODE, ANY_VALUE(CLIENTE_ISO_CODE) AS country
+    FROM {geolocalizaciones}
+    GROUP BY ZIPCODE
+) AS g ON g.ZIPCODE = c.postal_code
+GROUP BY segment, ds
+ORDER BY segment, ds
+"""
+
+QUERIES = {
+    'customer_features': CUSTOMER_FEATURES_SQL,
+    'daily_demand': DAILY_DEMAND_SQL,
+    'demand_by_category': DEMAND_BY_CATEGORY_SQL,
+    'demand_by_country': DEMAND_BY_COUNTRY_SQL,
+}
+
+
+def _reference(reference_date):
+    return pd.Timestamp(reference_date) if reference_date is not None else pd.Timestamp.now().floor('s')
+
+
+def render(query, dialect, relations, reference_date=None):
+    """Sustituye en la consulta de QUERIES las tablas (relations) y las expresiones del dialecto."""
+    return render_sql(QUERIES[query], dialect, relations, reference_date)
+
+
+def render_sql(sql, dialect, relations, reference_date=None):
+    """Como render para cualquier SQL escrito con los mismos marcadores (p. ej. CUSTOMER_FEATURES_SELECT)."""
+    d = DIALECTS[dialect]
+    number, text = d['number'].format, d['text'].format
+    literal = lambda ts: d['literal'].format(ts.strftime('%Y-%m-%d %H:%M:%S'))
+    reference_ts = literal(_reference(reference_date))
+    return sql.format(
+        float=d['float'],
+        purchase_ts=d['datetime'].format('purchase_timestamp'),
+        ts_minus_200=d['minus_years'].format('ts', 200),
+        amount=number('amount'),
+        price=number('price'),
+        score=f"CASE WHEN {text('score')} = 's' THEN 5 ELSE {number('score')} END",
+        min_ts=literal(MIN_PURCHASE),
+        reference_ts=reference_ts,
+        days_since_purchase=d['days_between'].format('MAX(purchase_ts)', reference_ts),
+        date=d['date'].format('purchase_ts'),
+        **relations,
+    )
+
+
+class DuckDBBackend:
+    """Ejecuta las consultas en DuckDB sobre archivos locales o DataFrames.
+
+    sources: {'orders': 'ruta/orders*.csv', ...}; se aceptan CSV y Parquet (y patrones glob), o
+    DataFrames ya leídos, como los que descarga main.py en FULL_REFRESH.
+    Con memory_limit y temp_directory DuckDB vuelca a disco lo que no cabe en memoria.
+    """
+    dialect = 'duckdb'
+
+    def __init__(self, sources, threads=None, memory_limit=None, temp_directory=None):
+        if duckdb is None:
+            raise ImportError("DuckDBBackend requiere el paquete duckdb")
+        self.sources = sources
+        self.conn = duckdb.connect()
+        if threads:
+            self.conn.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            self.conn.execute(f"SET memory_limit = '{memory_limit}'")
+        if temp_directory:
+            self.conn.execute(f"SET temp_directory = '{temp_directory}'")
+
+    @classmethod
+    def from_directory(cls, data_dir, **kwargs):
+        """Busca {tabla}.parquet, {tabla}.csv o {tabla}_*.csv para cada tabla de SOURCES."""
+        sources = {}
+        for kind in SOURCES:
+            for pattern in (f"{kind}.parquet", f"{kind}.csv", f"{kind}_*.parquet", f"{kind}_*.csv"):
+                if glob.glob(os.path.join(data_dir, pattern)):
+                    sources[kind] = os.path.join(data_dir, pattern)
+                    break
+        return cls(sources, **kwargs)
+
+    def relation(self, kind):
+        if kind not in self.sources:
+            raise FileNotFoundError(f"No hay archivo para la tabla {kind}")
+        source = self.sources[kind]
+        if isinstance(source, pd.DataFrame):
+            # Las categorías de pandas llegan como ENUM y los joins con texto son más lentos
+            categories = [col for col in source.columns if isinstance(source[col].dtype, pd.CategoricalDtype)]
+            self.conn.register(f"frame_{kind}", source.astype({col: str for col in categories}))
+            return f"frame_{kind}"
+        path = source.replace("'", "''")
+        if path.endswith('.parquet'):
+            return f"read_parquet('{path}', union_by_name = true)"
+        # Todo como texto: las conversiones son las mismas que en pandas (errors='coerce')
+        return f"read_csv('{path}', header = true, all_varchar = true, union_by_name = true)"
+
+    def run(self, query, reference_date=None):
+        relations = {kind: self.relation(kind) for kind in SOURCES if f"{{{kind}}}" in QUERIES[query]}
+        return self.conn.execute(render(query, self.dialect, relations, reference_date)).df()
+
+    def customer_features(self, reference_date=None):
+        return self.run('customer_features', reference_date)
+
+    def daily_demand(self, reference_date=None):
+        return self.run('daily_demand', reference_date)
+
+    def demand_by_category(self, reference_date=None):
+        return self.run('demand_by_category', reference_date)
+
+    def demand_by_country(self, reference_date=None):
+        return self.run('demand_by_country', reference_date)
+
+
+class BigQueryBackend:
+    """Ejecuta las consultas en BigQuery sobre las tablas limpias de {project}.{dataset}.
+
+    Con destination el resultado se escribe en esa tabla (WRITE_TRUNCATE) sin descargarlo.
+    """
+    dialect = 'bigquery'
+
+    def __init__(self, client, dataset='tablas', project=None):
+        if bigquery is None:
+            raise ImportError("BigQueryBackend requiere el paquete google-cloud-bigquery")
+        self.client = client
+        self.dataset = dataset
+        self.project = project or client.project
+
+    def relation(self, kind):
+        return f"`{self.project}.{self.dataset}.{kind}`"
+
+    def run(self, query, reference_date=None, destination=None):
+        relations = {kind: self.relation(kind) for kind in SOURCES if f"{{{kind}}}" in QUERIES[query]}
+        sql = render(query, self.dialect, relations, reference_date)
+        if destination is None:
+            return self.client.query(sql).to_dataframe()
+        job_config = bigquery.QueryJobConfig(destination=destination, write_disposition="WRITE_TRUNCATE")
+        job = self.client.query(sql, job_config=job_config)
+        job.result()
+        print(f"{query}: {job.total_bytes_processed} bytes processed, written to {destination}.")
+        return None
+
+    def customer_features(self, reference_date=None, destination=None):
+        return self.run('customer_features', reference_date, destination)
+
+    def daily_demand(self, reference_date=None, destination=None):
+        return self.run('daily_demand', reference_date, destination)
+
+    def demand_by_category(self, reference_date=None, destination=None):
+        return self.run('demand_by_category', reference_date, destination)
+
+    def demand_by_country(self, reference_date=None, destination=None):
+        return self.run('demand_by_country', reference_date, destination)
+
+
+def purchase_dates(values):
+    """Fechas de compra con el año 2222 corregido a 2022, para las tablas que se agregan fuera de SQL."""
+    purchase = pd.to_datetime(values, errors='coerce')
+    return purchase.mask(purchase.dt.year == 2222, purchase - pd.DateOffset(years=200))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=['duckdb', 'bigquery'], default='duckdb')
+    parser.add_argument("--query", choices=sorted(QUERIES), default='customer_features')
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "DATA", "raw"))
+    parser.add_argument("--reference-date", default=os.getenv('REFERENCE_DATE'))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--memory-limit", default=None, help="p. ej. 2GB; DuckDB vuelca a disco lo que no quepa")
+    parser.add_argument("--temp-directory", default=None)
+    parser.add_argument("--dataset", default='tablas', help="dataset de BigQuery con las tablas limpias")
+    parser.add_argument("--destination", default=None, help="tabla de BigQuery donde escribir el resultado")
+    parser.add_argument("--output", default=None, help="CSV o Parquet de salida (duckdb)")
+    args = parser.parse_args()
+
+    if args.backend == 'bigquery':
+        backend = BigQueryBackend(bigquery.Client(), args.dataset)
+        result = backend.run(args.query, args.reference_date, args.destination)
+    else:
+        backend = DuckDBBackend.from_directory(args.data_dir, threads=args.threads,
+                                               memory_limit=args.memory_limit,
+                                               temp_directory=args.temp_directory)
+        result = backend.run(args.query, args.reference_date)
+
+    if result is None:
+        return
+    if args.output and args.output.endswith('.parquet'):
+        result.to_parquet(args.output, index=False)
+    elif args.output:
+        result.to_csv(args.output, index=False)
+    else:
+        print(result)
+    print(f"{args.query}: {len(result)} rows ({args.backend}).")
+
+
+if __name__ == "__main__":
+    main()
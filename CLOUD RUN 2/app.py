@@ -1,3 +1,7 @@
+import os
+import time
+from datetime import datetime
+import numpy as np
 import pandas as pd
 from prophet import Prophet
 from google.cloud import bigquery
@@ -5,103 +9,217 @@ from google.cloud import storage
 import pickle
 import json
 
-# Cargar credenciales desde el archivo JSON
-credentials_path = 'tfm-edem-ec8bf5197ad5.json'
-with open(credentials_path) as f:
-    service_account_info = json.load(f)
+from aggregation import BigQueryBackend
+from segments import SEGMENT_QUERIES, SEGMENT_TABLES, build_series, train_segments
 
-# Configura el cliente de BigQuery
-client = bigquery.Client.from_service_account_info(service_account_info)
+# fast_prophet.py es una copia idéntica del de la API (que consume la calibración) y aggregation.py
+# del de cargaarchivosMLtransformaciones, para que cada imagen se construya solo con su carpeta;
+# al cambiar uno hay que copiarlo a los demás
+from fast_prophet import build_forecast_artifact, calibrate_residual_quantiles
 
-# Consulta para extraer los datos de BigQuery
-query = """
-    SELECT *
-    FROM tfm-edem.tablas_ml.ml_demanda
-"""
-df = client.query(query).to_dataframe()
+# global: un único Prophet sobre la demanda total (ml_demanda).
+# segmented: un Prophet por segmento de SEGMENT_BY (category o country), entrenados en paralelo.
+TRAINING_MODE = os.getenv("TRAINING_MODE", "global").lower()
+SEGMENT_BY = os.getenv("SEGMENT_BY", "category")
+SEGMENT_WORKERS = int(os.getenv("SEGMENT_WORKERS", str(os.cpu_count() or 1)))
+MIN_SEGMENT_DAYS = int(os.getenv("MIN_SEGMENT_DAYS", "14"))
+FORECAST_DAYS = 183
 
-# Convertir la columna 'ds' al tipo datetime
-df['ds'] = pd.to_datetime(df['ds'])
 
-df = df.sort_values(by='ds')
+def train_global(client, service_account_info):
+    # Consulta para extraer los datos de BigQuery
+    query = """
+        SELECT *
+        FROM tfm-edem.tablas_ml.ml_demanda
+    """
+    df = client.query(query).to_dataframe()
 
-df = df.iloc[:-7]
+    # Convertir la columna 'ds' al tipo datetime
+    df['ds'] = pd.to_datetime(df['ds'])
 
-# Supongamos que los datos tienen columnas 'ds' y 'y' necesarias para Prophet
-model = Prophet(daily_seasonality=True)
-model.fit(df)
+    df = df.sort_values(by='ds')
 
-# Obtener el último valor de 'ds' en el dataframe para empezar las predicciones
-last_date = df['ds'].max()
+    df = df.iloc[:-7]
 
-# Crear un dataframe con 183 días en el futuro, empezando desde el día siguiente al último valor de 'ds'
-future = model.make_future_dataframe(periods=183, include_history=False)
-future['ds'] = pd.date_range(start=last_date + pd.Timedelta(days=1), periods=183)
+    # Supongamos que los datos tienen columnas 'ds' y 'y' necesarias para Prophet
+    model = Prophet(daily_seasonality=True)
+    model.fit(df)
 
-# Realizar la predicción
-forecast = model.predict(future)
+    # Obtener el último valor de 'ds' en el dataframe para empezar las predicciones
+    last_date = df['ds'].max()
 
-# Seleccionar las columnas de interés de la predicción
-forecast_filtered = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+    # Crear un dataframe con 183 días en el futuro, empezando desde el día siguiente al último valor de 'ds'
+    future = model.make_future_dataframe(periods=183, include_history=False)
+    future['ds'] = pd.date_range(start=last_date + pd.Timedelta(days=1), periods=183)
+
+    # Realizar la predicción
+    forecast = model.predict(future)
 
-# Para las predicciones, renombrar la columna 'yhat' a 'y' ya que corresponde a la demanda predicha
-forecast_filtered = forecast_filtered.rename(columns={'yhat': 'y'})
-
-# Combinar los datos históricos (con columna 'y') y las predicciones (donde 'y' corresponde a 'yhat')
-df_combined = pd.concat([df[['ds', 'y']], forecast_filtered[['ds', 'y', 'yhat_lower', 'yhat_upper']]], ignore_index=True)
-
-# Guardar el modelo entrenado en un archivo pickle
-model_filename = 'prophet_model.pkl'
-with open(model_filename, 'wb') as f:
-    pickle.dump(model, f)
-
-# Configura el cliente de Google Cloud Storage
-storage_client = storage.Client.from_service_account_info(service_account_info)
-bucket_name = 'bucket_for_model_tfm'
-bucket = storage_client.bucket(bucket_name)
-
-# Sube el archivo pickle al bucket
-blob = bucket.blob(model_filename)
-blob.upload_from_filename(model_filename)
-
-print(f"Modelo subido a gs://{bucket_name}/{model_filename}")
-
-# Configurar la tabla de destino en BigQuery para las predicciones
-table_id = 'tfm-edem.tablas_ml.ml_demanda_pred'
-
-# Definir el esquema de la tabla para las predicciones
-job_config = bigquery.LoadJobConfig(
-    schema=[
-        bigquery.SchemaField("ds", "TIMESTAMP"),
-        bigquery.SchemaField("y", "FLOAT"),  # Ahora y es la demanda predicha
-        bigquery.SchemaField("yhat_lower", "FLOAT"),
-        bigquery.SchemaField("yhat_upper", "FLOAT"),
-    ],
-    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE  # Sobrescribir la tabla si ya existe
-)
-
-# Subir los datos de predicción a la tabla en BigQuery
-job = client.load_table_from_dataframe(forecast_filtered, table_id, job_config=job_config)
-job.result()  # Esperar a que el trabajo termine
-
-print(f"Predicciones guardadas en la tabla {table_id}")
-
-# Configurar la tabla de destino para los datos reales + predicción
-combined_table_id = 'tfm-edem.tablas_ml.ml_demanda_tabla'
-
-# Definir el esquema de la tabla para los datos reales + predicción
-combined_job_config = bigquery.LoadJobConfig(
-    schema=[
-        bigquery.SchemaField("ds", "TIMESTAMP"),
-        bigquery.SchemaField("y", "FLOAT"),  # La columna y contendrá valores reales y predicciones (yhat)
-        bigquery.SchemaField("yhat_lower", "FLOAT"),
-        bigquery.SchemaField("yhat_upper", "FLOAT"),
-    ],
-    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE  # Sobrescribir la tabla si ya existe
-)
-
-# Subir los datos reales + predicción a la tabla en BigQuery
-combined_job = client.load_table_from_dataframe(df_combined, combined_table_id, job_config=combined_job_config)
-combined_job.result()  # Esperar a que el trabajo termine
-
-print(f"Datos reales + predicciones guardadas en la tabla {combined_table_id}")
+    # Seleccionar las columnas de interés de la predicción
+    forecast_filtered = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+
+    # Para las predicciones, renombrar la columna 'yhat' a 'y' ya que corresponde a la demanda predicha
+    forecast_filtered = forecast_filtered.rename(columns={'yhat': 'y'})
+
+    # Combinar los datos históricos (con columna 'y') y las predicciones (donde 'y' corresponde a 'yhat')
+    df_combined = pd.concat([df[['ds', 'y']], forecast_filtered[['ds', 'y', 'yhat_lower', 'yhat_upper']]], ignore_index=True)
+
+    # Guardar el modelo entrenado en un archivo pickle
+    model_filename = 'prophet_model.pkl'
+    with open(model_filename, 'wb') as f:
+        pickle.dump(model, f)
+
+    # Configura el cliente de Google Cloud Storage
+    storage_client = storage.Client.from_service_account_info(service_account_info)
+    bucket_name = 'bucket_for_model_tfm'
+    bucket = storage_client.bucket(bucket_name)
+
+    # Sube el archivo pickle al bucket
+    blob = bucket.blob(model_filename)
+    blob.upload_from_filename(model_filename)
+
+    print(f"Modelo subido a gs://{bucket_name}/{model_filename}")
+
+    # Materializar el pronóstico diario (historia + 2 años) para que la API lo sirva sin ejecutar Prophet.
+    # Formato columnar .npy de forma (4, n): ds (días desde 1970-01-01), yhat, yhat_lower, yhat_upper.
+    artifact_filename = 'prophet_forecast.npy'
+    artifact = build_forecast_artifact(model, horizon_days=730)
+    np.save(artifact_filename, artifact)
+
+    artifact_blob = bucket.blob(artifact_filename)
+    artifact_blob.upload_from_filename(artifact_filename)
+
+    print(f"Pronóstico materializado ({artifact.shape[1]} días) subido a gs://{bucket_name}/{artifact_filename}")
+
+    # Calibrar los intervalos del modo rápido de la API: cuantiles de los residuos sobre el histórico
+    intervals_filename = 'prophet_intervals.json'
+    intervals = calibrate_residual_quantiles(model)
+    with open(intervals_filename, 'w') as f:
+        json.dump(intervals, f)
+
+    intervals_blob = bucket.blob(intervals_filename)
+    intervals_blob.upload_from_filename(intervals_filename)
+
+    print(f"Calibración de intervalos subida a gs://{bucket_name}/{intervals_filename}: {intervals}")
+
+    # Configurar la tabla de destino en BigQuery para las predicciones
+    table_id = 'tfm-edem.tablas_ml.ml_demanda_pred'
+
+    # Definir el esquema de la tabla para las predicciones
+    job_config = bigquery.LoadJobConfig(
+        schema=[
+            bigquery.SchemaField("ds", "TIMESTAMP"),
+            bigquery.SchemaField("y", "FLOAT"),  # Ahora y es la demanda predicha
+            bigquery.SchemaField("yhat_lower", "FLOAT"),
+            bigquery.SchemaField("yhat_upper", "FLOAT"),
+        ],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE  # Sobrescribir la tabla si ya existe
+    )
+
+    # Subir los datos de predicción a la tabla en BigQuery
+    job = client.load_table_from_dataframe(forecast_filtered, table_id, job_config=job_config)
+    job.result()  # Esperar a que el trabajo termine
+
+    print(f"Predicciones guardadas en la tabla {table_id}")
+
+    # Configurar la tabla de destino para los datos reales + predicción
+    combined_table_id = 'tfm-edem.tablas_ml.ml_demanda_tabla'
+
+    # Definir el esquema de la tabla para los datos reales + predicción
+    combined_job_config = bigquery.LoadJobConfig(
+        schema=[
+            bigquery.SchemaField("ds", "TIMESTAMP"),
+            bigquery.SchemaField("y", "FLOAT"),  # La columna y contendrá valores reales y predicciones (yhat)
+            bigquery.SchemaField("yhat_lower", "FLOAT"),
+            bigquery.SchemaField("yhat_upper", "FLOAT"),
+        ],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE  # Sobrescribir la tabla si ya existe
+    )
+
+    # Subir los datos reales + predicción a la tabla en BigQuery
+    combined_job = client.load_table_from_dataframe(df_combined, combined_table_id, job_config=combined_job_config)
+    combined_job.result()  # Esperar a que el trabajo termine
+
+    print(f"Datos reales + predicciones guardadas en la tabla {combined_table_id}")
+
+
+def train_segmented(client):
+    # Serie diaria de cada segmento: se recalcula en BigQuery sobre las tablas limpias (tfm-edem.tablas)
+    # y se guarda en ml_demanda_<dimensión> antes de leerla
+    backend = BigQueryBackend(client, dataset='tablas', project='tfm-edem')
+    backend.run(f'demand_by_{SEGMENT_BY}', destination=SEGMENT_TABLES[SEGMENT_BY])
+    query = SEGMENT_QUERIES[SEGMENT_BY]
+    df = client.query(query).to_dataframe()
+    series, skipped = build_series(df, min_days=MIN_SEGMENT_DAYS)
+    print(f"{len(series)} series por {SEGMENT_BY} ({len(skipped)} omitidas), {SEGMENT_WORKERS} procesos")
+
+    # Entrenar todas las series en paralelo; cada fallo queda registrado en su serie
+    start = time.perf_counter()
+    forecasts, runs = train_segments(series, FORECAST_DAYS, SEGMENT_WORKERS)
+    elapsed = time.perf_counter() - start
+    ok = runs[runs['status'] == 'ok'] if len(runs) else runs
+    print(f"Entrenamiento: {elapsed:.1f} s en total, {len(ok)} series correctas, {len(runs) - len(ok)} con error, "
+          f"suma de ajustes {ok['fit_seconds'].sum() if len(ok) else 0:.1f} s")
+
+    trained_at = datetime.utcnow()
+    runs = pd.concat([runs, pd.DataFrame({'segment': list(skipped), 'status': 'skipped',
+                                          'n_days': None, 'error': list(skipped.values())})], ignore_index=True)
+    runs.insert(0, 'segment_by', SEGMENT_BY)
+    runs['trained_at'] = trained_at
+    forecasts.insert(0, 'segment_by', SEGMENT_BY)
+    forecasts = forecasts[['segment_by', 'segment', 'ds', 'y', 'yhat_lower', 'yhat_upper']]
+
+    # Todos los pronósticos en una sola carga (se sustituye la tabla de esta dimensión)
+    pred_table_id = f'tfm-edem.tablas_ml.ml_demanda_pred_{SEGMENT_BY}'
+    job_config = bigquery.LoadJobConfig(
+        schema=[
+            bigquery.SchemaField("segment_by", "STRING"),
+            bigquery.SchemaField("segment", "STRING"),
+            bigquery.SchemaField("ds", "TIMESTAMP"),
+            bigquery.SchemaField("y", "FLOAT"),
+            bigquery.SchemaField("yhat_lower", "FLOAT"),
+            bigquery.SchemaField("yhat_upper", "FLOAT"),
+        ],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+    )
+    client.load_table_from_dataframe(forecasts, pred_table_id, job_config=job_config).result()
+    print(f"{len(forecasts)} predicciones de {forecasts['segment'].nunique()} series guardadas en {pred_table_id}")
+
+    # Registro por serie (estado, días, tiempo de ajuste, error), acumulado entre ejecuciones
+    runs_table_id = 'tfm-edem.tablas_ml.ml_demanda_segment_runs'
+    runs_config = bigquery.LoadJobConfig(
+        schema=[
+            bigquery.SchemaField("segment_by", "STRING"),
+            bigquery.SchemaField("segment", "STRING"),
+            bigquery.SchemaField("status", "STRING"),
+            bigquery.SchemaField("n_days", "INTEGER"),
+            bigquery.SchemaField("fit_seconds", "FLOAT"),
+            bigquery.SchemaField("total_seconds", "FLOAT"),
+            bigquery.SchemaField("error", "STRING"),
+            bigquery.SchemaField("trained_at", "TIMESTAMP"),
+        ],
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+    )
+    runs['n_days'] = runs['n_days'].astype('Int64')
+    client.load_table_from_dataframe(runs, runs_table_id, job_config=runs_config).result()
+    print(f"Registro de {len(runs)} series guardado en {runs_table_id}")
+
+
+def main():
+    # Cargar credenciales desde el archivo JSON
+    credentials_path = 'tfm-edem-ec8bf5197ad5.json'
+    with open(credentials_path) as f:
+        service_account_info = json.load(f)
+
+    # Configura el cliente de BigQuery
+    client = bigquery.Client.from_service_account_info(service_account_info)
+
+    if TRAINING_MODE == "segmented":
+        train_segmented(client)
+    else:
+        train_global(client, service_account_info)
+
+
+# El pool de procesos usa spawn, que vuelve a importar este módulo: el trabajo va bajo el guard
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Backtesting con origen móvil del modelo de demanda (Prophet).
+
+Para cada combinación de parámetros de la rejilla y cada fecha de corte entrena Prophet con la
+historia hasta el corte y predice los siguientes días. Los pliegues se reparten entre procesos;
+cada proceso recibe la historia una sola vez y guarda en caché el DataFrame de entrenamiento de
+cada corte, así los pliegues que comparten corte (distintos parámetros) no lo vuelven a preparar.
+
+Salida: MAPE y cobertura del intervalo por parámetros y horizonte, y tiempos medios de ajuste y
+predicción por parámetros, para elegir configuración por precisión y por coste de entrenamiento.
+
+Uso:
+    python backtest.py --model prophet_model.pkl --cutoffs 8 --horizons 7,30,90
+    python backtest.py --grid '{"changepoint_prior_scale": [0.01, 0.05, 0.5], "uncertainty_samples": [0, 1000]}'
+    python backtest.py --input demanda.csv --output backtest      # backtest_accuracy.csv, backtest_cost.csv
+Sin --model ni --input la historia se lee de tfm-edem.tablas_ml.ml_demanda.
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from prophet import Prophet
+
+# Configuración actual de app.py
+DEFAULT_GRID = {'daily_seasonality': [True]}
+
+_history = None
+
+
+def _init_worker(history):
+    global _history
+    _history = history
+    for name in ('prophet', 'cmdstanpy'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+@lru_cache(maxsize=None)
+def training_frame(cutoff):
+    """Historia hasta el corte (incluido), preparada una vez por proceso y corte."""
+    return _history[_history['ds'] <= pd.Timestamp(cutoff)].reset_index(drop=True)
+
+
+def run_fold(params_id, params, cutoff, horizon):
+    """Entrena con la historia hasta cutoff y predice horizon días. No lanza excepciones."""
+    result = {'params_id': params_id, 'cutoff': cutoff, 'error': None, 'predictions': None}
+    try:
+        train = training_frame(cutoff)
+        start = time.perf_counter()
+        model = Prophet(**params)
+        model.fit(train)
+        result['fit_seconds'] = time.perf_counter() - start
+
+        future = pd.DataFrame({'ds': pd.date_range(pd.Timestamp(cutoff) + pd.Timedelta(days=1), periods=horizon)})
+        start = time.perf_counter()
+        forecast = model.predict(future)
+        result['predict_seconds'] = time.perf_counter() - start
+
+        # Con uncertainty_samples=0 Prophet no calcula intervalos: la cobertura queda en NaN
+        forecast = forecast.reindex(columns=['ds', 'yhat', 'yhat_lower', 'yhat_upper']).assign(h=np.arange(1, horizon + 1))
+        result['predictions'] = forecast.merge(_history, on='ds', how='inner')
+        result['n_train'] = len(train)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def expand_grid(grid):
+    """{'a': [1, 2], 'b': [3]} -> [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]"""
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def rolling_cutoffs(history, n_cutoffs, period, horizon):
+    """n_cutoffs fechas separadas period días; la última deja horizon días de historia para evaluar."""
+    last = history['ds'].max() - pd.Timedelta(days=horizon)
+    cutoffs = [last - pd.Timedelta(days=period * i) for i in range(n_cutoffs)]
+    first_allowed = history['ds'].min() + pd.Timedelta(days=2 * period)
+    return sorted(c for c in cutoffs if c >= first_allowed)
+
+
+def accuracy_table(predictions, horizons):
+    """MAPE (%) y cobertura del intervalo por parámetros y horizonte, acumulando los días 1..h."""
+    rows = []
+    for (params_id, horizon) in itertools.product(sorted(predictions['params_id'].unique()), horizons):
+        p = predictions[(predictions['params_id'] == params_id) & (predictions['h'] <= horizon)]
+        nonzero = p['y'] != 0
+        ape = (p['y'] - p['yhat']).abs()[nonzero] / p['y'].abs()[nonzero]
+        covered = (p['y'] >= p['yhat_lower']) & (p['y'] <= p['yhat_upper'])
+        rows.append({
+            'params_id': params_id,
+            'horizon': horizon,
+            'mape': float(ape.mean() * 100) if len(ape) else np.nan,
+            'coverage': float(covered.mean()) if p['yhat_lower'].notna().any() else np.nan,
+            'folds': int(p['cutoff'].nunique()),
+        })
+    return pd.DataFrame(rows)
+
+
+def cost_table(folds, grid):
+    """Tiempos medios de ajuste y predicción por combinación de parámetros."""
+    rows = []
+    for params_id, params in enumerate(grid):
+        done = [f for f in folds if f['params_id'] == params_id and f['error'] is None]
+        failed = [f for f in folds if f['params_id'] == params_id and f['error'] is not None]
+        rows.append({
+            'params_id': params_id,
+            'params': json.dumps(params, sort_keys=True),
+            'fit_s_mean': float(np.mean([f['fit_seconds'] for f in done])) if done else np.nan,
+            'predict_s_mean': float(np.mean([f['predict_seconds'] for f in done])) if done else np.nan,
+            'fit_s_total': float(np.sum([f['fit_seconds'] for f in done])),
+            'folds_ok': len(done),
+            'folds_failed': len(failed),
+        })
+    return pd.DataFrame(rows)
+
+
+def backtest(history, grid, cutoffs, horizon, workers):
+    """Ejecuta todos los pliegues (parámetros x cortes) en paralelo; devuelve la lista de resultados."""
+    tasks = [(params_id, params, str(cutoff.date()))
+             for cutoff in cutoffs for params_id, params in enumerate(grid)]
+    folds = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(history,)) as pool:
+        futures = [pool.submit(run_fold, params_id, params, cutoff, horizon) for params_id, params, cutoff in tasks]
+        for future in as_completed(futures):
+            fold = future.result()
+            folds.append(fold)
+            if fold['error'] is not None:
+                print(f"[{len(folds)}/{len(tasks)}] params {fold['params_id']} corte {fold['cutoff']}: ERROR {fold['error']}")
+    return folds
+
+
+def load_history(args):
+    if args.model:
+        import joblib
+        history = joblib.load(args.model).history[['ds', 'y']]
+    elif args.input:
+        history = pd.read_parquet(args.input) if args.input.endswith('.parquet') else pd.read_csv(args.input)
+    else:
+        from google.cloud import bigquery
+        with open('tfm-edem-ec8bf5197ad5.json') as f:
+            client = bigquery.Client.from_service_account_info(json.load(f))
+        history = client.query("SELECT ds, y FROM tfm-edem.tablas_ml.ml_demanda").to_dataframe()
+        # Igual que app.py: los últimos días están incompletos
+        history = history.sort_values('ds').iloc[:-args.holdout_days]
+    history = history.assign(ds=pd.to_datetime(history['ds']), y=history['y'].astype(float))
+    return history.sort_values('ds').reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=None, help="Prophet en pickle; se usa su historia")
+    parser.add_argument("--input", default=None, help="CSV o Parquet con columnas ds, y")
+    parser.add_argument("--holdout-days", type=int, default=7)
+    parser.add_argument("--grid", default=json.dumps(DEFAULT_GRID), help="JSON {parámetro: [valores]}")
+    parser.add_argument("--horizons", default="7,30,90")
+    parser.add_argument("--cutoffs", type=int, default=8)
+    parser.add_argument("--period", type=int, default=30, help="días entre cortes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", default=None, help="prefijo de los CSV de salida")
+    args = parser.parse_args()
+
+    history = load_history(args)
+    grid = expand_grid(json.loads(args.grid))
+    horizons = [int(h) for h in args.horizons.split(",")]
+    cutoffs = rolling_cutoffs(history, args.cutoffs, args.period, max(horizons))
+    print(f"Historia: {len(history)} días ({history['ds'].min().date()} a {history['ds'].max().date()}), "
+          f"{len(grid)} combinaciones x {len(cutoffs)} cortes = {len(grid) * len(cutoffs)} pliegues, "
+          f"{args.workers} procesos")
+
+    start = time.perf_counter()
+    folds = backtest(history, grid, cutoffs, max(horizons), args.workers)
+    elapsed = time.perf_counter() - start
+
+    done = [f for f in folds if f['error'] is None]
+    predictions = pd.concat([f['predictions'].assign(params_id=f['params_id'], cutoff=f['cutoff']) for f in done],
+                            ignore_index=True) if done else pd.DataFrame(
+        columns=['params_id', 'cutoff', 'h', 'y', 'yhat', 'yhat_lower', 'yhat_upper'])
+    accuracy = accuracy_table(predictions, horizons)
+    cost = cost_table(folds, grid)
+    fit_total = cost['fit_s_total'].sum()
+    print(f"{len(folds)} pliegues en {elapsed:.1f} s (suma de ajustes {fit_total:.1f} s)\n")
+
+    summary = accuracy.pivot(index='params_id', columns='horizon', values=['mape', 'coverage'])
+    summary.columns = [f"{metric}_{horizon}d" for metric, horizon in summary.columns]
+    summary = cost.set_index('params_id').join(summary)
+    with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+        print(summary.to_string(float_format=lambda v: f"{v:.3f}"))
+
+    if args.output:
+        accuracy.to_csv(f"{args.output}_accuracy.csv", index=False)
+        cost.to_csv(f"{args.output}_cost.csv", index=False)
+        predictions.to_csv(f"{args.output}_predictions.csv", index=False)
+        print(f"\nTablas guardadas en {args.output}_accuracy.csv, {args.output}_cost.csv y {args.output}_predictions.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Entrenamiento de Prophet por segmento (categoría de producto o país) en un pool de procesos.
+
+Cada segmento es una serie diaria como ml_demanda (ds, y = filas de orders ⋈ order_items ⋈
+order_payments), así que la suma de los segmentos coincide con la demanda total. Antes de entrenar,
+app.py recalcula con aggregation.py (demand_by_<dimensión>, la misma consulta que ml_demanda) la
+tabla tfm-edem.tablas_ml.ml_demanda_{category,country} sobre las tablas limpias. Los modelos se
+entrenan en procesos separados; un error en una serie se registra y no afecta a las demás.
+"""
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+from prophet import Prophet
+
+# Tabla y consulta por dimensión: segment, ds, y (resultado de aggregation.py demand_by_<dimensión>)
+SEGMENT_TABLES = {dimension: f"tfm-edem.tablas_ml.ml_demanda_{dimension}" for dimension in ('category', 'country')}
+SEGMENT_QUERIES = {dimension: f"SELECT segment, ds, y FROM `{table}`" for dimension, table in SEGMENT_TABLES.items()}
+
+
+def build_series(df, holdout_days=7, min_days=14):
+    """Separa el resultado de SEGMENT_QUERIES en una serie diaria (ds, y) por segmento.
+
+    Como el modelo global, se descartan los últimos holdout_days días (incompletos). Los días sin
+    pedidos cuentan 0. Devuelve ({segmento: serie}, {segmento: motivo}) con las series omitidas
+    por tener menos de min_days días con demanda.
+    """
+    df = df.assign(ds=pd.to_datetime(df['ds']), y=df['y'].astype(float))
+    cutoff = df['ds'].max() - pd.Timedelta(days=holdout_days)
+    df = df[df['ds'] <= cutoff]
+
+    series, skipped = {}, {}
+    for segment, group in df.groupby('segment', sort=False):
+        observed = int((group['y'] > 0).sum())
+        if observed < min_days:
+            skipped[segment] = f"only {observed} days with demand (min {min_days})"
+            continue
+        days = pd.date_range(group['ds'].min(), cutoff, freq='D')
+        y = group.groupby('ds')['y'].sum().reindex(days, fill_value=0.0)
+        series[segment] = pd.DataFrame({'ds': days, 'y': y.to_numpy()})
+    return series, skipped
+
+
+def _init_worker():
+    # Prophet y cmdstanpy escriben varias líneas por modelo; con cientos de series tapan el log
+    for name in ('prophet', 'cmdstanpy'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def fit_segment(segment, history, periods):
+    """Entrena Prophet en una serie y predice periods días tras su último día. No lanza excepciones."""
+    start = time.perf_counter()
+    result = {'segment': segment, 'n_days': len(history), 'forecast': None, 'error': None}
+    try:
+        model = Prophet(daily_seasonality=True)
+        model.fit(history)
+        fit_seconds = time.perf_counter() - start
+        future = pd.DataFrame({'ds': pd.date_range(history['ds'].max() + pd.Timedelta(days=1), periods=periods)})
+        forecast = model.predict(future)[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+        result.update(status='ok', fit_seconds=fit_seconds, forecast=forecast.rename(columns={'yhat': 'y'}))
+    except Exception as e:
+        result.update(status='error', fit_seconds=time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+    result['total_seconds'] = time.perf_counter() - start
+    return result
+
+
+def train_segments(series, periods, workers):
+    """Entrena todas las series en un pool de procesos y devuelve (pronósticos, registro por serie)."""
+    results = []
+    # Primero las series más largas, que son las que más tardan
+    order = sorted(series, key=lambda segment: len(series[segment]), reverse=True)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker) as pool:
+        futures = {pool.submit(fit_segment, segment, series[segment], periods): segment for segment in order}
+        for future in as_completed(futures):
+            segment = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # Un proceso murió (p. ej. sin memoria): las series pendientes quedan como fallidas
+                result = {'segment': segment, 'n_days': len(series[segment]), 'forecast': None, 'status': 'error',
+                          'fit_seconds': None, 'total_seconds': None, 'error': f"BrokenProcessPool: {e}"}
+            results.append(result)
+            if result['status'] == 'ok':
+                print(f"[{len(results)}/{len(order)}] {segment}: {result['n_days']} días, "
+                      f"ajuste {result['fit_seconds']:.1f} s")
+            else:
+                print(f"[{len(results)}/{len(order)}] {segment}: ERROR {result['error']}")
+
+    forecasts = [r['forecast'].assign(segment=r['segment']) for r in results if r['forecast'] is not None]
+    forecasts = pd.concat(forecasts, ignore_index=True) if forecasts else pd.DataFrame(
+        columns=['ds', 'y', 'yhat_lower', 'yhat_upper', 'segment'])
+    runs = pd.DataFrame([{key: r[key] for key in ('segment', 'status', 'n_days', 'fit_seconds', 'total_seconds', 'error')}
+                         for r in results])
+    return forecasts, runs
@@ -1,73 +1,311 @@
 import os
+import gzip
+import json
+import pickle
+import tempfile
+import time
+from datetime import datetime
+import joblib
+import numpy as np
 import pandas as pd
+import sklearn
 from google.cloud import bigquery, storage
-from sklearn.cluster import KMeans
-import joblib
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
 
 # Configuración de Google Cloud
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "tfm-edem-ec8bf5197ad5.json"
-  
+
+N_CLUSTERS = 9
+# full: carga la tabla entera y entrena KMeans. streaming: recorre la tabla por páginas con
+# MiniBatchKMeans.partial_fit partiendo de los centroides publicados (bundle o, si aún no hay, los
+# pickles desplegados), con memoria acotada por PAGE_SIZE.
+TRAINING_MODE = os.getenv("TRAINING_MODE", "full").lower()
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50000"))
+STREAMING_EPOCHS = int(os.getenv("STREAMING_EPOCHS", "2"))
+# Entrena también el KMeans completo para comparar inercias (necesita la tabla en memoria)
+COMPARE_FULL_FIT = os.getenv("COMPARE_FULL_FIT", "").lower() in ("1", "true", "yes")
+
+# Columnas del modelo en el orden que usa la API (ClusterInputData)
+FEATURE_NAMES = ['total_spent', 'purchase_frequency', 'average_order_value', 'num_reviews',
+                 'avg_review_score', 'days_since_last_purchase']
+FEATURE_RENAMES = {'days_since_purchase': 'days_since_last_purchase'}
+
+# Bundle único que sirve la API: escalado, centroides (en espacio escalado), orden de columnas y
+# metadatos como arrays de NumPy, sin objetos de sklearn. El formato lo valida fast_kmeans.load_bundle.
+BUNDLE_FORMAT_VERSION = 1
+bucket_name = 'bucket_for_model_tfm'
+bundle_filename = 'clusterizacion_clientes_bundle.npz'
+# Pickles de sklearn (KMeans y StandardScaler, como en el notebook) que la API carga mientras el bucket
+# no tiene bundle; se siguen publicando con los mismos centroides y escalado que el bundle
+model_filename = 'clusterizacion_clientes_model.pkl'
+scaler_filename = 'clusterizacion_clientes_modelscaler.pkl'
+# Asignaciones ya publicadas en ml_clusterizacion_bi (customer_id, cluster); solo se suben las que cambian
+snapshot_filename = 'clusterizacion_clientes_assignments.csv.gz'
+
 # Cliente de BigQuery
 client = bigquery.Client()
+storage_client = storage.Client()
+bucket = storage_client.bucket(bucket_name)
 
-# Leer la tabla de BigQuery
+# Leer la tabla de BigQuery; el resultado queda en una tabla temporal que se puede recorrer varias veces
 query = "SELECT * FROM `tfm-edem.tablas_ml.ml_clusterizacion`"
-df = client.query(query).to_dataframe()
+query_job = client.query(query)
+query_job.result()
+
+
+def features(df):
+    """Matriz de características en el orden de FEATURE_NAMES."""
+    return df.rename(columns=FEATURE_RENAMES)[FEATURE_NAMES].to_numpy(dtype=np.float64)
+
+
+def iter_pages():
+    """Recorre el resultado de la consulta en bloques de como mucho PAGE_SIZE filas."""
+    rows = client.list_rows(query_job.destination, page_size=PAGE_SIZE)
+    for page in rows.to_dataframe_iterable():
+        yield page['customer_id'], features(page)
+
+
+def published_centroids():
+    """Centroides publicados en unidades originales: los del bundle o, sin bundle compatible, los de
+    los pickles desplegados. None si no hay ningún modelo compatible."""
+    blob = bucket.blob(bundle_filename)
+    if blob.exists():
+        with tempfile.NamedTemporaryFile(suffix='.npz') as f:
+            blob.download_to_filename(f.name)
+            with np.load(f.name, allow_pickle=False) as bundle:
+                if (int(bundle['format_version']) == BUNDLE_FORMAT_VERSION
+                        and list(bundle['feature_names']) == FEATURE_NAMES
+                        and bundle['centroids'].shape == (N_CLUSTERS, len(FEATURE_NAMES))):
+                    return bundle['centroids'] * bundle['scale'] + bundle['mean']
+        print("El bundle publicado no es compatible con este modelo; se ignora.")
+    return pickle_centroids()
+
+
+def pickle_centroids():
+    """Centroides del KMeans y el escalado desplegados como pickles, tal como los usa la API sin bundle."""
+    blobs = [bucket.blob(name) for name in (model_filename, scaler_filename)]
+    if not all(blob.exists() for blob in blobs):
+        return None
+    try:
+        models = []
+        for blob in blobs:
+            with tempfile.NamedTemporaryFile(suffix='.pkl') as f:
+                blob.download_to_filename(f.name)
+                # joblib.load lee tanto pickle.dump (notebook) como joblib.dump (versiones anteriores de este job)
+                models.append(joblib.load(f.name))
+        kmeans, scaler = models
+        centers = scaler.inverse_transform(kmeans.cluster_centers_)
+    except Exception as e:
+        print(f"No se pueden leer los pickles desplegados; se ignoran: {e}")
+        return None
+    if centers.shape != (N_CLUSTERS, len(FEATURE_NAMES)):
+        print(f"Los pickles desplegados tienen centroides {centers.shape}; se ignoran.")
+        return None
+    print("Sin bundle publicado: se parte de los centroides de los pickles desplegados.")
+    return centers
+
+
+def published_assignments():
+    """Serie customer_id -> cluster publicada en la ejecución anterior; None si no hay snapshot."""
+    blob = bucket.blob(snapshot_filename)
+    if not blob.exists():
+        return None
+    with tempfile.NamedTemporaryFile(suffix='.csv.gz') as f:
+        blob.download_to_filename(f.name)
+        previous = pd.read_csv(f.name, dtype={'customer_id': str, 'cluster': np.int16})
+    return previous.drop_duplicates('customer_id', keep='last').set_index('customer_id')['cluster']
+
+
+def match_labels(scaler, kmeans, previous_centers):
+    """Reordena los centroides para que cada uno herede la etiqueta del centroide publicado más cercano.
 
-# Separar la columna customer_id
-customer_ids = df['customer_id']
-df = df.drop(columns=['customer_id'])
+    Emparejamiento de mínimo coste (algoritmo húngaro) sobre distancias en el espacio escalado, así
+    las etiquetas no se permutan entre ejecuciones. Devuelve el mapa etiqueta de ajuste -> etiqueta final.
+    """
+    if previous_centers is None:
+        return np.arange(N_CLUSTERS)
+    old = scaler.transform(previous_centers)
+    cost = np.square(old[:, None, :] - kmeans.cluster_centers_[None, :, :]).sum(axis=2)
+    _, order = linear_sum_assignment(cost)
+    kmeans.cluster_centers_ = kmeans.cluster_centers_[order]
+    relabel = np.empty(N_CLUSTERS, dtype=np.int64)
+    relabel[order] = np.arange(N_CLUSTERS)
+    return relabel
 
-# Entrenar el modelo de clusterización
-kmeans = KMeans(n_clusters=9, random_state=42)
-clusters = kmeans.fit_predict(df)
 
-# Crear un nuevo dataframe con customer_id y los clusters
-result_df = pd.DataFrame({
-    'customer_id': customer_ids,
-    'cluster': clusters
-})
+def fit_streaming():
+    # Primera pasada: media y desviación para el escalado
+    scaler = StandardScaler()
+    for _, X in iter_pages():
+        scaler.partial_fit(X)
+
+    centers = scaler.transform(previous_centers) if previous_centers is not None else None
+    print(f"Warm start desde el modelo publicado: {centers is not None}")
+    kmeans = MiniBatchKMeans(
+        n_clusters=N_CLUSTERS,
+        init=centers if centers is not None else 'k-means++',
+        n_init=1,
+        random_state=42,
+    )
+    for epoch in range(STREAMING_EPOCHS):
+        for _, X in iter_pages():
+            kmeans.partial_fit(scaler.transform(X))
+    return scaler, kmeans
+
+
+def assign_streaming(scaler, kmeans, totals):
+    """Asigna cada página y acumula filas e inercia en totals."""
+    for ids, X in iter_pages():
+        distances = kmeans.transform(scaler.transform(X))
+        totals['rows'] += len(ids)
+        totals['inertia'] += float(np.square(distances.min(axis=1)).sum())
+        yield ids, distances.argmin(axis=1)
+
+
+def write_assignments(pages, previous, snapshot_path, delta_path):
+    """Escribe todas las asignaciones (nuevo snapshot) y, aparte, solo las que difieren de previous.
+
+    Devuelve el número de filas cambiadas; sin snapshot anterior todas cuentan como cambiadas.
+    """
+    changed = 0
+    with gzip.open(snapshot_path, 'wt') as snapshot, open(delta_path, 'w') as delta:
+        for i, (ids, clusters) in enumerate(pages):
+            page = pd.DataFrame({'customer_id': np.asarray(ids), 'cluster': clusters})
+            page.to_csv(snapshot, header=i == 0, index=False)
+            if previous is not None:
+                before = previous.reindex(page['customer_id']).to_numpy()
+                page = page[before != page['cluster'].to_numpy()]
+            page.to_csv(delta, header=i == 0, index=False)
+            changed += len(page)
+    return changed
+
+
+previous_centers = published_centroids()
+previous_assignments = published_assignments()
+snapshot_path = os.path.join(tempfile.gettempdir(), snapshot_filename)
+delta_path = os.path.join(tempfile.gettempdir(), 'clusters_delta.csv')
+
+start = time.perf_counter()
+if TRAINING_MODE == "streaming":
+    # Entrenar el modelo de clusterización por páginas
+    scaler, kmeans = fit_streaming()
+    match_labels(scaler, kmeans, previous_centers)
+    fit_seconds = time.perf_counter() - start
+
+    # Asignar clusters por páginas y escribir el snapshot completo y las filas cambiadas en disco
+    totals = {'rows': 0, 'inertia': 0.0}
+    changed = write_assignments(assign_streaming(scaler, kmeans, totals), previous_assignments,
+                                snapshot_path, delta_path)
+    n_rows, inertia = totals['rows'], totals['inertia']
+    print(f"MiniBatchKMeans ({STREAMING_EPOCHS} pasadas, páginas de {PAGE_SIZE} filas): "
+          f"entrenamiento {fit_seconds:.1f} s, {n_rows} clientes, inercia {inertia:.6g}")
+
+    if COMPARE_FULL_FIT:
+        X = scaler.transform(features(query_job.to_dataframe()))
+        start = time.perf_counter()
+        full = KMeans(n_clusters=N_CLUSTERS, random_state=42).fit(X)
+        full_seconds = time.perf_counter() - start
+        print(f"KMeans completo: entrenamiento {full_seconds:.1f} s, inercia {full.inertia_:.6g}. "
+              f"Streaming/completo: tiempo {fit_seconds / full_seconds:.2f}x, inercia {inertia / full.inertia_:.4f}")
+else:
+    df = query_job.to_dataframe()
+
+    # Separar la columna customer_id
+    customer_ids = df['customer_id']
+    X = features(df)
+    n_rows = len(X)
+
+    # Escalar y entrenar el modelo de clusterización sobre los datos escalados, como en el notebook
+    scaler = StandardScaler().fit(X)
+    kmeans = KMeans(n_clusters=N_CLUSTERS, random_state=42)
+    clusters = kmeans.fit_predict(scaler.transform(X))
+    clusters = match_labels(scaler, kmeans, previous_centers)[clusters]
+    inertia = kmeans.inertia_
+    print(f"KMeans completo: entrenamiento {time.perf_counter() - start:.1f} s, "
+          f"{n_rows} clientes, inercia {inertia:.6g}")
+
+    changed = write_assignments([(customer_ids, clusters)], previous_assignments, snapshot_path, delta_path)
+
+print(f"Clientes que cambian de cluster: {changed} de {n_rows}"
+      f"{'' if previous_assignments is not None else ' (sin snapshot anterior, se publican todos)'}")
 
 # Definir el ID de la tabla temporal y de la tabla principal
 temp_table_id = "tfm-edem.tablas_ml.ml_clusterizacion_temp"
 main_table_id = "tfm-edem.tablas_ml.ml_clusterizacion_bi"
 
-# Crear la tabla temporal en BigQuery
-schema = [
-    bigquery.SchemaField("customer_id", "STRING"),
-    bigquery.SchemaField("cluster", "INTEGER"),
-]
+if changed:
+    # Crear la tabla temporal en BigQuery
+    schema = [
+        bigquery.SchemaField("customer_id", "STRING"),
+        bigquery.SchemaField("cluster", "INTEGER"),
+    ]
 
-table = bigquery.Table(temp_table_id, schema=schema)
-client.create_table(table, exists_ok=True)  # Crear la tabla temporal
+    table = bigquery.Table(temp_table_id, schema=schema)
+    client.create_table(table, exists_ok=True)  # Crear la tabla temporal
 
-# Cargar el DataFrame en la tabla temporal
-job = client.load_table_from_dataframe(result_df, temp_table_id)
-job.result()  # Esperar a que el trabajo termine
+    # Cargar solo las filas cambiadas en la tabla temporal
+    job_config = bigquery.LoadJobConfig(
+        schema=schema,
+        source_format=bigquery.SourceFormat.CSV,
+        skip_leading_rows=1,
+        write_disposition="WRITE_TRUNCATE",
+    )
+    with open(delta_path, 'rb') as f:
+        job = client.load_table_from_file(f, temp_table_id, job_config=job_config)
+    job.result()  # Esperar a que el trabajo termine
 
-# Actualizar la tabla principal con los datos de la tabla temporal
-update_query = f"""
-MERGE `{main_table_id}` AS target
-USING `{temp_table_id}` AS source
-ON target.customer_id = source.customer_id
-WHEN MATCHED THEN
-  UPDATE SET target.cluster = source.cluster
-"""
+    # Actualizar la tabla principal con los datos de la tabla temporal
+    update_query = f"""
+    MERGE `{main_table_id}` AS target
+    USING `{temp_table_id}` AS source
+    ON target.customer_id = source.customer_id
+    WHEN MATCHED THEN
+      UPDATE SET target.cluster = source.cluster
+    """
 
-client.query(update_query).result()  # Ejecutar la consulta de actualización
+    client.query(update_query).result()  # Ejecutar la consulta de actualización
 
-# Eliminar la tabla temporal
-client.delete_table(temp_table_id)
+    # Eliminar la tabla temporal
+    client.delete_table(temp_table_id)
 
-# Guardar el modelo en un archivo pkl
-model_filename = 'clusterizacion_clientes_model.pkl'
-joblib.dump(kmeans, model_filename)
+# Guardar escalado y centroides en el bundle versionado
+metadata = {
+    'trained_at': datetime.utcnow().isoformat(),
+    'training_mode': TRAINING_MODE,
+    'n_samples': int(n_rows),
+    'n_clusters': N_CLUSTERS,
+    'inertia': float(inertia),
+    'changed_assignments': int(changed),
+    'sklearn_version': sklearn.__version__,
+    'source_table': 'tfm-edem.tablas_ml.ml_clusterizacion',
+}
+with open(bundle_filename, 'wb') as f:
+    np.savez(
+        f,
+        format_version=np.int64(BUNDLE_FORMAT_VERSION),
+        feature_names=np.array(FEATURE_NAMES, dtype=str),
+        mean=scaler.mean_.astype(np.float64),
+        scale=scaler.scale_.astype(np.float64),
+        centroids=kmeans.cluster_centers_.astype(np.float64),
+        metadata=np.array(json.dumps(metadata)),
+    )
 
-# Subir el modelo al bucket de Google Cloud Storage
-bucket_name = 'bucket_for_model_tfm'
-storage_client = storage.Client()
-bucket = storage_client.bucket(bucket_name)
-blob = bucket.blob(model_filename)
-blob.upload_from_filename(model_filename)
+# Los pickles que carga la API sin bundle, con el mismo escalado y centroides (pickle.dump, como el notebook)
+for filename, model in ((model_filename, kmeans), (scaler_filename, scaler)):
+    with open(filename, 'wb') as f:
+        pickle.dump(model, f)
+    bucket.blob(filename).upload_from_filename(filename)
+print(f"Pickles subidos a gs://{bucket_name}/: {model_filename}, {scaler_filename}")
+
+# Subir el bundle al bucket de Google Cloud Storage
+blob = bucket.blob(bundle_filename)
+blob.upload_from_filename(bundle_filename)
+print(f"Bundle subido a gs://{bucket_name}/{bundle_filename}: {metadata}")
+
+# El snapshot se sube el último, después del MERGE y del bundle: si algo falla antes, la próxima
+# ejecución vuelve a comparar con lo publicado y alinea las etiquetas con los centroides publicados
+bucket.blob(snapshot_filename).upload_from_filename(snapshot_path)
 
 print("Script completado con éxito.")
@@ -0,0 +1,223 @@
+"""Compara el cálculo anterior de customer_features (pd.concat + groupby) con el FULL_REFRESH de main.py.
+
+Genera un conjunto sintético con la forma de los CSV de cargacsv2ml (por defecto 100k pedidos),
+mide tiempo y pico de memoria (tracemalloc) de cada versión partiendo de los CSV en memoria, y
+comprueba el resultado nuevo contra el merge del notebook de clusterización sobre una muestra.
+full_refresh reconstruye el estado de FeatureStore (SQLite) y calcula las características en
+DuckDB sobre los DataFrames; ambos usan las mismas fórmulas de aggregation.py. Si duckdb está
+instalado también se mide DuckDBBackend sobre los mismos CSV escritos en un directorio temporal
+y se comprueban sus customer_features y daily_demand.
+
+Uso:
+    python bench_features.py --orders 100000 --repeats 3
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+from aggregation import DuckDBBackend
+from feature_store import FeatureStore
+from main import SOURCE_COLUMNS, full_refresh
+
+REFERENCE_DATE = '2024-01-01'
+
+
+def synthetic_sources(n_orders, seed=0, text_scores=True):
+    rng = np.random.default_rng(seed)
+    order_ids = np.array([f"{i:032x}" for i in range(n_orders)], dtype=object)
+    n_customers = int(n_orders * 0.97)
+    customer_ids = np.array([f"{i:032x}"[::-1] for i in range(n_customers)], dtype=object)
+    purchase = pd.Timestamp('2021-09-01') + pd.to_timedelta(rng.integers(0, 730 * 86400, n_orders), unit='s')
+
+    orders = pd.DataFrame({
+        'order_id': order_ids,
+        'customer_id': customer_ids[rng.integers(0, n_customers, n_orders)],
+        'status': rng.choice(['delivered', 'shipped', 'canceled'], n_orders),
+        'purchase_timestamp': purchase.strftime('%Y-%m-%d %H:%M:%S'),
+        'approved_at': (purchase + pd.Timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'),
+        'delivered_courier_date': (purchase + pd.Timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S'),
+        'delivered_customer_date': (purchase + pd.Timedelta(days=8)).strftime('%Y-%m-%d %H:%M:%S'),
+        'estimated_delivery_date': (purchase + pd.Timedelta(days=12)).strftime('%Y-%m-%d'),
+    })
+    customers = pd.DataFrame({
+        'customer_id': customer_ids,
+        'customer_unique_id': customer_ids,
+        'postal_code': rng.integers(1000, 99999, n_customers),
+    })
+
+    def fan_out(mean_extra):
+        counts = 1 + rng.poisson(mean_extra, n_orders)
+        return np.repeat(order_ids, counts), counts
+
+    payment_orders, _ = fan_out(0.05)
+    payments = pd.DataFrame({
+        'order_id': payment_orders,
+        'sequential': 1,
+        'payment_type': rng.choice(['credit_card', 'boleto', 'voucher'], len(payment_orders)),
+        'installments': rng.integers(1, 10, len(payment_orders)),
+        'amount': rng.gamma(2, 80, len(payment_orders)).round(2),
+    })
+    item_orders, _ = fan_out(0.15)
+    items = pd.DataFrame({
+        'order_id': item_orders,
+        'product_id': 'p',
+        'seller_id': 's',
+        'shipping_limit_date': '2022-01-01 00:00:00',
+        'price': rng.gamma(2, 60, len(item_orders)).round(2),
+        'freight_value': rng.gamma(2, 10, len(item_orders)).round(2),
+    })
+    reviewed = order_ids[rng.random(n_orders) > 0.01]
+    scores = ['1', '2', '3', '4', '5', 's' if text_scores else '5']
+    reviews = pd.DataFrame({
+        'review_id': [f"r{i}" for i in range(len(reviewed))],
+        'order_id': reviewed,
+        'score': rng.choice(scores, len(reviewed), p=[0.1, 0.05, 0.1, 0.2, 0.5, 0.05]),
+        'has_comment': rng.integers(0, 2, len(reviewed)),
+        'review_creation_date': '2022-01-01 00:00:00',
+        'review_answer_timestamp': '2022-01-02 00:00:00',
+    })
+    frames = {'orders.csv': orders, 'customers.csv': customers, 'order_payments.csv': payments,
+              'order_items.csv': items, 'reviews.csv': reviews}
+    return {name: df.to_csv(index=False).encode() for name, df in frames.items()}
+
+
+def legacy_features(files):
+    """Copia de la versión anterior: apila todos los archivos y agrupa por customer_id."""
+    combined_df = pd.DataFrame()
+    for file_name in ['orders.csv', 'order_items.csv', 'order_payments.csv', 'reviews.csv', 'customers.csv']:
+        df = pd.read_csv(io.StringIO(files[file_name].decode('utf-8')))
+        combined_df = pd.concat([combined_df, df], ignore_index=True, sort=False)
+    if 'days_since_purchase' not in combined_df.columns:
+        combined_df['days_since_purchase'] = None
+    return combined_df.groupby('customer_id').agg({
+        'amount': 'sum', 'order_id': 'count', 'price': 'mean',
+        'review_id': 'count', 'score': 'mean', 'days_since_purchase': 'min',
+    }).reset_index()
+
+
+def new_features(files, from_state=False):
+    """FULL_REFRESH de main.py (full_refresh) con el estado en un SQLite temporal.
+
+    Con from_state las características se consultan al estado reconstruido, como en las
+    actualizaciones incrementales.
+    """
+    frames = {file_name: pd.read_csv(io.BytesIO(files[file_name]), usecols=usecols, dtype=dtype)
+              for file_name, (usecols, dtype) in SOURCE_COLUMNS.items()}
+    with tempfile.TemporaryDirectory(prefix='features-') as directory:
+        store = FeatureStore(os.path.join(directory, 'state.sqlite'))
+        try:
+            features = full_refresh(store, frames, REFERENCE_DATE)
+            if from_state:
+                features = store.customer_features(None, REFERENCE_DATE)
+            return features.drop(columns='deleted')
+        finally:
+            store.close()
+
+
+def notebook_features(files):
+    """Referencia: los merges y la agregación del notebook Clusterizacion_Clientes."""
+    read = {name: pd.read_csv(io.BytesIO(content)) for name, content in files.items()}
+    df = pd.merge(read['orders.csv'], read['customers.csv'], on='customer_id')
+    df = pd.merge(df, read['order_payments.csv'], on='order_id')
+    df = pd.merge(df, read['order_items.csv'], on='order_id')
+    df = pd.merge(df, read['reviews.csv'], on='order_id', how='left')
+    df = df.fillna({'review_id': 'no_review'})
+    df['score'] = pd.to_numeric(df['score'].replace('s', '5'), errors='coerce').fillna(0)
+    df['purchase_timestamp'] = pd.to_datetime(df['purchase_timestamp'])
+    df['days_since_purchase'] = (pd.Timestamp(REFERENCE_DATE) - df['purchase_timestamp']).dt.days
+    return df.groupby('customer_id').agg({
+        'amount': 'sum', 'order_id': 'count', 'price': 'mean',
+        'review_id': 'count', 'score': 'mean', 'days_since_purchase': 'min',
+    }).rename(columns={
+        'amount': 'total_spent', 'order_id': 'purchase_frequency', 'price': 'average_order_value',
+        'review_id': 'num_reviews', 'score': 'avg_review_score',
+    }).reset_index()
+
+
+def notebook_demand(files):
+    """Referencia: merges y groupby del notebook Prediccion_Demanda."""
+    read = {name: pd.read_csv(io.BytesIO(content)) for name, content in files.items()}
+    df = pd.merge(read['orders.csv'], read['order_items.csv'], on='order_id')
+    df = pd.merge(df, read['order_payments.csv'], on='order_id')
+    df['purchase_timestamp'] = pd.to_datetime(df['purchase_timestamp'])
+    df = df[(df['purchase_timestamp'] >= '2010-01-01') & (df['purchase_timestamp'] <= pd.Timestamp(REFERENCE_DATE))]
+    demand = df.groupby(df['purchase_timestamp'].dt.normalize()).size()
+    return pd.DataFrame({'ds': demand.index, 'y': demand.to_numpy()})
+
+
+def write_sources(files, directory):
+    for name, content in files.items():
+        with open(os.path.join(directory, name), 'wb') as file:
+            file.write(content)
+
+
+def duckdb_features(directory):
+    return DuckDBBackend.from_directory(directory).customer_features(REFERENCE_DATE)
+
+
+def check_backends(sample):
+    """customer_features de full_refresh, FeatureStore y DuckDB, y daily_demand de DuckDB, contra los notebooks."""
+    expected = notebook_features(sample).set_index('customer_id').sort_index()
+    expected_demand = notebook_demand(sample)
+    results = {'full_refresh': new_features(sample), 'feature_store': new_features(sample, from_state=True)}
+    with tempfile.TemporaryDirectory(prefix='features-') as directory:
+        write_sources(sample, directory)
+        if aggregation.duckdb is not None:
+            backend = DuckDBBackend.from_directory(directory)
+            results['duckdb'] = backend.customer_features(REFERENCE_DATE)
+            demand = backend.daily_demand(REFERENCE_DATE)
+            demand['ds'] = pd.to_datetime(demand['ds'])
+            pd.testing.assert_frame_equal(demand, expected_demand, check_dtype=False)
+            print(f"duckdb: daily_demand ({len(demand)} days) matches the notebook.")
+
+    for name, result in results.items():
+        result = result.set_index('customer_id').sort_index()
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_exact=False, rtol=1e-9)
+        print(f"{name}: customer_features ({len(result)} customers) matches the notebook.")
+
+
+def measure(fn, files, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(files)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(files)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--check-orders", type=int, default=20000, help="pedidos de la muestra comparada con el notebook")
+    args = parser.parse_args()
+
+    check_backends(synthetic_sources(args.check_orders, seed=1))
+
+    # La versión anterior no admite la puntuación 's' (falla al calcular la media)
+    files = synthetic_sources(args.orders, text_scores=False)
+    print(f"{args.orders} orders, {sum(len(content) for content in files.values()) / 2**20:.1f} MiB of CSV")
+    for name, fn in (('concat + groupby', legacy_features), ('full_refresh', new_features)):
+        seconds, peak = measure(fn, files, args.repeats)
+        print(f"{name:26}{seconds:>8.2f} s{peak:>10.1f} MiB peak")
+    if aggregation.duckdb is not None:
+        # DuckDB lee los CSV desde disco en sus propios hilos; tracemalloc no ve su memoria
+        with tempfile.TemporaryDirectory(prefix='features-') as directory:
+            write_sources(files, directory)
+            seconds, _ = measure(duckdb_features, directory, args.repeats)
+        print(f"{'DuckDBBackend':26}{seconds:>8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
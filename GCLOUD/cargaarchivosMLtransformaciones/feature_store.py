@@ -0,0 +1,224 @@
+import sqlite3
+from datetime import datetime
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from aggregation import CUSTOMER_FEATURES_SELECT, purchase_dates, render_sql
+
+# Aportación de cada archivo a cada pedido. Al volver a subir un archivo con el mismo
+# nombre se sustituyen sus filas, así que nunca se suma dos veces el mismo contenido.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS order_facts (
+    file_name TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    n_payments REAL NOT NULL DEFAULT 0,
+    amount REAL NOT NULL DEFAULT 0,
+    n_items REAL NOT NULL DEFAULT 0,
+    n_prices REAL NOT NULL DEFAULT 0,
+    price_sum REAL NOT NULL DEFAULT 0,
+    n_reviews REAL NOT NULL DEFAULT 0,
+    score_sum REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (file_name, order_id)
+);
+CREATE INDEX IF NOT EXISTS order_facts_order ON order_facts (order_id);
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    customer_id TEXT,
+    purchase_ts REAL,
+    file_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_customer ON orders (customer_id);
+CREATE INDEX IF NOT EXISTS orders_file ON orders (file_name);
+CREATE TABLE IF NOT EXISTS customers (
+    customer_id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS customers_file ON customers (file_name);
+CREATE TABLE IF NOT EXISTS processed_files (
+    file_name TEXT PRIMARY KEY,
+    generation TEXT,
+    rows INTEGER,
+    processed_at TEXT
+);
+"""
+
+FACT_COLUMNS = ['n_payments', 'amount', 'n_items', 'n_prices', 'price_sum', 'n_reviews', 'score_sum']
+INDEXES = ['order_facts_order', 'orders_customer', 'orders_file', 'customers_file']
+
+# Pedidos con la forma de per_order a partir del estado incremental; las fórmulas son las de
+# aggregation.CUSTOMER_FEATURES_SELECT (fechas en segundos epoch: dialecto sqlite)
+FEATURES_SQL = """
+WITH per_order AS (
+    SELECT o.customer_id, o.purchase_ts,
+           SUM(f.n_payments) AS p, SUM(f.amount) AS amount, SUM(f.n_items) AS i, SUM(f.n_prices) AS ip,
+           SUM(f.price_sum) AS price_sum, MAX(SUM(f.n_reviews), 1) AS r, SUM(f.score_sum) AS score_sum
+    FROM {customers}
+    JOIN orders o ON o.customer_id = c.customer_id
+    JOIN order_facts f ON f.order_id = o.order_id
+    GROUP BY o.order_id
+)""" + CUSTOMER_FEATURES_SELECT
+
+
+def source_kind(file_name):
+    """Tipo de archivo por prefijo del nombre: 'orders', 'order_items_2024-01-02.csv' -> 'order_items', etc."""
+    base = file_name.rsplit('/', 1)[-1]
+    for kind in ('order_items', 'order_payments', 'orders', 'reviews', 'customers'):
+        if base.startswith(kind) and base.endswith('.csv'):
+            return kind
+    return None
+
+
+def order_facts(kind, df):
+    """Agrega un archivo de pagos, artículos o reseñas por pedido con las columnas de order_facts."""
+    order_id = df['order_id'].astype('category')
+    if kind == 'order_payments':
+        values = {'n_payments': 1.0, 'amount': pd.to_numeric(df['amount'], errors='coerce').fillna(0)}
+    elif kind == 'order_items':
+        price = pd.to_numeric(df['price'], errors='coerce')
+        values = {'n_items': 1.0, 'n_prices': price.notna().astype(float), 'price_sum': price.fillna(0)}
+    else:
+        score = pd.to_numeric(df['score'].replace('s', '5'), errors='coerce')
+        values = {'n_reviews': 1.0, 'score_sum': score.fillna(0)}
+    facts = pd.DataFrame(values, index=df.index).groupby(order_id, observed=True).sum()
+    for col in FACT_COLUMNS:
+        if col not in facts.columns:
+            facts[col] = 0.0
+    return facts[FACT_COLUMNS]
+
+
+def purchase_seconds(values):
+    """Fecha de compra en segundos epoch, con el año 2222 corregido a 2022 como en el notebook."""
+    purchase = purchase_dates(values)
+    seconds = purchase.astype('datetime64[s]').astype('int64').astype(float)
+    return np.where(purchase.isna(), np.nan, seconds)
+
+
+class FeatureStore:
+    """Estado incremental de customer_features en SQLite.
+
+    Cada archivo ingerido actualiza solo sus filas y devuelve los clientes afectados,
+    para los que se recalculan las características con FEATURES_SQL.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def is_processed(self, file_name, generation):
+        row = self.conn.execute("SELECT generation FROM processed_files WHERE file_name = ?", (file_name,)).fetchone()
+        return row is not None and row[0] == str(generation)
+
+    def _customers_of_orders(self, order_ids):
+        self._fill_temp('touched_orders', 'order_id', order_ids)
+        return {row[0] for row in self.conn.execute(
+            "SELECT DISTINCT o.customer_id FROM orders o JOIN touched_orders t ON t.order_id = o.order_id "
+            "WHERE o.customer_id IS NOT NULL")}
+
+    def _fill_temp(self, table, column, values):
+        self.conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} ({column} TEXT PRIMARY KEY)")
+        self.conn.execute(f"DELETE FROM {table}")
+        self.conn.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?)", ((value,) for value in values))
+
+    def _insert_customers(self, file_name, customer_ids):
+        self.conn.executemany("INSERT OR REPLACE INTO customers VALUES (?, ?)", zip(customer_ids, repeat(file_name)))
+
+    def _insert_orders(self, file_name, orders):
+        seconds = purchase_seconds(orders['purchase_timestamp'])
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?)",
+            zip(orders['order_id'].tolist(), orders['customer_id'].tolist(),
+                np.where(np.isnan(seconds), None, seconds).tolist(), repeat(file_name)))
+
+    def _insert_facts(self, file_name, facts):
+        self.conn.executemany(
+            f"INSERT INTO order_facts (file_name, order_id, {', '.join(FACT_COLUMNS)}) "
+            f"VALUES (?, ?{', ?' * len(FACT_COLUMNS)})",
+            zip(repeat(file_name), map(str, facts.index), *(facts[col].tolist() for col in FACT_COLUMNS)))
+
+    def _mark_processed(self, file_name, generation, rows):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO processed_files VALUES (?, ?, ?, ?)",
+            (file_name, None if generation is None else str(generation), rows, datetime.utcnow().isoformat()))
+
+    def apply_file(self, kind, file_name, df, generation=None):
+        """Sustituye la aportación de file_name por la de df; devuelve el conjunto de clientes afectados."""
+        with self.conn:
+            if kind == 'customers':
+                old = {row[0] for row in self.conn.execute(
+                    "SELECT customer_id FROM customers WHERE file_name = ?", (file_name,))}
+                new = set(df['customer_id'].dropna().unique())
+                self.conn.execute("DELETE FROM customers WHERE file_name = ?", (file_name,))
+                self._insert_customers(file_name, new)
+                affected = old | new
+            elif kind == 'orders':
+                orders = df.drop_duplicates('order_id', keep='last')
+                affected = {row[0] for row in self.conn.execute(
+                    "SELECT DISTINCT customer_id FROM orders WHERE file_name = ? AND customer_id IS NOT NULL",
+                    (file_name,))}
+                # Los clientes que tenían antes estos pedidos (si vienen de otro archivo) también cambian
+                affected |= self._customers_of_orders(orders['order_id'])
+                self.conn.execute("DELETE FROM orders WHERE file_name = ?", (file_name,))
+                self._insert_orders(file_name, orders)
+                affected |= set(orders['customer_id'].dropna().unique())
+            else:
+                facts = order_facts(kind, df)
+                old_orders = [row[0] for row in self.conn.execute(
+                    "SELECT order_id FROM order_facts WHERE file_name = ?", (file_name,))]
+                self.conn.execute("DELETE FROM order_facts WHERE file_name = ?", (file_name,))
+                self._insert_facts(file_name, facts)
+                affected = self._customers_of_orders(set(old_orders) | set(map(str, facts.index)))
+
+            self._mark_processed(file_name, generation, len(df))
+        return affected
+
+    def rebuild(self, frames):
+        """Sustituye todo el estado por los archivos completos ({'orders.csv': df, ...}).
+
+        A diferencia de apply_file no busca clientes afectados: cada archivo se agrega por pedido
+        y se inserta en bloque sin los índices secundarios, que se vuelven a crear al final.
+        """
+        # Si algo falla main.py descarta la copia local, así que no hace falta esperar al disco
+        self.conn.execute("PRAGMA synchronous = OFF")
+        with self.conn:
+            for index in INDEXES:
+                self.conn.execute(f"DROP INDEX IF EXISTS {index}")
+            for table in ('order_facts', 'orders', 'customers', 'processed_files'):
+                self.conn.execute(f"DELETE FROM {table}")
+            for file_name, df in frames.items():
+                kind = source_kind(file_name)
+                if kind == 'customers':
+                    self._insert_customers(file_name, df['customer_id'].dropna().unique().tolist())
+                elif kind == 'orders':
+                    self._insert_orders(file_name, df.drop_duplicates('order_id', keep='last'))
+                else:
+                    self._insert_facts(file_name, order_facts(kind, df))
+                self._mark_processed(file_name, None, len(df))
+        self.conn.executescript(SCHEMA)
+        self.conn.execute("PRAGMA synchronous = FULL")
+
+    def customer_features(self, customer_ids=None, reference_date=None):
+        """Características de los clientes indicados (o de todos si es None).
+
+        Los clientes indicados que ya no tienen filas se devuelven con deleted=True para
+        poder borrarlos aguas abajo.
+        """
+        if customer_ids is None:
+            customers = "customers c"
+        else:
+            self._fill_temp('affected_customers', 'customer_id', customer_ids)
+            customers = "affected_customers a JOIN customers c ON c.customer_id = a.customer_id"
+        query = render_sql(FEATURES_SQL, 'sqlite', {'customers': customers}, reference_date)
+        features = pd.read_sql_query(query, self.conn)
+        features['deleted'] = False
+        if customer_ids is not None:
+            gone = sorted(set(customer_ids) - set(features['customer_id']))
+            if gone:
+                features = pd.concat([features, pd.DataFrame({'customer_id': gone, 'deleted': True})],
+                                     ignore_index=True)
+        return features
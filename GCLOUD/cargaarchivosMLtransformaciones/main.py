@@ -1,79 +1,91 @@
+import os
 import pandas as pd
 from google.cloud import storage, bigquery
 import io
 import functions_framework
 from google.api_core.exceptions import NotFound
 
-def process_and_load_data(event, context):
-    bucket_name = 'cargacsv2ml'
-    file_names = ['orders.csv', 'order_items.csv', 'order_payments.csv', 'reviews.csv', 'customers.csv']
-    project_id = 'tfm-edem'
-    dataset_id = 'tablas_ml'
-    table_id = 'customer_features'
-
-    storage_client = storage.Client()
-    bq_client = bigquery.Client()
-
-    # Inicializa un DataFrame vacío para combinar los datos
-    combined_df = pd.DataFrame()
+from aggregation import DuckDBBackend, duckdb
+from feature_store import FeatureStore, source_kind
+
+# Columnas que se leen de cada archivo; los identificadores hash se leen como categorías
+SOURCE_COLUMNS = {
+    'orders.csv': (['order_id', 'customer_id', 'purchase_timestamp'], {'order_id': 'str', 'customer_id': 'str'}),
+    'customers.csv': (['customer_id'], {'customer_id': 'str'}),
+    'order_payments.csv': (['order_id', 'amount'], {'order_id': 'category'}),
+    'order_items.csv': (['order_id', 'price'], {'order_id': 'category'}),
+    'reviews.csv': (['order_id', 'score'], {'order_id': 'category', 'score': 'str'}),
+}
+
+def read_source(bucket, file_name, source=None):
+    """Descarga un CSV del bucket leyendo solo las columnas de su tipo (source); None si no existe."""
+    blob = bucket.blob(file_name)
+    if not blob.exists():
+        print(f"File {file_name} does not exist in bucket {bucket.name}.")
+        return None
+
+    print(f"Downloading {file_name} from bucket {bucket.name}.")
+    usecols, dtype = SOURCE_COLUMNS[source or file_name]
+    return pd.read_csv(io.BytesIO(blob.download_as_bytes()), usecols=usecols, dtype=dtype)
+
+
+# Estado incremental: SQLite en /tmp, sincronizado con el bucket entre instancias
+STATE_BLOB = os.getenv('FEATURE_STATE_BLOB', 'feature_state/customer_features.sqlite')
+STATE_PATH = os.getenv('FEATURE_STATE_PATH', '/tmp/customer_features.sqlite')
+FULL_REFRESH = os.getenv('FULL_REFRESH', '').lower() in ('1', 'true', 'yes')
+
+FEATURE_SCHEMA = [
+    bigquery.SchemaField("customer_id", "STRING"),
+    bigquery.SchemaField("total_spent", "FLOAT64"),
+    bigquery.SchemaField("purchase_frequency", "FLOAT64"),
+    bigquery.SchemaField("average_order_value", "FLOAT64"),
+    bigquery.SchemaField("num_reviews", "FLOAT64"),
+    bigquery.SchemaField("avg_review_score", "FLOAT64"),
+    bigquery.SchemaField("days_since_purchase", "FLOAT64")
+]
+
+# Generación del estado descargado en esta instancia (None si no hay copia local)
+_state_generation = None
+
+
+def load_state(bucket):
+    """Abre el FeatureStore local, descargándolo solo si el bucket tiene una generación más reciente."""
+    global _state_generation
+    blob = bucket.get_blob(STATE_BLOB)
+    generation = blob.generation if blob is not None else 0
+    if generation != _state_generation or not os.path.exists(STATE_PATH):
+        if os.path.exists(STATE_PATH):
+            os.remove(STATE_PATH)
+        if blob is not None:
+            print(f"Downloading feature state generation {generation}.")
+            blob.download_to_filename(STATE_PATH)
+        _state_generation = generation
+    return FeatureStore(STATE_PATH)
+
+
+def discard_state():
+    """Olvida la copia local del estado; la siguiente invocación lo descarga de nuevo del bucket."""
+    global _state_generation
+    _state_generation = None
+    if os.path.exists(STATE_PATH):
+        os.remove(STATE_PATH)
+
+
+def save_state(bucket, store):
+    """Sube el estado solo si nadie lo ha cambiado desde que se descargó (if_generation_match)."""
+    global _state_generation
+    store.close()
+    blob = bucket.blob(STATE_BLOB)
+    try:
+        blob.upload_from_filename(STATE_PATH, if_generation_match=_state_generation or 0)
+    except Exception:
+        # Otra instancia subió el estado antes: se descarta la copia local y el evento se reintenta
+        discard_state()
+        raise
+    _state_generation = blob.generation
 
-    bucket = storage_client.bucket(bucket_name)
-    for file_name in file_names:
-        blob = bucket.blob(file_name)
-        if not blob.exists():
-            print(f"File {file_name} does not exist in bucket {bucket_name}.")
-            continue
-
-        print(f"Downloading {file_name} from bucket {bucket_name}.")
-        data = blob.download_as_text(encoding='utf-8')
-        df = pd.read_csv(io.StringIO(data))
-
-        # Imprime las primeras filas para depuración
-        print(f"Data from {file_name}:")
-        print(df.head())
-
-        # Concatena con el DataFrame combinado
-        combined_df = pd.concat([combined_df, df], ignore_index=True, sort=False)
-
-    # Imprime las columnas del DataFrame combinado para depuración
-    print("Columns in combined_df:")
-    print(combined_df.columns)
-    print("First few rows of combined_df:")
-    print(combined_df.head())
-
-    # Agregar columna ficticia 'days_since_purchase' si no existe
-    if 'days_since_purchase' not in combined_df.columns:
-        combined_df['days_since_purchase'] = None
-
-    # Agregaciones específicas
-    aggregations = {
-        'amount': 'sum',
-        'order_id': 'count',
-        'price': 'mean',
-        'review_id': 'count',
-        'score': 'mean',
-        'days_since_purchase': 'min'
-    }
-
-    customer_features = combined_df.groupby('customer_id').agg(aggregations).rename(columns={
-        'amount': 'total_spent',
-        'order_id': 'purchase_frequency',
-        'price': 'average_order_value',
-        'review_id': 'num_reviews',
-        'score': 'avg_review_score'
-    }).reset_index()
-
-    # Definir el esquema
-    schema = [
-        bigquery.SchemaField("customer_id", "STRING"),
-        bigquery.SchemaField("total_spent", "FLOAT64"),
-        bigquery.SchemaField("purchase_frequency", "FLOAT64"),
-        bigquery.SchemaField("average_order_value", "FLOAT64"),
-        bigquery.SchemaField("num_reviews", "FLOAT64"),
-        bigquery.SchemaField("avg_review_score", "FLOAT64"),
-        bigquery.SchemaField("days_since_purchase", "FLOAT64")
-    ]
 
+def ensure_feature_table(bq_client, dataset_id, table_id):
     dataset_ref = bq_client.dataset(dataset_id)
 
     # Crear el dataset si no existe
@@ -94,28 +106,130 @@ def process_and_load_data(event, context):
         print(f"Table {table_id} already exists.")
     except NotFound:
         print(f"Table {table_id} does not exist. Creating it.")
-        table = bigquery.Table(table_ref, schema=schema)
+        table = bigquery.Table(table_ref, schema=FEATURE_SCHEMA)
         table = bq_client.create_table(table)
         print(f"Table {table_id} created.")
+    return table_ref
+
 
+def load_features(bq_client, features, table_ref, schema, write_disposition):
     job_config = bigquery.LoadJobConfig(
         schema=schema,
-        write_disposition="WRITE_TRUNCATE",
+        write_disposition=write_disposition,
         source_format=bigquery.SourceFormat.CSV,
+        skip_leading_rows=1,
     )
 
     csv_buffer = io.StringIO()
-    customer_features.to_csv(csv_buffer, index=False)
+    features.to_csv(csv_buffer, index=False)
     csv_buffer.seek(0)
 
-    print(f"Loading data into BigQuery table {table_id}.")
+    print(f"Loading {len(features)} rows into BigQuery table {table_ref.table_id}.")
     job = bq_client.load_table_from_file(csv_buffer, table_ref, job_config=job_config)
     job.result()
-
     if job.error_result:
         print(f"Error: {job.error_result}")
-    else:
-        print(f'Loaded data into {project_id}.{dataset_id}.{table_id}')
+
+
+def upsert_features(bq_client, features, project_id, dataset_id, table_id):
+    """Carga solo las filas cambiadas en una tabla de staging y las integra con MERGE."""
+    staging_id = f"{table_id}_staging"
+    staging_ref = bq_client.dataset(dataset_id).table(staging_id)
+    staging_schema = FEATURE_SCHEMA + [bigquery.SchemaField("deleted", "BOOL")]
+    load_features(bq_client, features, staging_ref, staging_schema, "WRITE_TRUNCATE")
+
+    columns = [field.name for field in FEATURE_SCHEMA]
+    merge_query = f"""
+    MERGE `{project_id}.{dataset_id}.{table_id}` T
+    USING `{project_id}.{dataset_id}.{staging_id}` S
+    ON T.customer_id = S.customer_id
+    WHEN MATCHED AND S.deleted THEN
+      DELETE
+    WHEN MATCHED THEN
+      UPDATE SET {', '.join(f'{col} = S.{col}' for col in columns[1:])}
+    WHEN NOT MATCHED AND NOT S.deleted THEN
+      INSERT ({', '.join(columns)}) VALUES ({', '.join(f'S.{col}' for col in columns)})
+    """
+    bq_client.query(merge_query).result()
+    print(f"Merged {len(features)} changed customers into {project_id}.{dataset_id}.{table_id}.")
+
+
+def full_refresh(store, frames, reference_date=None):
+    """Reconstruye el estado con los archivos completos ({'orders.csv': df, ...}) y devuelve
+    customer_features de todos los clientes.
+
+    Las características se calculan en DuckDB sobre los DataFrames descargados, con el mismo SQL
+    de aggregation.py; sin duckdb (o si falta algún archivo) se consultan al estado en SQLite.
+    """
+    store.rebuild(frames)
+    if duckdb is None or len(frames) < len(SOURCE_COLUMNS):
+        return store.customer_features(None, reference_date)
+    backend = DuckDBBackend({source_kind(source): df for source, df in frames.items()})
+    customer_features = backend.customer_features(reference_date)
+    customer_features['deleted'] = False
+    return customer_features
+
+
+def process_and_load_data(event, context):
+    """Actualiza customer_features con el archivo del evento.
+
+    Solo se lee el archivo nuevo, se recalculan los clientes afectados y se hace upsert
+    de esas filas. Con FULL_REFRESH se reconstruye el estado con los cinco archivos y
+    se reescribe la tabla completa (WRITE_TRUNCATE).
+    """
+    bucket_name = 'cargacsv2ml'
+    project_id = 'tfm-edem'
+    dataset_id = 'tablas_ml'
+    table_id = 'customer_features'
+
+    data = getattr(event, 'data', None) or {}
+    file_name = data.get('name')
+    generation = data.get('generation')
+    kind = source_kind(file_name) if file_name else None
+    if not FULL_REFRESH and kind is None:
+        print(f"File {file_name} is not a customer feature source. Skipping.")
+        return
+
+    storage_client = storage.Client()
+    bq_client = bigquery.Client()
+    bucket = storage_client.bucket(bucket_name)
+    reference_date = os.getenv('REFERENCE_DATE')
+
+    store = load_state(bucket)
+    try:
+        if FULL_REFRESH:
+            frames = {source: read_source(bucket, source) for source in SOURCE_COLUMNS}
+            frames = {source: df for source, df in frames.items() if df is not None}
+            customer_features = full_refresh(store, frames, reference_date)
+        else:
+            if store.is_processed(file_name, generation):
+                print(f"File {file_name} (generation {generation}) already processed. Skipping.")
+                store.close()
+                return
+            df = read_source(bucket, file_name, f"{kind}.csv")
+            if df is None:
+                store.close()
+                return
+            affected = store.apply_file(kind, file_name, df, generation)
+            customer_features = store.customer_features(affected, reference_date)
+            print(f"{file_name}: {len(df)} rows, {len(affected)} affected customers.")
+
+        table_ref = ensure_feature_table(bq_client, dataset_id, table_id)
+        if FULL_REFRESH:
+            features = customer_features.drop(columns='deleted')
+            load_features(bq_client, features, table_ref, FEATURE_SCHEMA, "WRITE_TRUNCATE")
+            print(f'Loaded {len(features)} customers into {project_id}.{dataset_id}.{table_id}')
+        elif len(customer_features):
+            upsert_features(bq_client, customer_features, project_id, dataset_id, table_id)
+    except Exception:
+        # apply_file ya marcó el archivo como procesado en el SQLite local: se descarta la copia
+        # para que el reintento vuelva a bajar el estado del bucket y recalcule el archivo
+        store.close()
+        discard_state()
+        raise
+
+    # El estado se guarda después de publicar: si falla la subida, el reintento recalcula lo mismo
+    save_state(bucket, store)
 
 @functions_framework.cloud_event
 def hello_gcs(cloud_event):
@@ -0,0 +1,159 @@
+"""Compara la limpieza anterior (read_csv con inferencia + apply fila a fila) con los planes compilados.
+
+Mide también la salida en Parquet (STAGING_FORMAT=PARQUET) y el tamaño de cada archivo limpio, y
+comprueba que cada tabla limpia tiene los mismos valores que con la limpieza anterior (las fechas
+sintéticas empiezan en 2019, así que también se comprueba a qué columnas se aplica MIN_DATE).
+Usa los CSV de DATA/raw y genera orders/order_payments/order_items/reviews sintéticos del mismo
+tamaño. No toca GCS ni BigQuery: los clientes se sustituyen por mocks al importar cloud.py.
+
+Uso:
+    python bench_cleaning.py --rows 30000 --repeats 5
+"""
+import argparse
+import io
+import os
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+with mock.patch("google.cloud.storage.Client"), mock.patch("google.cloud.bigquery.Client"):
+    import cloud
+
+
+def legacy_clean(content, int_columns, float_columns, date_columns):
+    """Copia de la limpieza previa a los planes compilados, para comparar tiempos."""
+    df = pd.read_csv(io.StringIO(content.decode()))
+
+    if 'amount' in df.columns:
+        df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
+        mean_amount = df[df['amount'] <= 10000.0]['amount'].mean()
+        df['amount'] = df['amount'].apply(lambda x: mean_amount if pd.notna(x) and x > 10000.0 else x)
+
+    for col in int_columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+            mode_value = df[col].mode()
+            mode_value = mode_value[0] if not mode_value.empty else df[col].mean()
+            df[col] = df[col].fillna(mode_value).astype('Int64')
+
+    for col in float_columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+            df[col] = df[col].fillna(df[col].mean())
+
+    dates = ["purchase_timestamp", "approved_at", "delivered_courier_date", "delivered_customer_date", "estimated_delivery_date"]
+    for date_col in set(dates + date_columns):
+        if date_col in df.columns:
+            df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+            df.loc[df[date_col] < pd.Timestamp('2020-01-01'), date_col] = pd.NaT
+    return df.to_csv(index=False)
+
+
+def plan_frame(content, plan):
+    header = cloud._parse_header(content[:65536].decode('utf-8', errors='ignore'))
+    df = cloud._coerce_numeric(cloud._read_csv(io.BytesIO(content), plan, header), plan)
+    return cloud._clean_frame(df, plan, cloud._frame_stats(df, plan))
+
+
+def plan_clean(content, plan):
+    return plan_frame(content, plan).to_csv(index=False)
+
+
+def plan_clean_parquet(content, plan):
+    buffer = io.BytesIO()
+    pq.write_table(cloud._frame_to_arrow(plan_frame(content, plan), plan), buffer, compression=cloud.PARQUET_COMPRESSION)
+    return buffer.getvalue()
+
+
+def check_same_values(table, legacy_csv, plan_csv):
+    """Mismos valores que la limpieza anterior; solo puede cambiar la forma de escribir los números."""
+    pd.testing.assert_frame_equal(pd.read_csv(io.StringIO(plan_csv)), pd.read_csv(io.StringIO(legacy_csv)),
+                                  check_dtype=False, obj=table)
+
+
+def timestamps(rng, n, missing=0.0):
+    values = pd.Timestamp('2019-06-01') + pd.to_timedelta(rng.integers(0, 1500 * 86400, n), unit='s')
+    values = values.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=object)
+    values[rng.random(n) < missing] = None
+    return values
+
+
+def synthetic_files(n, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [f"{i:032x}" for i in range(n)]
+    amount = rng.gamma(2, 80, n).round(2)
+    amount[rng.random(n) < 0.01] = 25000.0
+    return {
+        'orders': pd.DataFrame({
+            'order_id': ids, 'customer_id': ids, 'status': rng.choice(['delivered', 'shipped'], n),
+            'purchase_timestamp': timestamps(rng, n), 'approved_at': timestamps(rng, n, 0.01),
+            'delivered_courier_date': timestamps(rng, n, 0.02), 'delivered_customer_date': timestamps(rng, n, 0.03),
+            'estimated_delivery_date': pd.Series(timestamps(rng, n)).str[:10],
+        }),
+        'order_payments': pd.DataFrame({
+            'order_id': ids, 'sequential': rng.integers(1, 3, n), 'payment_type': rng.choice(['credit_card', 'boleto'], n),
+            'installments': rng.integers(1, 10, n), 'amount': amount,
+        }),
+        'order_items': pd.DataFrame({
+            'order_id': ids, 'product_id': ids, 'seller_id': ids, 'shipping_limit_date': timestamps(rng, n),
+            'price': rng.gamma(2, 50, n).round(2), 'freight_value': rng.gamma(2, 10, n).round(2),
+        }),
+        'reviews': pd.DataFrame({
+            'review_id': ids, 'order_id': ids, 'score': rng.integers(1, 6, n), 'has_comment': rng.integers(0, 2, n),
+            'review_creation_date': timestamps(rng, n), 'review_answer_timestamp': timestamps(rng, n),
+        }),
+    }
+
+
+def best_of(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw-dir", default=os.path.join(here, "..", "..", "DATA", "raw"))
+    parser.add_argument("--rows", type=int, default=30000, help="filas de los archivos sintéticos")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    files = {}
+    for table in ('geolocalizaciones', 'products', 'sellers'):
+        with open(os.path.join(args.raw_dir, f"{table}.csv"), 'rb') as file:
+            files[table] = file.read()
+    for table, df in synthetic_files(args.rows).items():
+        files[table] = df.to_csv(index=False).encode()
+
+    print(f"pyarrow: {cloud.pa is not None}")
+    print(f"{'tabla':20}{'filas':>8}{'MB':>7}{'antes (s)':>11}{'plan (s)':>10}{'x':>7}"
+          f"{'parquet (s)':>13}{'x':>7}{'MB csv':>8}{'MB parquet':>12}")
+    for table, content in files.items():
+        plan = cloud.CLEANING_PLANS[table]
+        schema = plan['schema']
+        int_columns = [col['name'] for col in schema if col['type'] == 'INTEGER']
+        float_columns = [col['name'] for col in schema if col['type'] == 'FLOAT']
+        date_columns = [col['name'] for col in schema if col['type'] == 'DATE']
+        check_same_values(table, legacy_clean(content, int_columns, float_columns, date_columns),
+                          plan_clean(content, plan))
+
+        before = best_of(lambda: legacy_clean(content, int_columns, float_columns, date_columns), args.repeats)
+        after = best_of(lambda: plan_clean(content, plan), args.repeats)
+        parquet = best_of(lambda: plan_clean_parquet(content, plan), args.repeats)
+        csv_size = len(plan_clean(content, plan).encode())
+        parquet_size = len(plan_clean_parquet(content, plan))
+        rows = content.count(b'\n') - 1
+        print(f"{table:20}{rows:>8}{len(content) / 1e6:>7.2f}{before:>11.4f}{after:>10.4f}{before / after:>7.1f}"
+              f"{parquet:>13.4f}{before / parquet:>7.1f}{csv_size / 1e6:>8.2f}{parquet_size / 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
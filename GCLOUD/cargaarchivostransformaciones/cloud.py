@@ -4,14 +4,28 @@ import os
 import traceback
 import re
 import io
+import csv
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 import pandas as pd
 import yaml
 from google.cloud import bigquery
 from google.cloud import storage
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import Conflict, NotFound, PreconditionFailed
+
+# Lector CSV de pyarrow si está instalado (multihilo); si no, el motor de C de pandas
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
 
 # Leer la configuración del archivo YAML
-with open("./schemas.yaml") as schema_file:
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.yaml")) as schema_file:
     config = yaml.load(schema_file, Loader=yaml.Loader)
 
 PROJECT_ID = os.getenv('GCP_PROJECT')
@@ -21,116 +35,466 @@ BQ = bigquery.Client()
 
 PROCESSED_PREFIX = "processed_"
 
-def clean_csv(bucket_name, file_name, int_columns, float_columns, date_columns, processed_prefix):
-    """Descarga el CSV, limpia columnas de enteros y decimales, transforma fechas y horas, y luego vuelve a subir el archivo limpio."""
+STREAMING_THRESHOLD_BYTES = int(os.getenv('STREAMING_THRESHOLD_BYTES', str(64 * 1024 * 1024)))
+CHUNK_ROWS = int(os.getenv('CHUNK_ROWS', '50000'))
+# Intentos de carga por archivo: cada uno es un job con id propio ({id}_{n}) porque BigQuery no reutiliza ids
+MAX_LOAD_ATTEMPTS = int(os.getenv('MAX_LOAD_ATTEMPTS', '10'))
+AMOUNT_LIMIT = 10000.0
+MIN_DATE = pd.Timestamp('2020-01-01')
+# Las fechas anteriores a MIN_DATE se cargan como NaT solo en las fechas de pedidos y en las columnas
+# DATE, como en la limpieza original; shipping_limit_date y las fechas de reseñas se cargan tal cual
+MIN_DATE_COLUMNS = ('purchase_timestamp', 'approved_at', 'delivered_courier_date', 'delivered_customer_date',
+                    'estimated_delivery_date')
+DATETIME_FORMATS = {'TIMESTAMP': '%Y-%m-%d %H:%M:%S', 'DATE': '%Y-%m-%d'}
+
+# Formato de los archivos limpios que se dejan en el bucket y se cargan en BigQuery: CSV o PARQUET
+STAGING_FORMAT = os.getenv('STAGING_FORMAT', 'CSV').upper()
+if STAGING_FORMAT not in ('CSV', 'PARQUET'):
+    raise ValueError(f"STAGING_FORMAT must be CSV or PARQUET, got {STAGING_FORMAT}")
+if STAGING_FORMAT == 'PARQUET' and pa is None:
+    raise ImportError("STAGING_FORMAT=PARQUET requires pyarrow")
+PARQUET_COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'snappy')
+
+
+def _arrow_type(bq_type):
+    """Tipo de Arrow para cada tipo del esquema; los TIMESTAMP se escriben en UTC, igual que BigQuery interpreta el CSV."""
+    return {
+        'STRING': pa.string(),
+        'INTEGER': pa.int64(),
+        'FLOAT': pa.float64(),
+        'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+        'DATE': pa.date32(),
+    }[bq_type]
+
+
+def compile_cleaning_plan(table):
+    """Traduce la definición de una tabla del schema.yaml a un plan de limpieza reutilizable."""
+    schema = table.get('schema')
+    return {
+        'name': table.get('name'),
+        'format': table.get('format'),
+        'schema': schema,
+        'int_columns': [col['name'] for col in schema if col['type'] == 'INTEGER'],
+        'float_columns': [col['name'] for col in schema if col['type'] == 'FLOAT'],
+        'date_formats': {col['name']: DATETIME_FORMATS[col['type']] for col in schema if col['type'] in DATETIME_FORMATS},
+        'min_date_columns': [col['name'] for col in schema
+                             if col['name'] in MIN_DATE_COLUMNS or col['type'] == 'DATE'],
+        'arrow_fields': [pa.field(col['name'], _arrow_type(col['type'])) for col in schema] if pa is not None else None,
+    }
 
-    bucket = CS.bucket(bucket_name)
-    cleaned_file_name = processed_prefix + file_name
-    cleaned_blob = bucket.blob(cleaned_file_name)
-    if cleaned_blob.exists():
-        print(f"El archivo {cleaned_file_name} ya ha sido procesado. Omitting.")
-        return cleaned_file_name
 
-    # Descargar el archivo CSV y cargarlo en un DataFrame
-    blob = bucket.blob(file_name)
-    csv_content = blob.download_as_text()
-    df = pd.read_csv(io.StringIO(csv_content))
+# Los planes se compilan una sola vez por instancia, no en cada evento
+CLEANING_PLANS = {table['name']: compile_cleaning_plan(table) for table in config}
+
+# Índice de enrutado precompilado: un archivo va a la tabla cuyo nombre (con '_' o '-') aparece en él
+TABLE_ROUTES = [(name, re.compile(f"{name.replace('_', '-')}|{name}")) for name in CLEANING_PLANS]
+
+# Cachés que sobreviven entre invocaciones mientras la instancia siga caliente
+KNOWN_TABLES = set()
+LEDGER_SIZE = int(os.getenv('LEDGER_SIZE', '10000'))
+_event_ledger = OrderedDict()
+_ledger_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def route_file(filename):
+    """Tablas de destino de un archivo según el índice de enrutado."""
+    return tuple(name for name, pattern in TABLE_ROUTES if pattern.search(filename))
+
+
+def _claim_event(key):
+    """Registra el evento (bucket, nombre, generación); devuelve False si ya se procesó en esta instancia."""
+    with _ledger_lock:
+        if key in _event_ledger:
+            _event_ledger.move_to_end(key)
+            return False
+        _event_ledger[key] = True
+        if len(_event_ledger) > LEDGER_SIZE:
+            _event_ledger.popitem(last=False)
+        return True
 
-    # Procesar columna 'amount' si existe
+
+def _release_event(key):
+    """Quita el evento del registro para que un reintento pueda volver a procesarlo."""
+    with _ledger_lock:
+        _event_ledger.pop(key, None)
+
+
+@lru_cache(maxsize=256)
+def _reader_options(table_name, header):
+    """Columnas y tipos para pd.read_csv según la cabecera real del archivo.
+
+    La carga en BigQuery es posicional, así que se leen las primeras columnas del
+    archivo (tantas como tenga el esquema) y el tipo se toma de la posición: así una
+    cabecera con otro nombre (CLIENT_ISO_CODE frente a CLIENTE_ISO_CODE) sigue funcionando.
+    Las columnas STRING y de fecha se leen como texto: las fechas se parsean después
+    con formato fijo y el texto no pasa por la inferencia de tipos.
+    """
+    plan = CLEANING_PLANS[table_name]
+    usecols = list(header[:len(plan['schema'])])
+    dtype = {name: 'str' for name, col in zip(usecols, plan['schema'])
+             if col['type'] == 'STRING' or col['type'] in DATETIME_FORMATS}
+    return {'usecols': usecols, 'dtype': dtype}
+
+
+def _parse_header(text):
+    return tuple(next(csv.reader(io.StringIO(text.split('\n', 1)[0].rstrip('\r')))))
+
+
+def _read_csv(source, plan, header, **kwargs):
+    """Lee el CSV con las columnas y tipos del plan; sin chunksize usa pyarrow si está disponible."""
+    options = _reader_options(plan['name'], header)
+    if pa is not None and 'chunksize' not in kwargs:
+        convert_options = pa_csv.ConvertOptions(
+            include_columns=options['usecols'],
+            column_types={name: pa.string() for name in options['dtype']},
+            strings_can_be_null=True,  # vacíos como nulos, igual que pandas
+        )
+        return pa_csv.read_csv(source, convert_options=convert_options).to_pandas()
+    return pd.read_csv(source, usecols=options['usecols'], dtype=options['dtype'], **kwargs)
+
+
+def _parse_dates(values, date_format):
+    """Parsea con el formato fijo del esquema; si algún valor no encaja, vuelve a la inferencia."""
+    parsed = pd.to_datetime(values, format=date_format, errors='coerce')
+    if (parsed.isna() & values.notna()).any():
+        parsed = pd.to_datetime(values, errors='coerce')
+    return parsed
+
+
+def _coerce_numeric(df, plan):
+    """Convierte a número las columnas numéricas del plan (los valores no válidos pasan a nulo)."""
+    for col in plan['int_columns'] + plan['float_columns']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
     if 'amount' in df.columns:
         df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-        mean_amount = df[df['amount'] <= 10000.0]['amount'].mean()
-        df['amount'] = df['amount'].apply(lambda x: mean_amount if pd.notna(x) and x > 10000.0 else x)
+    return df
+
+
+def _new_stats(plan):
+    """Estadísticas acumulables entre trozos: modas (conteos), sumas y recuentos."""
+    return {
+        'amount': [0.0, 0, 0],  # suma <= límite, recuento <= límite, recuento > límite
+        'int': {col: pd.Series(dtype='float64') for col in plan['int_columns']},
+        'float': {col: [0.0, 0] for col in plan['float_columns']},
+    }
+
+
+def _accumulate_stats(df, stats, plan):
+    """Actualiza las estadísticas con un trozo ya convertido por _coerce_numeric (sin modificarlo)."""
+    if 'amount' in df.columns:
+        amount = df['amount']
+        valid = amount[amount <= AMOUNT_LIMIT]
+        stats['amount'][0] += valid.sum()
+        stats['amount'][1] += valid.count()
+        stats['amount'][2] += int((amount > AMOUNT_LIMIT).sum())
+
+    for col in plan['int_columns']:
+        if col in df.columns:
+            stats['int'][col] = stats['int'][col].add(df[col].value_counts(), fill_value=0)
+
+    for col in plan['float_columns']:
+        if col in df.columns and col != 'amount':
+            stats['float'][col][0] += df[col].sum()
+            stats['float'][col][1] += df[col].count()
+
+
+def _finalize_stats(stats):
+    """Convierte las estadísticas acumuladas en los valores de imputación."""
+    amount_sum, amount_count, outliers = stats['amount']
+    mean_amount = amount_sum / amount_count if amount_count else float('nan')
+
+    int_fill = {}
+    for col, counts in stats['int'].items():
+        if len(counts):
+            # Igual que Series.mode()[0]: máxima frecuencia y, en empate, el menor valor
+            int_fill[col] = counts[counts == counts.max()].index.min()
+        else:
+            int_fill[col] = float('nan')
+
+    float_fill = {}
+    for col, (total, count) in stats['float'].items():
+        float_fill[col] = total / count if count else float('nan')
+    if 'amount' in stats['float']:
+        # Los valores atípicos ya se han sustituido por la media cuando se imputan los nulos
+        count = amount_count + outliers
+        float_fill['amount'] = (amount_sum + outliers * mean_amount) / count if count else float('nan')
+
+    return {'mean_amount': mean_amount, 'int': int_fill, 'float': float_fill}
+
+
+def _frame_stats(df, plan):
+    """Valores de imputación calculados sobre un DataFrame completo (modo en memoria)."""
+    stats = _new_stats(plan)
+    _accumulate_stats(df, stats, plan)
+    return _finalize_stats(stats)
+
+
+def _clean_frame(df, plan, fill):
+    """Aplica el plan a un DataFrame (o a un trozo) ya convertido, con valores de imputación ya calculados."""
+    # Sustituir los importes atípicos por la media de los válidos
+    if 'amount' in df.columns:
+        df['amount'] = df['amount'].mask(df['amount'] > AMOUNT_LIMIT, fill['mean_amount'])
 
     # Procesar columnas de enteros
-    for col in int_columns:
+    for col in plan['int_columns']:
         if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-            mode_value = df[col].mode()
-            if not mode_value.empty:
-                mode_value = mode_value[0]
-            else:
-                mode_value = df[col].mean()
-            df[col] = df[col].fillna(mode_value).astype('Int64') 
+            df[col] = df[col].fillna(fill['int'][col]).astype('Int64')
 
     # Procesar columnas de flotantes
-    for col in float_columns:
+    for col in plan['float_columns']:
         if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-            mean_value = df[col].mean()
-            df[col] = df[col].fillna(mean_value)
+            df[col] = df[col].fillna(fill['float'][col])
 
-
-    dates = ["purchase_timestamp", "approved_at", "delivered_courier_date", "delivered_customer_date", "estimated_delivery_date"]
-    # Asegurarse de que no haya duplicados combinando las listas
-    all_date_columns = list(set(dates + date_columns))
-    # Convertir todas las columnas de fecha a tipo datetime y cargar nulos como NaT a BigQuery
-    for date_col in all_date_columns:
-        if date_col in df.columns:
-            df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+    # Convertir las columnas TIMESTAMP y DATE a datetime y cargar nulos como NaT a BigQuery
+    for col, date_format in plan['date_formats'].items():
+        if col in df.columns:
+            parsed = _parse_dates(df[col], date_format)
             # Reemplazar fechas anteriores a 2020 por NaT
-            df.loc[df[date_col] < pd.Timestamp('2020-01-01'), date_col] = pd.NaT
+            df[col] = parsed.where(parsed >= MIN_DATE) if col in plan['min_date_columns'] else parsed
+    return df
+
+
+def _frame_to_arrow(df, plan):
+    """Convierte un DataFrame limpio en una tabla Arrow con los nombres y tipos del esquema.
+
+    Las columnas se emparejan por posición, como en la carga CSV, y se renombran al
+    nombre del esquema porque BigQuery carga los Parquet por nombre de columna.
+    """
+    fields = plan['arrow_fields'][:len(df.columns)]
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.rename_columns([field.name for field in fields])
+    # safe=False: las fechas DATE pueden venir con hora si se parsearon por inferencia
+    return table.cast(pa.schema(fields), safe=False)
+
+
+def _cleaned_file_name(file_name, processed_prefix):
+    if STAGING_FORMAT == 'PARQUET':
+        return processed_prefix + os.path.splitext(file_name)[0] + '.parquet'
+    return processed_prefix + file_name
 
-    # Convertir el DataFrame de nuevo a CSV y subirlo al bucket
-    cleaned_csv_content = df.to_csv(index=False)
-    cleaned_blob.upload_from_string(cleaned_csv_content, content_type="text/csv")
+
+def _upload_frame(df, cleaned_blob, plan, if_generation_match=0):
+    """Sube el DataFrame limpio al bucket en el formato de STAGING_FORMAT."""
+    if STAGING_FORMAT == 'PARQUET':
+        buffer = io.BytesIO()
+        pq.write_table(_frame_to_arrow(df, plan), buffer, compression=PARQUET_COMPRESSION)
+        cleaned_blob.upload_from_string(buffer.getvalue(), content_type="application/vnd.apache.parquet",
+                                        if_generation_match=if_generation_match)
+    else:
+        # Convertir el DataFrame de nuevo a CSV y subirlo al bucket
+        cleaned_csv_content = df.to_csv(index=False)
+        cleaned_blob.upload_from_string(cleaned_csv_content, content_type="text/csv", if_generation_match=if_generation_match)
+
+
+def _write_chunks(chunks, cleaned_blob, plan, if_generation_match=0):
+    """Escribe los trozos limpios en una subida reanudable; devuelve el número de filas."""
+    rows = 0
+    if STAGING_FORMAT == 'PARQUET':
+        with cleaned_blob.open('wb', content_type="application/vnd.apache.parquet", if_generation_match=if_generation_match) as sink:
+            writer = None
+            for chunk in chunks:
+                table = _frame_to_arrow(chunk, plan)
+                if writer is None:
+                    writer = pq.ParquetWriter(sink, table.schema, compression=PARQUET_COMPRESSION)
+                writer.write_table(table)
+                rows += len(chunk)
+            if writer is not None:
+                writer.close()
+    else:
+        with cleaned_blob.open('w', content_type="text/csv", if_generation_match=if_generation_match) as sink:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(sink, index=False, header=(i == 0))
+                rows += len(chunk)
+    return rows
+
+
+def _clean_in_memory(blob, cleaned_blob, plan, if_generation_match=0):
+    """Descarga el CSV completo, lo limpia y lo vuelve a subir (archivos pequeños)."""
+    content = blob.download_as_bytes()
+    header = _parse_header(content[:65536].decode('utf-8', errors='ignore'))
+    df = _coerce_numeric(_read_csv(io.BytesIO(content), plan, header), plan)
+    fill = _frame_stats(df, plan)
+    df = _clean_frame(df, plan, fill)
+    _upload_frame(df, cleaned_blob, plan, if_generation_match)
+
+
+def _clean_streaming(blob, cleaned_blob, plan, if_generation_match=0):
+    """Limpia el CSV por trozos con memoria acotada.
+
+    Primera pasada: acumula modas y medias. Segunda pasada: limpia cada trozo y
+    lo escribe en una subida reanudable, sin tener nunca el archivo entero en memoria.
+    La lectura por trozos usa el motor de C de pandas.
+    """
+    header = _parse_header(blob.download_as_bytes(start=0, end=65535).decode('utf-8', errors='ignore'))
+
+    stats = _new_stats(plan)
+    with blob.open('rb') as reader:
+        for chunk in _read_csv(reader, plan, header, chunksize=CHUNK_ROWS):
+            _accumulate_stats(_coerce_numeric(chunk, plan), stats, plan)
+    fill = _finalize_stats(stats)
+
+    with blob.open('rb') as reader:
+        chunks = (_clean_frame(_coerce_numeric(chunk, plan), plan, fill)
+                  for chunk in _read_csv(reader, plan, header, chunksize=CHUNK_ROWS))
+        rows = _write_chunks(chunks, cleaned_blob, plan, if_generation_match)
+    print(f"Cleaned {rows} rows from {blob.name} in chunks of {CHUNK_ROWS}.")
+
+
+def clean_csv(bucket_name, file_name, plan, processed_prefix, size=None, generation=None):
+    """Descarga el CSV, limpia columnas de enteros y decimales, transforma fechas y horas, y luego vuelve a subir el archivo limpio.
+
+    Los archivos mayores que STREAMING_THRESHOLD_BYTES se procesan por trozos con memoria constante.
+    Con STAGING_FORMAT=PARQUET el archivo limpio se escribe como Parquet tipado y comprimido.
+    La subida solo crea el archivo limpio si no existe (if_generation_match=0). Si ya existe (un
+    intento anterior lo escribió) se reutiliza y se devuelve igualmente su nombre: que la carga se
+    haga una sola vez lo garantiza el id del job, no la existencia del archivo. Si el archivo limpio
+    es de otra generación del original, se sustituye. El tamaño llega en el evento; solo si falta
+    se piden los metadatos del objeto.
+    """
+
+    bucket = CS.bucket(bucket_name)
+    cleaned_file_name = _cleaned_file_name(file_name, processed_prefix)
+    cleaned_blob = bucket.blob(cleaned_file_name)
+    if generation is not None:
+        cleaned_blob.metadata = {'source_generation': str(generation)}
+
+    if size is None:
+        blob = bucket.get_blob(file_name)
+        size = blob.size
+    else:
+        blob = bucket.blob(file_name)
+    clean = _clean_streaming if size is not None and int(size) > STREAMING_THRESHOLD_BYTES else _clean_in_memory
+    try:
+        clean(blob, cleaned_blob, plan)
+    except PreconditionFailed:
+        existing = bucket.get_blob(cleaned_file_name)
+        previous = (existing.metadata or {}).get('source_generation') if existing is not None else None
+        if generation is None or previous is None or previous == str(generation):
+            print(f"El archivo {cleaned_file_name} ya existe; se reutiliza para la carga.")
+            return cleaned_file_name
+        # El original se volvió a subir: se sustituye el archivo limpio de la generación anterior
+        print(f"El archivo {cleaned_file_name} es de la generación {previous}; se limpia de nuevo la {generation}.")
+        clean(blob, cleaned_blob, plan, if_generation_match=existing.generation)
     return cleaned_file_name
 
 
+def _load_job_id(tableName, sources):
+    """Id determinista del job de carga a partir de los originales (bucket/nombre#generación)."""
+    digest = hashlib.sha1("\n".join(sorted(sources)).encode()).hexdigest()
+    return f"carga_{tableName}_{digest}"
+
+
+def _record_load_jobs(bucket_name, cleaned_file_names, tableName, job_id, executor=None):
+    """Anota en los metadatos de cada archivo limpio el job que lo carga en tableName.
+
+    Es el registro que consulta el backfill (ver _load_succeeded) para saber si un archivo
+    ya está en BigQuery; se escribe antes de lanzar el job.
+    """
+    bucket = CS.bucket(bucket_name)
+
+    def record(name):
+        blob = bucket.blob(name)
+        blob.metadata = {f'load_job_{tableName}': job_id}
+        blob.patch()
+
+    list((executor.map if executor is not None else map)(record, cleaned_file_names))
+
+
+def _load_succeeded(job_id):
+    """True si algún intento del job de carga (ver _load_table_from_uris) terminó sin errores."""
+    for attempt in range(MAX_LOAD_ATTEMPTS):
+        try:
+            load_job = BQ.get_job(f"{job_id}_{attempt}")
+        except NotFound:
+            return False
+        if load_job.state != 'DONE':
+            try:
+                load_job.result()
+            except Exception:
+                pass
+        if load_job.error_result is None:
+            return True
+    return False
+
 
 def streaming(data):
-    """Procesa el evento de carga de archivo y carga el CSV limpio a BigQuery."""
+    """Procesa el evento de carga de archivo y carga el CSV limpio a BigQuery.
+
+    Los errores se relanzan para que el evento se reintente; el reintento vuelve a cargar el
+    archivo salvo que su job de carga ya haya terminado bien.
+    """
     bucketname = data['bucket']
     filename = data['name']
+    generation = data.get('generation')
 
     # Verificar si el archivo ya ha sido procesado
     if filename.startswith(PROCESSED_PREFIX):
         print(f"File {filename} has already been processed. Skipping.")
         return
 
+    # Eventos duplicados o reintentos del mismo objeto en esta instancia
+    event_key = (bucketname, filename, generation)
+    if not _claim_event(event_key):
+        print(f"Event for {filename} (generation {event_key[2]}) already handled. Skipping.")
+        return
+
     try:
-        for table in config:
-            tableName = table.get('name')
-            if re.search(tableName.replace('_', '-'), filename) or re.search(tableName, filename):
-                tableSchema = table.get('schema')
-                tableFormat = table.get('format')
-
-                # Identificar las columnas de tipo entero, flotante y de fecha
-                int_columns = [col['name'] for col in tableSchema if col['type'] == 'INTEGER']
-                float_columns = [col['name'] for col in tableSchema if col['type'] == 'FLOAT']
-                date_columns = [col['name'] for col in tableSchema if col['type'] == 'DATE']
-
-                # Verificar si la tabla existe y crearla si es necesario
-                _check_if_table_exists(tableName, tableSchema)
-
-                if tableFormat == 'CSV':
-                    # Limpiar el archivo CSV de filas nulas y con valores no válidos en columnas de enteros y decimales
-                    cleaned_filename = clean_csv(bucketname, filename, int_columns, float_columns, date_columns, PROCESSED_PREFIX)
-
-                    # Cargar el archivo limpio en BigQuery
-                    _load_table_from_uri(bucketname, cleaned_filename, tableSchema, tableName)
+        for tableName in route_file(filename):
+            plan = CLEANING_PLANS[tableName]
+            # Verificar si la tabla existe y crearla si es necesario
+            _check_if_table_exists(tableName, plan['schema'])
+
+            if plan['format'] == 'CSV':
+                # Limpiar el archivo CSV de filas nulas y con valores no válidos en columnas de enteros y decimales
+                cleaned_filename = clean_csv(bucketname, filename, plan, PROCESSED_PREFIX,
+                                             size=data.get('size'), generation=generation)
+
+                # Cargar el archivo limpio en BigQuery
+                job_id = _load_job_id(tableName, [f"{bucketname}/{filename}#{generation}"])
+                _record_load_jobs(bucketname, [cleaned_filename], tableName, job_id)
+                _load_table_from_uri(bucketname, cleaned_filename, plan['schema'], tableName, job_id)
     except Exception:
+        _release_event(event_key)
         print('Error streaming file. Cause: %s' % (traceback.format_exc()))
+        raise
 
 def _check_if_table_exists(tableName, tableSchema):
-    """Verifica si la tabla existe en BigQuery y la crea si no existe."""
+    """Verifica si la tabla existe en BigQuery y la crea si no existe.
+
+    Las tablas ya comprobadas se recuerdan en KNOWN_TABLES mientras la instancia siga caliente.
+    """
+    if tableName in KNOWN_TABLES:
+        return True
     table_id = BQ.dataset(BQ_DATASET).table(tableName)
     try:
         BQ.get_table(table_id)
+        KNOWN_TABLES.add(tableName)
         return True
     except NotFound:
         logging.warning(f'Creating table: {tableName}')
         schema = create_schema_from_yaml(tableSchema)
         table = bigquery.Table(table_id, schema=schema)
-        table = BQ.create_table(table)
+        table = BQ.create_table(table, exists_ok=True)
+        KNOWN_TABLES.add(tableName)
         print(f"Created table {table.project}.{table.dataset_id}.{table.table_id}")
         return False
 
-def _load_table_from_uri(bucket_name, file_name, tableSchema, tableName):
-    """Carga el archivo CSV desde el bucket a la tabla de BigQuery."""
+def _load_table_from_uri(bucket_name, file_name, tableSchema, tableName, job_id):
+    """Carga el archivo limpio (CSV o Parquet según STAGING_FORMAT) desde el bucket a la tabla de BigQuery."""
     # Construye la URI del archivo en el bucket
     uri = f'gs://{bucket_name}/{file_name}'
+    return _load_table_from_uris([uri], tableSchema, tableName, job_id)
+
 
+def _load_table_from_uris(uris, tableSchema, tableName, job_id):
+    """Lanza un único job de carga para una lista de URIs y devuelve las filas cargadas.
+
+    job_id identifica el contenido (ver _load_job_id) y cada intento usa {job_id}_{n}: si un
+    intento anterior terminó bien no se vuelve a cargar, si falló se lanza el siguiente. Los
+    errores de carga se relanzan.
+    """
     # Define el ID de la tabla en BigQuery
     table_id = f'{BQ_DATASET}.{tableName}'
 
@@ -139,27 +503,44 @@ def _load_table_from_uri(bucket_name, file_name, tableSchema, tableName):
     print(schema)
 
     # Configura el job de carga
-    job_config = bigquery.LoadJobConfig(
-        schema=schema,
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,  # Si el archivo CSV tiene una fila de encabezado
-        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
-        max_bad_records=10  # Permite hasta 10 errores antes de fallar
-    )
-
-    # Inicia el job de carga
-    load_job = BQ.load_table_from_uri(
-        uri,
-        table_id,
-        job_config=job_config,
-    )
-
-    # Espera a que el job de carga termine
-    try:
-        load_job.result()
-        print(f"Loaded {load_job.output_rows} rows into {table_id}.")
-    except Exception as e:
-        print(f"Failed to load table: {e}")
+    if STAGING_FORMAT == 'PARQUET':
+        # El Parquet ya lleva los tipos del esquema: no hay cabecera ni errores de conversión que tolerar
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+    else:
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            source_format=bigquery.SourceFormat.CSV,
+            skip_leading_rows=1,  # Si el archivo CSV tiene una fila de encabezado
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            max_bad_records=10  # Permite hasta 10 errores antes de fallar
+        )
+
+    for attempt in range(MAX_LOAD_ATTEMPTS):
+        attempt_id = f"{job_id}_{attempt}"
+        try:
+            load_job = BQ.get_job(attempt_id)
+        except NotFound:
+            try:
+                # Inicia el job de carga y espera a que termine; si falla, la excepción llega al llamante
+                load_job = BQ.load_table_from_uri(uris, table_id, job_id=attempt_id, job_config=job_config)
+                load_job.result()
+                print(f"Loaded {load_job.output_rows} rows from {len(uris)} file(s) into {table_id} (job {attempt_id}).")
+                return load_job.output_rows
+            except Conflict:
+                # Otra ejecución acaba de crear el mismo intento
+                load_job = BQ.get_job(attempt_id)
+
+        if load_job.state != 'DONE':
+            load_job.result()
+        if load_job.error_result is None:
+            print(f"Job {attempt_id} already loaded {load_job.output_rows} rows into {table_id}. Skipping.")
+            return load_job.output_rows
+        print(f"Job {attempt_id} failed: {load_job.error_result}. Retrying.")
+    raise RuntimeError(f"Load into {table_id} failed {MAX_LOAD_ATTEMPTS} times (job {job_id})")
 
 def create_schema_from_yaml(table_schema):
     """Crea el esquema de BigQuery a partir del archivo YAML."""
@@ -190,3 +571,126 @@ def hello_gcs(cloud_event):
     print(f"Created: {timeCreated}")
     print(f"Updated: {updated}")
     streaming(data)
+
+
+# Máximo de URIs por job de carga que admite BigQuery
+MAX_URIS_PER_LOAD = 10000
+
+
+def backfill(bucket_name, prefix='', max_workers=8, reload_unverified=False):
+    """Procesa de una vez todos los archivos de un prefijo del bucket.
+
+    Los archivos se limpian en paralelo con un pool acotado de hilos; un fallo en un
+    archivo no detiene el resto. Después se lanza un solo job de carga por tabla con
+    todas las URIs limpias. Un archivo se omite solo si su archivo limpio es de la misma
+    generación y el job anotado en sus metadatos terminó bien; si está limpio pero no
+    cargado, se carga sin limpiarlo otra vez. Los archivos limpios de versiones anteriores
+    sin ese registro se devuelven en 'unverified' y solo se cargan con reload_unverified.
+    Devuelve un resumen con los archivos cargados, omitidos y fallidos (por nombre de archivo).
+    """
+    existing = {blob.name: blob for blob in CS.list_blobs(bucket_name, prefix=PROCESSED_PREFIX + prefix)}
+    succeeded = {}
+
+    def already_loaded(cleaned_blob, tableName):
+        job_id = (cleaned_blob.metadata or {}).get(f'load_job_{tableName}')
+        if job_id is None:
+            return False
+        if job_id not in succeeded:
+            succeeded[job_id] = _load_succeeded(job_id)
+        return succeeded[job_id]
+
+    tasks = []
+    cleaned = {}
+    skipped = []
+    unverified = []
+    for blob in CS.list_blobs(bucket_name, prefix=prefix):
+        if blob.name.startswith(PROCESSED_PREFIX) or blob.name.endswith('/'):
+            continue
+        tables = route_file(blob.name)
+        if not tables:
+            skipped.append(blob.name)
+        for tableName in tables:
+            if CLEANING_PLANS[tableName]['format'] != 'CSV':
+                continue
+            cleaned_blob = existing.get(_cleaned_file_name(blob.name, PROCESSED_PREFIX))
+            source_generation = (cleaned_blob.metadata or {}).get('source_generation') if cleaned_blob is not None else None
+            if cleaned_blob is None or (source_generation is not None and source_generation != str(blob.generation)):
+                tasks.append((tableName, blob.name, blob.size, blob.generation))
+            elif source_generation is None and not reload_unverified:
+                unverified.append(blob.name)
+            elif already_loaded(cleaned_blob, tableName):
+                skipped.append(blob.name)
+            else:
+                cleaned.setdefault(tableName, []).append((cleaned_blob.name, blob.name, blob.generation))
+
+    for tableName in sorted({task[0] for task in tasks} | set(cleaned)):
+        _check_if_table_exists(tableName, CLEANING_PLANS[tableName]['schema'])
+    print(f"Backfill of gs://{bucket_name}/{prefix}: {len(tasks)} file(s) to clean with {max_workers} worker(s), "
+          f"{sum(len(files) for files in cleaned.values())} already clean, {len(unverified)} unverified.")
+
+    failed = []
+    rows = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(clean_csv, bucket_name, file_name, CLEANING_PLANS[tableName], PROCESSED_PREFIX, size,
+                            generation): (tableName, file_name, generation)
+            for tableName, file_name, size, generation in tasks
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            tableName, file_name, generation = futures[future]
+            try:
+                cleaned_filename = future.result()
+            except Exception:
+                failed.append(file_name)
+                print(f"[{done}/{len(tasks)}] Failed to clean {file_name}: {traceback.format_exc()}")
+                continue
+            cleaned.setdefault(tableName, []).append((cleaned_filename, file_name, generation))
+            print(f"[{done}/{len(tasks)}] {file_name} -> {tableName}")
+
+        for tableName, files in cleaned.items():
+            plan = CLEANING_PLANS[tableName]
+            files.sort()
+            for start in range(0, len(files), MAX_URIS_PER_LOAD):
+                batch = files[start:start + MAX_URIS_PER_LOAD]
+                job_id = _load_job_id(tableName, [f"{bucket_name}/{name}#{generation}" for _, name, generation in batch])
+                try:
+                    _record_load_jobs(bucket_name, [cleaned_name for cleaned_name, _, _ in batch], tableName, job_id, executor)
+                    loaded = _load_table_from_uris([f'gs://{bucket_name}/{cleaned_name}' for cleaned_name, _, _ in batch],
+                                                   plan['schema'], tableName, job_id)
+                except Exception:
+                    failed.extend(name for _, name, _ in batch)
+                    print(f"Failed to load {len(batch)} file(s) into {tableName}: {traceback.format_exc()}")
+                else:
+                    rows[tableName] = rows.get(tableName, 0) + loaded
+
+    summary = {
+        'files': len(tasks),
+        'loaded_rows': rows,
+        'skipped': skipped,
+        'unverified': unverified,
+        'failed': failed,
+    }
+    print(f"Backfill finished: {summary}")
+    return summary
+
+
+@functions_framework.http
+def backfill_http(request):
+    """Punto de entrada HTTP del backfill: JSON o parámetros con bucket, prefix y workers."""
+    params = request.get_json(silent=True) or request.args
+    summary = backfill(params.get('bucket'), params.get('prefix', ''), int(params.get('workers', 8)),
+                       str(params.get('reload_unverified', '')).lower() in ('1', 'true'))
+    return summary, (500 if summary['failed'] else 200)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Carga en BigQuery todos los CSV de un prefijo del bucket")
+    parser.add_argument("bucket")
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--reload-unverified", action="store_true",
+                        help="carga también los archivos limpios sin registro del job que los cargó")
+    args = parser.parse_args()
+    backfill(args.bucket, args.prefix, args.workers, args.reload_unverified)
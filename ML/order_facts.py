@@ -0,0 +1,314 @@
+"""Tabla de hechos por pedido compartida por los notebooks de ML (clusterización, demanda y satisfacción).
+
+Cada notebook leía los mismos CSVs y encadenaba pd.merge de orders con pagos, artículos y
+reseñas; como un pedido tiene varios de cada uno, el resultado repetía cada pedido P·I·R
+veces. Aquí cada archivo se agrega por pedido y se une una sola vez: una fila por pedido,
+con los identificadores como categorías y con las correcciones de los notebooks ya
+aplicadas (año 2222 -> 2022, puntuación 's' -> 5).
+
+La tabla se guarda como Parquet particionado por año-mes de compra junto a un manifest con
+la huella de los CSVs de origen, y solo se reconstruye cuando cambian.
+
+Uso (en la carpeta de los CSVs):
+    from order_facts import load_order_facts, build_customer_features, build_daily_demand
+    facts = load_order_facts('.')
+    features = build_customer_features(facts)      # mismas filas que el merge de Clusterizacion_Clientes
+    demand = build_daily_demand(facts)              # mismas filas que el merge de Prediccion_Demanda
+    recent = load_order_facts('.', filters=[('year_month', '>=', '2023-01')])
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+# Las fórmulas de customer_features y de la demanda diaria son las de aggregation.py, las mismas
+# que calculan DuckDB, BigQuery y el estado incremental de la función cargaarchivosMLtransformaciones.
+# ML/aggregation.py es una copia idéntica de la de GCLOUD/cargaarchivosMLtransformaciones: al
+# cambiar una hay que copiarla a la otra
+from aggregation import CUSTOMER_FEATURES_SELECT, DAILY_DEMAND_SELECT, duckdb, purchase_dates, render_sql
+
+# Se incrementa al cambiar el cálculo para que las cachés existentes se reconstruyan
+FACTS_VERSION = 1
+
+# Columnas que se leen de cada CSV
+SOURCES = {
+    'orders': ['order_id', 'customer_id', 'status', 'purchase_timestamp', 'approved_at',
+               'delivered_courier_date', 'delivered_customer_date', 'estimated_delivery_date'],
+    'customers': ['customer_id'],
+    'order_payments': ['order_id', 'amount'],
+    'order_items': ['order_id', 'product_id', 'seller_id', 'price', 'freight_value'],
+    'reviews': ['order_id', 'score'],
+    'products': ['product_id', 'category_name', 'weight_g', 'length_cm', 'height_cm', 'width_cm'],
+    'sellers': ['seller_id'],
+}
+ID_COLUMNS = ['order_id', 'customer_id', 'status', 'category_name']
+DATE_COLUMNS = ['purchase_timestamp', 'approved_at', 'delivered_courier_date', 'delivered_customer_date',
+                'estimated_delivery_date']
+NO_DATE_PARTITION = '0000-00'
+
+CACHE_DIR = 'order_facts_cache'
+MANIFEST = 'manifest.json'
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(data_dir, previous=None):
+    """Tamaño, fecha de modificación y sha256 de cada CSV de origen.
+
+    Si el tamaño y la fecha coinciden con previous (la huella del manifest) se reutiliza su
+    sha256 sin volver a leer el archivo.
+    """
+    previous = previous or {}
+    fingerprint = {}
+    for kind in SOURCES:
+        path = os.path.join(data_dir, f"{kind}.csv")
+        stat = os.stat(path)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        old = previous.get(kind)
+        if old and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns']:
+            entry['sha256'] = old['sha256']
+        else:
+            entry['sha256'] = _file_hash(path)
+        fingerprint[kind] = entry
+    return fingerprint
+
+
+def read_sources(data_dir):
+    """Lee de cada CSV solo las columnas de SOURCES; los identificadores como texto."""
+    frames = {}
+    for kind, columns in SOURCES.items():
+        df = pd.read_csv(os.path.join(data_dir, f"{kind}.csv"), usecols=lambda c: c in columns, dtype=str)
+        frames[kind] = df.reindex(columns=columns)
+    return frames
+
+
+def _order_codes(order_index, order_ids):
+    """Posición en orders de cada order_id (-1 si no existe), resolviendo solo las categorías únicas."""
+    order_ids = order_ids.astype('category')
+    category_codes = order_index.get_indexer(order_ids.cat.categories)
+    codes = order_ids.cat.codes.to_numpy()
+    return np.where(codes >= 0, category_codes[codes], -1)
+
+
+def _per_order(codes, n_orders, weights=None):
+    """Suma (o cuenta) por pedido con bincount sobre las posiciones de _order_codes."""
+    mask = codes >= 0
+    if weights is not None:
+        weights = np.nan_to_num(np.asarray(weights, dtype=np.float64)[mask])
+    return np.bincount(codes[mask], weights=weights, minlength=n_orders).astype(np.float64)
+
+
+def _per_order_distinct(codes, n_orders, values):
+    """Número de valores distintos por pedido."""
+    pairs = pd.DataFrame({'order': codes, 'value': values})
+    pairs = pairs[(pairs['order'] >= 0) & pairs['value'].notna()].drop_duplicates()
+    return np.bincount(pairs['order'].to_numpy(), minlength=n_orders).astype(np.float64)
+
+
+def build_order_facts(frames):
+    """Construye la tabla de hechos (una fila por pedido) a partir de los DataFrames de read_sources."""
+    orders = frames['orders'].drop_duplicates('order_id', keep='last').reset_index(drop=True)
+    order_index = pd.Index(orders['order_id'])
+    n_orders = len(order_index)
+
+    facts = pd.DataFrame({'order_id': orders['order_id'], 'customer_id': orders['customer_id'],
+                          'status': orders['status']})
+    facts['customer_known'] = orders['customer_id'].isin(frames['customers']['customer_id']).to_numpy()
+    for col in DATE_COLUMNS:
+        facts[col] = pd.to_datetime(orders[col], errors='coerce', format='mixed')
+    # Mismo arreglo que los notebooks: el año 2222 es 2022
+    facts['purchase_timestamp'] = purchase_dates(facts['purchase_timestamp'])
+
+    payments = frames['order_payments']
+    codes = _order_codes(order_index, payments['order_id'])
+    facts['n_payments'] = _per_order(codes, n_orders)
+    facts['amount'] = _per_order(codes, n_orders, pd.to_numeric(payments['amount'], errors='coerce'))
+
+    items = frames['order_items'].merge(frames['products'].drop_duplicates('product_id'), on='product_id', how='left')
+    codes = _order_codes(order_index, items['order_id'])
+    price = pd.to_numeric(items['price'], errors='coerce')
+    facts['n_items'] = _per_order(codes, n_orders)
+    facts['n_prices'] = _per_order(codes, n_orders, price.notna())
+    facts['price_sum'] = _per_order(codes, n_orders, price)
+    facts['freight_sum'] = _per_order(codes, n_orders, pd.to_numeric(items['freight_value'], errors='coerce'))
+    facts['n_products'] = _per_order_distinct(codes, n_orders, items['product_id'])
+    facts['n_sellers'] = _per_order_distinct(codes, n_orders, items['seller_id'])
+    unknown_seller = ~items['seller_id'].isin(frames['sellers']['seller_id'])
+    facts['sellers_known'] = _per_order(codes, n_orders, unknown_seller) == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for col in ('weight_g', 'length_cm', 'height_cm', 'width_cm'):
+            value = pd.to_numeric(items[col], errors='coerce')
+            facts[f"{col}_mean"] = _per_order(codes, n_orders, value) / _per_order(codes, n_orders, value.notna())
+
+    # Categoría más frecuente entre los artículos del pedido (en empate, la primera alfabéticamente)
+    category = pd.DataFrame({'order': codes, 'category_name': items['category_name'].fillna('unknown')})
+    category = category[category['order'] >= 0].value_counts().rename('n').reset_index()
+    category = category.sort_values(['order', 'n', 'category_name'], ascending=[True, False, True])
+    category = category.drop_duplicates('order').set_index('order')['category_name']
+    facts['category_name'] = category.reindex(np.arange(n_orders)).to_numpy()
+
+    reviews = frames['reviews']
+    codes = _order_codes(order_index, reviews['order_id'])
+    score = pd.to_numeric(reviews['score'].replace('s', '5'), errors='coerce')
+    facts['n_reviews'] = _per_order(codes, n_orders)
+    facts['n_scores'] = _per_order(codes, n_orders, score.notna())
+    facts['score_sum'] = _per_order(codes, n_orders, score)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        facts['score_mean'] = facts['score_sum'] / facts['n_scores']
+
+    # Los pedidos sin fecha válida van a la partición '0000-00', que queda antes de cualquier mes
+    facts['year_month'] = facts['purchase_timestamp'].dt.strftime('%Y-%m').fillna(NO_DATE_PARTITION)
+    for col in ID_COLUMNS:
+        facts[col] = facts[col].astype('category')
+    return facts
+
+
+def _read_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(cache_dir, manifest):
+    with open(os.path.join(cache_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def refresh_cache(data_dir='.', cache_dir=None, force=False):
+    """Reconstruye la caché si los CSVs (o FACTS_VERSION) han cambiado. Devuelve el manifest."""
+    cache_dir = cache_dir or os.path.join(data_dir, CACHE_DIR)
+    manifest = _read_manifest(cache_dir)
+    previous = manifest['sources'] if manifest and manifest.get('version') == FACTS_VERSION else None
+    fingerprint = source_fingerprint(data_dir, previous)
+    if not force and previous and os.path.isdir(os.path.join(cache_dir, 'facts')) \
+            and all(fingerprint[kind]['sha256'] == previous.get(kind, {}).get('sha256') for kind in SOURCES):
+        if fingerprint != previous:
+            # Mismo contenido con otra fecha (p. ej. copiado de nuevo): basta con actualizar la huella
+            manifest['sources'] = fingerprint
+            _write_manifest(cache_dir, manifest)
+        return manifest
+
+    start = time.perf_counter()
+    facts = build_order_facts(read_sources(data_dir))
+    # Se escribe en una carpeta temporal y se sustituye al final para no dejar una caché a medias
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = os.path.join(cache_dir, 'facts.tmp')
+    shutil.rmtree(staging, ignore_errors=True)
+    table = facts.copy()
+    for col in ID_COLUMNS:
+        # Cada partición guardaría el diccionario completo de la categoría; en Parquet basta el texto
+        table[col] = table[col].astype(object)
+    table.to_parquet(staging, partition_cols=['year_month'], index=False)
+    shutil.rmtree(os.path.join(cache_dir, 'facts'), ignore_errors=True)
+    os.replace(staging, os.path.join(cache_dir, 'facts'))
+
+    manifest = {
+        'version': FACTS_VERSION,
+        'sources': fingerprint,
+        'rows': len(facts),
+        'built_at': pd.Timestamp.now().isoformat(),
+        'build_seconds': round(time.perf_counter() - start, 3),
+    }
+    _write_manifest(cache_dir, manifest)
+    print(f"order_facts: {len(facts)} pedidos en {manifest['build_seconds']} s -> {cache_dir}")
+    return manifest
+
+
+def load_order_facts(data_dir='.', cache_dir=None, columns=None, filters=None, force=False):
+    """Tabla de hechos por pedido desde la caché, construyéndola antes si hace falta.
+
+    columns y filters se pasan a pd.read_parquet; los filtros sobre year_month solo leen
+    las particiones necesarias.
+    """
+    cache_dir = cache_dir or os.path.join(data_dir, CACHE_DIR)
+    refresh_cache(data_dir, cache_dir, force)
+    facts = pd.read_parquet(os.path.join(cache_dir, 'facts'), columns=columns, filters=filters)
+    for col in ID_COLUMNS:
+        if col in facts.columns:
+            facts[col] = facts[col].astype('category')
+    return facts
+
+
+def _run_sql(sql, table, frame, reference_date):
+    """Ejecuta una consulta de aggregation sobre frame como tabla table.
+
+    Con duckdb instalado se consulta el DataFrame directamente; si no, se copia a un SQLite en
+    memoria con las fechas (purchase_ts) en segundos epoch, como las espera su dialecto.
+    """
+    if duckdb is not None:
+        conn = duckdb.connect()
+        try:
+            conn.register(table, frame)
+            return conn.execute(render_sql(sql, 'duckdb', {}, reference_date)).df()
+        finally:
+            conn.close()
+    purchase = frame['purchase_ts']
+    seconds = purchase.astype('datetime64[s]').astype('int64').astype(float)
+    frame = frame.assign(purchase_ts=np.where(purchase.isna(), np.nan, seconds))
+    with sqlite3.connect(':memory:') as conn:
+        frame.to_sql(table, conn, index=False)
+        return pd.read_sql_query(render_sql(sql, 'sqlite', {}, reference_date), conn)
+
+
+def build_customer_features(facts, reference_date=None):
+    """Características por cliente del notebook de clusterización.
+
+    El merge del notebook (orders ⋈ customers ⋈ payments ⋈ items, reviews por la izquierda)
+    repetía cada pedido P·I·max(R, 1) veces; aggregation.CUSTOMER_FEATURES_SELECT usa esas
+    repeticiones como pesos sobre la tabla de hechos.
+    """
+    known = facts[facts['customer_known']]
+    per_order = pd.DataFrame({
+        'customer_id': known['customer_id'].astype(str),
+        'purchase_ts': known['purchase_timestamp'],
+        'p': known['n_payments'],
+        'amount': known['amount'],
+        'i': known['n_items'],
+        'ip': known['n_prices'],
+        'price_sum': known['price_sum'],
+        'r': np.maximum(known['n_reviews'], 1),
+        'score_sum': known['score_sum'],
+    })
+    features = _run_sql(CUSTOMER_FEATURES_SELECT, 'per_order', per_order, reference_date)
+    features = features.rename(columns={'days_since_purchase': 'days_since_last_purchase'})
+    features['days_since_last_purchase'] = features['days_since_last_purchase'].astype(np.int64)
+    return features.set_index('customer_id').sort_index()
+
+
+def build_daily_demand(facts, reference_date=None):
+    """Serie diaria del notebook de demanda: cada pedido pesa P·I (filas de orders ⋈ items ⋈ payments)."""
+    demand_orders = pd.DataFrame({
+        'purchase_ts': facts['purchase_timestamp'],
+        'p': facts['n_payments'],
+        'i': facts['n_items'],
+    })
+    demand = _run_sql(DAILY_DEMAND_SELECT, 'demand_orders', demand_orders, reference_date)
+    return pd.DataFrame({'ds': pd.to_datetime(demand['ds']), 'y': demand['y'].astype(np.int64)})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default=".", help="carpeta con orders.csv, customers.csv, ...")
+    parser.add_argument("--cache-dir", default=None, help=f"por defecto <data-dir>/{CACHE_DIR}")
+    parser.add_argument("--force", action="store_true", help="reconstruir aunque los CSVs no hayan cambiado")
+    args = parser.parse_args()
+    manifest = refresh_cache(args.data_dir, args.cache_dir, args.force)
+    print(json.dumps({key: manifest[key] for key in ('version', 'rows', 'built_at')}))
+
+
+if __name__ == "__main__":
+    main()
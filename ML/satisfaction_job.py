@@ -0,0 +1,250 @@
+"""Entrenamiento del modelo de satisfacción (puntuación de la reseña de cada pedido) con XGBoost.
+
+Parte de la tabla de hechos de order_facts (una fila por pedido con reseña) y sustituye el
+bucle del notebook Satisfaccion sobre ParameterGrid:
+
+- La matriz de características se guarda codificada junto a la caché de order_facts y solo
+  se recalcula cuando cambia la tabla. Las categorías (status, category_name) van como
+  códigos con el soporte categórico de XGBoost en vez de get_dummies.
+- Búsqueda de hiperparámetros por successive halving: todas las combinaciones empiezan con
+  pocas rondas, y solo el mejor tercio pasa a la siguiente etapa con el triple de rondas.
+  Cada entrenamiento usa tree_method='hist' y early stopping sobre el conjunto de validación,
+  y los de una misma etapa se reparten entre procesos con joblib.
+- El modelo ganador se guarda como JSON de XGBoost con un JSON de metadatos (columnas,
+  vocabularios de las categorías, métricas) que usa la API en /satisfaction_predict.
+
+Uso (en la carpeta de los CSVs):
+    python satisfaction_job.py --workers 4
+    python satisfaction_job.py --publish          # sube modelo y metadatos a gs://bucket_for_model_tfm
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from joblib import Parallel, delayed
+
+from order_facts import CACHE_DIR, FACTS_VERSION, load_order_facts, refresh_cache
+
+# Se incrementa al cambiar la codificación para invalidar la matriz guardada
+ENCODING_VERSION = 1
+# Formato de los metadatos que valida la API (satisfaction_model.load_satisfaction_model)
+MODEL_FORMAT_VERSION = 1
+
+NUMERIC_FEATURES = ['price_sum', 'freight_sum', 'n_items', 'weight_g_mean', 'length_cm_mean', 'height_cm_mean',
+                    'width_cm_mean']
+CATEGORICAL_FEATURES = ['status', 'category_name']
+FEATURE_NAMES = NUMERIC_FEATURES + CATEGORICAL_FEATURES
+FEATURE_TYPES = ['q'] * len(NUMERIC_FEATURES) + ['c'] * len(CATEGORICAL_FEATURES)
+
+# Misma rejilla que el notebook; n_estimators lo decide successive halving + early stopping
+PARAM_GRID = {
+    'max_depth': [3, 5, 7],
+    'learning_rate': [0.01, 0.1, 0.3],
+    'subsample': [0.8, 1.0],
+    'colsample_bytree': [0.8, 1.0],
+}
+MIN_ROUNDS = 50
+MAX_ROUNDS = 1350
+HALVING_FACTOR = 3
+EARLY_STOPPING_ROUNDS = 20
+MAX_BIN = 256
+
+bucket_name = 'bucket_for_model_tfm'
+model_filename = 'satisfaccion_model.json'
+metadata_filename = 'satisfaccion_model_metadata.json'
+matrix_filename = 'satisfaction_matrix.npz'
+
+
+def encode(facts, vocabularies):
+    """Matriz float32 en el orden de FEATURE_NAMES; las categorías como su posición en el vocabulario.
+
+    Los valores ausentes y las categorías fuera del vocabulario quedan como NaN (XGBoost los trata
+    como ausentes). La API hace la misma codificación a partir de los metadatos publicados.
+    """
+    X = np.empty((len(facts), len(FEATURE_NAMES)), dtype=np.float32)
+    for j, col in enumerate(NUMERIC_FEATURES):
+        X[:, j] = pd.to_numeric(facts[col], errors='coerce').to_numpy(dtype=np.float32, na_value=np.nan)
+    for j, col in enumerate(CATEGORICAL_FEATURES, start=len(NUMERIC_FEATURES)):
+        codes = pd.Categorical(facts[col].astype(object), categories=vocabularies[col]).codes
+        X[:, j] = np.where(codes >= 0, codes, np.nan)
+    return X
+
+
+def training_rows(facts):
+    """Pedidos con reseña, artículos, cliente y vendedores conocidos (las filas del notebook, una por pedido)."""
+    keep = (facts['n_scores'] > 0) & (facts['n_items'] > 0) & facts['customer_known'] & facts['sellers_known']
+    return facts[keep]
+
+
+def load_matrix(data_dir='.', cache_dir=None):
+    """(X, y, vocabularios, clave) desde la caché; se recalculan si cambia order_facts o ENCODING_VERSION."""
+    cache_dir = cache_dir or os.path.join(data_dir, CACHE_DIR)
+    manifest = refresh_cache(data_dir, cache_dir)
+    sources = {kind: entry['sha256'] for kind, entry in manifest['sources'].items()}
+    key = hashlib.sha256(json.dumps([sources, FACTS_VERSION, ENCODING_VERSION], sort_keys=True).encode()).hexdigest()
+
+    path = os.path.join(cache_dir, matrix_filename)
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as cached:
+            if str(cached['key']) == key:
+                vocabularies = {col: [str(v) for v in cached[f"vocab_{col}"]] for col in CATEGORICAL_FEATURES}
+                return cached['X'], cached['y'], vocabularies, key
+
+    start = time.perf_counter()
+    columns = FEATURE_NAMES + ['n_scores', 'customer_known', 'sellers_known', 'score_mean']
+    facts = training_rows(load_order_facts(data_dir, cache_dir, columns=list(dict.fromkeys(columns))))
+    vocabularies = {col: sorted(facts[col].dropna().astype(str).unique()) for col in CATEGORICAL_FEATURES}
+    X = encode(facts, vocabularies)
+    y = facts['score_mean'].to_numpy(dtype=np.float32)
+    np.savez(path, key=np.array(key), X=X, y=y,
+             **{f"vocab_{col}": np.array(vocab, dtype=str) for col, vocab in vocabularies.items()})
+    print(f"Matriz de satisfacción: {X.shape[0]} pedidos x {X.shape[1]} columnas en {time.perf_counter() - start:.2f} s")
+    return X, y, vocabularies, key
+
+
+def split(n_rows, seed=42, valid_size=0.15, test_size=0.15):
+    """Índices de entrenamiento, validación (early stopping y halving) y test (métrica final)."""
+    order = np.random.default_rng(seed).permutation(n_rows)
+    n_test, n_valid = int(n_rows * test_size), int(n_rows * valid_size)
+    return order[n_test + n_valid:], order[n_test:n_test + n_valid], order[:n_test]
+
+
+def expand_grid(grid):
+    """{'a': [1, 2], 'b': [3]} -> [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]"""
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+_dmatrices = {}
+
+
+def _datasets(key, X_train, y_train, X_valid, y_valid):
+    # Los procesos de joblib se reutilizan entre tareas: cada uno cuantiza la matriz una sola vez
+    if key not in _dmatrices:
+        _dmatrices.clear()
+        train = xgb.QuantileDMatrix(X_train, y_train, feature_names=FEATURE_NAMES, feature_types=FEATURE_TYPES,
+                                    enable_categorical=True, max_bin=MAX_BIN)
+        valid = xgb.QuantileDMatrix(X_valid, y_valid, feature_names=FEATURE_NAMES, feature_types=FEATURE_TYPES,
+                                    enable_categorical=True, max_bin=MAX_BIN, ref=train)
+        _dmatrices[key] = (train, valid)
+    return _dmatrices[key]
+
+
+def fit_config(params, rounds, data, threads, seed=42):
+    """Entrena una combinación hasta rounds rondas con early stopping; devuelve RMSE de validación y booster."""
+    train, valid = _datasets(*data)
+    start = time.perf_counter()
+    booster = xgb.train(
+        {'tree_method': 'hist', 'objective': 'reg:squarederror', 'eval_metric': 'rmse', 'max_bin': MAX_BIN,
+         'nthread': threads, 'seed': seed, **params},
+        train, num_boost_round=rounds, evals=[(valid, 'valid')],
+        early_stopping_rounds=EARLY_STOPPING_ROUNDS, verbose_eval=False)
+    return {'params': params, 'rounds': rounds, 'rmse': float(booster.best_score),
+            'best_iteration': int(booster.best_iteration), 'seconds': time.perf_counter() - start,
+            'stopped': booster.num_boosted_rounds() < rounds, 'booster': booster}
+
+
+def successive_halving(grid, data, workers, threads):
+    """data = (clave, X_train, y_train, X_valid, y_valid). Devuelve (mejor resultado, historial de todas las etapas)."""
+    survivors, rounds, history = [None] * len(grid), MIN_ROUNDS, []
+    candidates = list(grid)
+    with Parallel(n_jobs=workers) as parallel:
+        while True:
+            start = time.perf_counter()
+            # Las combinaciones que ya pararon por early stopping darían el mismo modelo: no se reentrenan
+            pending = [params for params, previous in zip(candidates, survivors)
+                       if previous is None or not previous['stopped']]
+            trained = iter(parallel(delayed(fit_config)(params, rounds, data, threads) for params in pending))
+            results = [previous if previous is not None and previous['stopped'] else next(trained)
+                       for previous in survivors]
+            results.sort(key=lambda r: r['rmse'])
+            history += [{key: r[key] for key in ('params', 'rounds', 'rmse', 'best_iteration', 'seconds')}
+                        for r in results if r['rounds'] == rounds]
+            print(f"{len(pending)} de {len(candidates)} combinaciones x {rounds} rondas en "
+                  f"{time.perf_counter() - start:.1f} s, mejor RMSE {results[0]['rmse']:.4f} ({results[0]['params']})")
+            if len(results) == 1 or rounds >= MAX_ROUNDS:
+                return results[0], history
+            survivors = results[:max(1, len(results) // HALVING_FACTOR)]
+            candidates = [r['params'] for r in survivors]
+            rounds = min(rounds * HALVING_FACTOR, MAX_ROUNDS)
+
+
+def evaluate(booster, X, y):
+    pred = booster.inplace_predict(X, iteration_range=(0, booster.best_iteration + 1))
+    mse = float(np.mean((pred - y) ** 2))
+    return {'mse': mse, 'rmse': float(np.sqrt(mse)), 'r2': float(1 - mse / np.var(y)), 'rows': int(len(y))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default=".", help="carpeta con orders.csv, customers.csv, ...")
+    parser.add_argument("--cache-dir", default=None, help=f"por defecto <data-dir>/{CACHE_DIR}")
+    parser.add_argument("--grid", default=json.dumps(PARAM_GRID), help="JSON {parámetro: [valores]}")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output-dir", default=".", help="dónde escribir el modelo y los metadatos")
+    parser.add_argument("--publish", action="store_true", help=f"subir el modelo a gs://{bucket_name}")
+    args = parser.parse_args()
+
+    X, y, vocabularies, key = load_matrix(args.data_dir, args.cache_dir)
+    train, valid, test = split(len(y))
+    grid = expand_grid(json.loads(args.grid))
+    workers = max(1, min(args.workers, len(grid)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"{len(train)} entrenamiento / {len(valid)} validación / {len(test)} test, "
+          f"{len(grid)} combinaciones, {workers} procesos x {threads} hilos")
+
+    start = time.perf_counter()
+    data = (key, X[train], y[train], X[valid], y[valid])
+    best, history = successive_halving(grid, data, workers, threads)
+    search_seconds = time.perf_counter() - start
+    booster = best['booster']
+    metrics = {'valid': evaluate(booster, X[valid], y[valid]), 'test': evaluate(booster, X[test], y[test])}
+    print(f"Mejor: {best['params']}, {booster.best_iteration + 1} árboles, test {metrics['test']} "
+          f"({len(history)} entrenamientos en {search_seconds:.1f} s)")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    model_path = os.path.join(args.output_dir, model_filename)
+    metadata_path = os.path.join(args.output_dir, metadata_filename)
+    booster.save_model(model_path)
+    with open(model_path, 'rb') as f:
+        model_sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    metadata = {
+        'format_version': MODEL_FORMAT_VERSION,
+        'model_sha256': model_sha256,
+        'numeric_features': NUMERIC_FEATURES,
+        'categorical_features': {col: vocabularies[col] for col in CATEGORICAL_FEATURES},
+        'best_iteration': int(booster.best_iteration),
+        'params': best['params'],
+        'metrics': metrics,
+        'search': {'trainings': len(history), 'seconds': round(search_seconds, 3), 'min_rounds': MIN_ROUNDS,
+                   'max_rounds': MAX_ROUNDS, 'halving_factor': HALVING_FACTOR},
+        'xgboost_version': xgb.__version__,
+        'trained_at': pd.Timestamp.now().isoformat(),
+    }
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    print(f"Modelo guardado en {model_path} y {metadata_path}")
+
+    if args.publish:
+        from google.cloud import storage
+        bucket = storage.Client().bucket(bucket_name)
+        # La API comprueba model_sha256: entre las dos subidas sigue sirviendo el modelo anterior.
+        # Los metadatos van los últimos y solo si la generación subida es el modelo que describen.
+        model_blob = bucket.blob(model_filename)
+        model_blob.upload_from_filename(model_path)
+        uploaded = model_blob.download_as_bytes(if_generation_match=model_blob.generation)
+        if hashlib.sha256(uploaded).hexdigest() != model_sha256:
+            raise RuntimeError(f"gs://{bucket_name}/{model_filename} no coincide con {model_sha256}; no se publican los metadatos")
+        bucket.blob(metadata_filename).upload_from_filename(metadata_path)
+        print(f"Modelo publicado en gs://{bucket_name}/{model_filename}")
+
+
+if __name__ == "__main__":
+    main()